@@ -51,5 +51,27 @@ def test_array_vstack1():
   assert numpy.all(A123 == A123_refs)
 
 
+def test_growable_array1():
+  # 20261019
+  from wpylib.array_tools import growable_array
+
+  print("test_growable_array1::")
+  A = growable_array(capacity=2)
+  rows = numpy.arange(30.0).reshape((10, 3))
+  for r in rows[:5]:
+    A.append(r)
+  A.extend(rows[5:])
+  assert len(A) == 10 and A.shape == (3,)
+  assert numpy.all(A.array() == rows)
+  assert numpy.all(A[-1] == rows[-1])
+  assert numpy.all(numpy.asarray(A) == rows)
+  A.reserve(100)
+  assert len(A.data) == 100 and numpy.all(A.array() == rows)
+  B = growable_array(shape=(), dtype=int)
+  assert B.array().shape == (0,)
+  B.extend([1, 2, 3])
+  assert list(B) == [1, 2, 3]
+
+
 if __name__ == '__main__':
   test_array_vstack1()
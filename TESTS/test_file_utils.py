@@ -0,0 +1,127 @@
+# Created: 20261019
+# Test module for wpylib.file.file_utils
+
+import os.path
+from wpylib.file.tmpdir import tmpdir
+from wpylib.file.file_utils import open_input_file, open_output_file
+
+
+def make_test_lines(nlines):
+  """Synthetic QMC-like output lines."""
+  return [ "%6d %20.12f %20.12f %12.8f\n" % (i, -1.0 - 1e-3*(i % 97), 0.25 + 1e-4*(i % 13), 1.0/(1+i))
+           for i in xrange(nlines) ]
+
+
+def test_open_output_file1():
+  """Compressed output must be readable by open_input_file, the standard
+  gzip module, and the standard decompressor executables."""
+  import gzip
+  from wpylib import shell_tools as sh
+  print("test_open_output_file1::")
+  lines = make_test_lines(5000)
+  for ext in (".gz", ".xz", ".bz2", ""):
+    fname = os.path.join(tmpdir(), "test_open_output_file1.txt" + ext)
+    with open_output_file(fname, nthreads=3, blocksize=10000) as F:
+      for L in lines:
+        F.write(L)
+    assert list(open_input_file(fname)) == lines
+    if ext == ".gz":
+      assert gzip.GzipFile(fname).read() == "".join(lines)
+      assert sh.pipe_out(("gzip", "-dc", fname)) == "".join(lines)
+    elif ext == ".xz":
+      assert sh.pipe_out(("xz", "-dc", fname)) == "".join(lines)
+
+  # Empty file and append mode:
+  fname = os.path.join(tmpdir(), "test_open_output_file1b.txt.gz")
+  open_output_file(fname).close()
+  assert list(open_input_file(fname)) == []
+  F = open_output_file(fname, mode="a")
+  F.writelines(lines[:10])
+  F.close()
+  assert list(open_input_file(fname)) == lines[:10]
+
+
+def test_open_input_file_readahead1():
+  """Read-ahead input must yield the same lines as the plain input,
+  and must keep the super_file pushback semantics."""
+  from wpylib.iofmt.text_input import text_input
+  print("test_open_input_file_readahead1::")
+  lines = make_test_lines(3000) + ["last line without newline"]
+  for ext in (".gz", ".bz2", ""):
+    fname = os.path.join(tmpdir(), "test_open_input_file_readahead1.txt" + ext)
+    with open_output_file(fname) as F:
+      F.writelines(lines)
+    # small buffers to exercise the line splitting across buffers
+    from wpylib.file.file_utils import readahead_file
+    R = readahead_file(open_input_file(fname), nbuffers=2, bufsize=777)
+    assert list(R) == lines
+    R.close()
+
+    S = open_input_file(fname, superize=1, readahead=3)
+    L0 = S.next()
+    L1 = S.next()
+    S.push(L1)
+    S.push(L0)
+    assert [S.next(), S.next(), S.next()] == lines[:3]
+    S.close()
+
+    arr1 = text_input(fname).read_floats(0, 1, 3, maxcount=3000)
+    arr2 = text_input(fname, readahead=1).read_floats(0, 1, 3, maxcount=3000)
+    assert (arr1 == arr2).all()
+
+
+def test_readahead_file_read_lines1():
+  """Sized reads mixed with line iteration."""
+  from wpylib.file.file_utils import readahead_file
+  print("test_readahead_file_read_lines1::")
+  lines = make_test_lines(300) + ["last line without newline"]
+  text = "".join(lines)
+  fname = os.path.join(tmpdir(), "test_readahead_file_read_lines1.txt")
+  with open_output_file(fname) as F:
+    F.writelines(lines)
+  for bufsize in (7, 100, 1<<20):
+    R = readahead_file(open_input_file(fname), nbuffers=2, bufsize=bufsize)
+    assert R.read(1) == text[:1]
+    assert R.next() == lines[0][1:]
+    assert R.readline() == lines[1]
+    n = len(lines[0]) + len(lines[1])
+    assert R.read(5) == text[n:n+5]
+    assert list(R) == [lines[2][5:]] + lines[3:]
+    R.close()
+    # sized read ending inside the unterminated last line:
+    R = readahead_file(open_input_file(fname), nbuffers=2, bufsize=bufsize)
+    assert R.read(len(text) - 4) == text[:-4]
+    assert list(R) == [text[-4:]]
+    R.close()
+
+
+def bench_open_input_file_readahead(nlines=400000, repeat=3):
+  """Throughput benchmark of read-ahead decompression on synthetic
+  QMC-like output, parsed with text_input.read_floats.
+  Prints the parsing throughput (in MB/s of uncompressed text) with and
+  without read-ahead for each compression format.
+
+  On a single-core machine no speedup is expected, since decompression
+  and parsing are then merely interleaved.
+  """
+  import time
+  from wpylib.iofmt.text_input import text_input
+  lines = make_test_lines(nlines)
+  nbytes = sum([ len(L) for L in lines ])
+  for ext in (".gz", ".bz2", ".xz"):
+    fname = os.path.join(tmpdir(), "bench_readahead.txt" + ext)
+    with open_output_file(fname) as F:
+      F.writelines(lines)
+    for readahead in (0, 4):
+      tm = []
+      for r in xrange(repeat):
+        t1 = time.time()
+        arr = text_input(fname, readahead=readahead).read_floats(0, 1, 2, 3)
+        tm.append(time.time() - t1)
+      assert arr.shape == (nlines, 4)
+      print("%-4s readahead=%d : %8.2f MB/s  (best of %d: %.3f secs)" \
+            % (ext, readahead, nbytes / min(tm) / 1e6, repeat, min(tm)))
+
+
+if __name__ == '__main__':
+  bench_open_input_file_readahead()
@@ -0,0 +1,130 @@
+# Created: 20261019
+# Test module for wpylib.math.fitting.fit_cache
+
+import os.path
+import numpy
+from wpylib.file.tmpdir import tmpdir
+from wpylib.math.fitting import fit_func, fit_func_base
+from wpylib.math.fitting.fit_cache import fit_cache
+from wpylib.math.fitting.funcs_pec import morse2_fit_func
+
+
+def sample_data():
+  x = numpy.linspace(1.55, 3.0, 13)
+  C0 = (-2.18, 9.8, 1.80, 1.86)
+  dy = 0.02 * numpy.ones(len(x))
+  y = morse2_fit_func()(C0, [x]) + dy * numpy.random.RandomState(11).normal(size=len(x))
+  return (x, y, dy)
+
+
+def test_fit_cache_method1():
+  """Caching of fit_func_base.fit results, in memory and on disk."""
+  print("test_fit_cache_method1::")
+  fname = os.path.join(tmpdir(), "test_fit_cache_method1.h5")
+  if os.path.exists(fname):
+    os.remove(fname)
+  (x, y, dy) = sample_data()
+
+  func = morse2_fit_func()
+  xopt_ref = func.fit(x, y, dy)
+  rec_ref = func.last_fit
+
+  cache = fit_cache(fname, version=1, max_entries=2)
+  func.fit_cache = cache
+  xopt1 = func.fit(x, y, dy)
+  xopt2 = func.fit(x, y, dy)
+  assert (cache.misses, cache.hits) == (1, 1)
+  assert numpy.all(xopt1 == xopt_ref) and numpy.all(xopt2 == xopt_ref)
+  for k in ('xerr', 'chi_square', 'funcalls'):
+    assert numpy.all(func.last_fit[k] == rec_ref[k]), k
+
+  # Anything that changes the fit must miss:
+  func.fit(x, y * 1.0001, dy)                 # data
+  func.fit(x, y, dy, Guess=xopt_ref)          # guess
+  func.use_jacobian = True
+  func.fit(x, y, dy)                          # ansatz flag
+  func.use_jacobian = False
+  func.fit(x, y, dy, fit_opts=dict(xtol=1e-6))  # fit options
+  assert cache.misses == 5
+  assert len(cache) == 2
+
+  # A fresh cache (new session) finds the results on disk:
+  func2 = morse2_fit_func()
+  func2.fit_cache = fit_cache(fname, version=1)
+  xopt3 = func2.fit(x, y, dy)
+  assert func2.fit_cache.disk_hits == 1
+  assert numpy.all(xopt3 == xopt_ref)
+  assert numpy.all(func2.last_fit['xerr'] == rec_ref['xerr'])
+  assert func2.guess_params == func.guess_params
+
+  # New version tag invalidates the stored results:
+  func2.fit_cache = fit_cache(fname, version=2)
+  func2.fit(x, y, dy)
+  assert func2.fit_cache.misses == 1
+
+
+def test_fit_cache_ansatz_state1():
+  """The class-level tuning attributes are part of the cache key; the
+  methods and the debugging settings are not."""
+  print("test_fit_cache_ansatz_state1::")
+  from wpylib.math.fitting.fit_cache import ansatz_state
+  from wpylib.math.fitting.funcs_simple import expm_fit_func
+  class expm2(expm_fit_func):
+    pass
+  func = expm2()
+  state0 = ansatz_state(func)
+  assert state0[1]['A_guess'] == expm_fit_func.A_guess
+  assert state0[1]['fit_method'] == 'leastsq'
+  assert 'fit' not in state0[1] and 'debug' not in state0[1]
+  expm2.A_guess = -1.0
+  assert ansatz_state(func) != state0
+  del expm2.A_guess
+  expm2.debug = 5
+  assert ansatz_state(func) == state0
+
+
+def test_fit_cache_lmfit1():
+  """Cache hits of lmfit fits restore the fitted Parameters."""
+  print("test_fit_cache_lmfit1::")
+  from wpylib.math.fitting import HAS_LMFIT
+  if not HAS_LMFIT:
+    return
+  (x, y, dy) = sample_data()
+  cache = fit_cache()
+  funcs = []
+  for i in xrange(2):
+    func = morse2_fit_func()
+    func.fit_method = 'lmfit:leastsq'
+    func.fit_cache = cache
+    func.fit(x, y, dy)
+    funcs.append(func)
+  assert (cache.misses, cache.hits) == (1, 1)
+  (P1, P2) = (funcs[0].Params, funcs[1].Params)
+  assert funcs[1].last_fit.params is P2
+  for k in P1:
+    assert P2[k].value == P1[k].value == funcs[0].last_fit.params[k].value
+    assert P2[k].stderr == P1[k].stderr
+
+  rec1 = fit_func(funcs[0], x=[x], y=y, dy=dy, method='lmfit:leastsq',
+                  outfmt=0, cache=cache)
+  rec2 = fit_func(funcs[0], x=[x], y=y, dy=dy, method='lmfit:leastsq',
+                  outfmt=0, cache=cache)
+  assert cache.hits == 2
+  for k in rec1['params']:
+    assert rec2['params'][k].value == rec1['params'][k].value
+
+
+def test_fit_cache_fit_func1():
+  """Caching of fit_func calls (in memory only)."""
+  print("test_fit_cache_fit_func1::")
+  (x, y, dy) = sample_data()
+  func = morse2_fit_func()
+  cache = fit_cache()
+  guess = (-2.2, 9.0, 1.8, 1.8)
+  rec1 = fit_func(func, x=[x], y=y, dy=dy, Guess=guess, outfmt=0, cache=cache)
+  rec2 = fit_func(func, x=[x], y=y, dy=dy, Guess=guess, outfmt=0, cache=cache)
+  xopt3 = fit_func(func, x=[x], y=y, dy=dy, Guess=guess, cache=cache)
+  assert (cache.misses, cache.hits) == (1, 2)
+  assert numpy.all(rec1['xopt'] == rec2['xopt']) and numpy.all(xopt3 == rec1['xopt'])
+  assert rec2['funcalls'] == rec1['funcalls']
+  assert rec2['chi_square'] == rec1['chi_square']
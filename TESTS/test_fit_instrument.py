@@ -0,0 +1,89 @@
+# Created: 20261019
+# Test module for wpylib.math.fitting.instrument
+
+import numpy
+from wpylib.math.fitting.instrument import make_instrument
+from wpylib.math.fitting.funcs_pec import morse2_fit_func
+
+
+def sample_data():
+  x = numpy.linspace(1.55, 3.0, 13)
+  C0 = (-2.18, 9.8, 1.80, 1.86)
+  dy = 0.02 * numpy.ones(len(x))
+  y = morse2_fit_func()(C0, [x]) + dy * numpy.random.RandomState(11).normal(size=len(x))
+  return (x, y, dy)
+
+
+def test_fit_instrument1():
+  """The instrumentation modes give identical fits and bounded logs."""
+  print("test_fit_instrument1::")
+  (x, y, dy) = sample_data()
+
+  func = morse2_fit_func()
+  xopt_ref = func.fit(x, y, dy)
+  I = func.instrument
+  assert I.mode == 'counters'
+  assert I.params_log is None
+  assert I.nfits == 1
+  # All the evaluations are counted, including those not reported by
+  # the minimizer:
+  ncalls = I.last_fit_stats['ncalls']
+  assert I.ncalls == ncalls >= func.last_fit['funcalls']
+  func.fit(x, y, dy)
+  assert I.nfits == 2 and I.ncalls == 2 * ncalls
+  assert I.fit_time > 0
+  # The instrument is resolved once per fit, not on every evaluation:
+  assert func.func_call_hook == I.on_call
+  func(xopt_ref, [x])
+  assert I.ncalls == 2 * ncalls + 1
+
+  for mode in ('off', 'ring', 'trace'):
+    func = morse2_fit_func()
+    func.instrument = make_instrument(mode, ring_size=5)
+    for i in xrange(3):
+      xopt = func.fit(x, y, dy)
+      assert numpy.all(xopt == xopt_ref), mode
+    I = func.instrument
+    print(mode, I.stats())
+    if mode == 'off':
+      assert I.ncalls == 0 and I.nfits == 0
+      assert func.func_call_hook is None
+    elif mode == 'ring':
+      assert len(I.params_log) == 5 and len(I.fit_log) == 3
+      assert numpy.all(I.params_log[-1] == func.last_fit['xopt'])
+      assert I.stats()['eval_time'] > 0
+    elif mode == 'trace':
+      assert len(I.params_log) == ncalls
+      assert len(I.fit_log) == 3
+      assert func.dbg_params_log is I.params_log
+
+  # Legacy switch, also when turned on after the first fit:
+  func = morse2_fit_func()
+  func.dbg_params = 1
+  func.fit(x, y, dy)
+  assert len(func.dbg_params_log) == ncalls
+  func = morse2_fit_func()
+  func.fit(x, y, dy)
+  func.dbg_params = 1
+  func.fit(x, y, dy)
+  assert func.instrument.mode == 'trace'
+  assert len(func.dbg_params_log) == ncalls
+  func.dbg_params = 0
+  func.instrument_mode = 'ring'
+  func.fit(x, y, dy)
+  assert func.instrument.mode == 'ring'
+  # An explicitly assigned instrument is kept:
+  func.instrument = make_instrument('off')
+  func.fit(x, y, dy)
+  assert func.instrument.mode == 'off'
+
+  # Variable projection logs the full parameter sets only:
+  func = morse2_fit_func()
+  func.use_varpro = True
+  func.instrument = make_instrument('trace')
+  func.fit(x, y, dy)
+  assert numpy.all([ len(C) == 4 for C in func.dbg_params_log ])
+
+
+if __name__ == '__main__':
+  test_fit_instrument1()
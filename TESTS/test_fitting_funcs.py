@@ -0,0 +1,390 @@
+# Created: 20261019
+# Test module for the fit_func_base function ansatzes
+
+import numpy
+from wpylib.math.fitting import fit_func_base
+from wpylib.math.fitting import funcs_pec, funcs_simple, funcs_physics
+
+
+# (ansatz class, a reasonable parameter set)
+ansatz_samples = [
+  (funcs_pec.harm_fit_func,         (-2.18, 9.8, 1.80)),
+  (funcs_pec.harmcube_fit_func,     (-2.18, 9.8, 1.80, -1.5)),
+  (funcs_pec.morse2_fit_func,       (-2.18, 9.8, 1.80, 1.86)),
+  (funcs_pec.ext3Bmorse2_fit_func,  (-2.18, 9.8, 1.80, 1.86, 0.3)),
+  (funcs_simple.const_fit_func,     (1.25,)),
+  (funcs_simple.linear_fit_func,    (1.25, -0.5)),
+  (funcs_simple.exp_fit_func,       (-2.6, -9.0, 1.57)),
+  (funcs_simple.expm_fit_func,      (-2.6, 9.0, 1.57)),
+  (funcs_simple.powx_fit_func,      (-2.6, -3.0, 0.4)),
+  (funcs_physics.FermiDirac_fit_func, (1.3, 1.9, 0.05)),
+]
+
+def sample_x():
+  return fit_func_base.domain_array(numpy.linspace(1.55, 3.0, 17))
+
+def sample_params(C0, nsamples=25, seed=1234):
+  rng = numpy.random.RandomState(seed)
+  C0 = numpy.array(C0)
+  return C0 * (1 + 0.02 * rng.normal(size=(nsamples, len(C0))))
+
+
+def test_eval_batch1():
+  """Batched evaluation must agree with the one-by-one evaluation."""
+  print("test_eval_batch1::")
+  x = sample_x()
+  for (cls, C0) in ansatz_samples:
+    func = cls()
+    C = sample_params(C0)
+    y_batch = func.eval_batch(C, x)
+    y_loop = numpy.array([ numpy.ones(x.shape[1]) * func(Ci, x) for Ci in C ])
+    assert func.batch_call
+    assert y_batch.shape == (len(C), x.shape[1])
+    assert numpy.allclose(y_batch, y_loop, rtol=1e-14, atol=0), cls.__name__
+
+
+def test_jacobian1():
+  """Analytic Jacobians must agree with the finite-difference estimates."""
+  print("test_jacobian1::")
+  x = sample_x()
+  for (cls, C0) in ansatz_samples:
+    func = cls()
+    if getattr(func, "jacobian", None) is None:
+      continue
+    J = func.eval_jacobian(C0, x)
+    J_fd = func.eval_jacobian(C0, x, analytic=False)
+    assert J.shape == (x.shape[1], len(C0)), cls.__name__
+    assert numpy.allclose(J, J_fd, rtol=1e-6, atol=1e-7), cls.__name__
+
+
+def test_jacobian_fit1():
+  """Fitting with the analytic Jacobian (opt-in, use_jacobian) gives the
+  same result with fewer function calls."""
+  print("test_jacobian_fit1::")
+  from test_stochastic_fitting import setup_MC_TZ
+  import test_stochastic_fitting
+  setup_MC_TZ()
+  D = test_stochastic_fitting.Cr2_TZ_data_20140728uhf
+  x, y, dy = fit_func_base.domain_array(D[:,0]), D[:,1], D[:,2]
+  rslt = {}
+  for use_jac in (False, True):
+    func = funcs_pec.morse2_fit_func()
+    func.use_jacobian = use_jac
+    func.fit(x, y, dy)
+    rslt[use_jac] = func.last_fit
+  print("  funcalls %d (finite diff) -> %d (analytic), njev = %d" \
+        % (rslt[False]['funcalls'], rslt[True]['funcalls'], rslt[True]['njev']))
+  # Both must agree well within the fit uncertainties
+  assert numpy.all(abs(rslt[True]['xopt'] - rslt[False]['xopt'])
+                   < 0.01 * rslt[False]['xerr'])
+  assert rslt[True]['funcalls'] < rslt[False]['funcalls']
+
+
+def test_fit_batch1():
+  """The batched fitting engine, with analytic or finite-difference
+  Jacobians, must agree with the one-by-one fits."""
+  print("test_fit_batch1::")
+  from wpylib.math.fitting.batch import fit_batch
+  class morse2_nojac(funcs_pec.morse2_fit_func):
+    jacobian = None
+  C0 = (-2.18, 9.8, 1.80, 1.86)
+  x = sample_x()
+  dy = 0.02 * numpy.ones(x.shape[1])
+  rng = numpy.random.RandomState(4321)
+  Y = funcs_pec.morse2_fit_func()(C0, x) + dy * rng.normal(size=(12, x.shape[1]))
+  for cls in (funcs_pec.morse2_fit_func, morse2_nojac):
+    func = cls()
+    rslt = fit_batch(func, x, Y, dy=dy, Guess=C0)
+    assert rslt['xopt'].shape == (12, 4)
+    assert numpy.all(rslt['converged'])
+    for (y1, xopt1, xerr1) in zip(Y, rslt['xopt'], rslt['xerr']):
+      xopt_ref = funcs_pec.morse2_fit_func().fit(x, y1, dy, Guess=C0)
+      assert numpy.all(abs(xopt1 - xopt_ref) < 0.01 * xerr1), cls.__name__
+
+
+def test_poly_linear_fit1():
+  """Design-matrix evaluation and the closed-form linear fit of the
+  polynomial ansatzes."""
+  print("test_poly_linear_fit1::")
+  from wpylib.math.fitting import fit_func
+  from wpylib.math.fitting import funcs_poly
+  rng = numpy.random.RandomState(2718)
+  ndim = 3
+  x = rng.uniform(-1, 1, size=(ndim, 40))
+  # reference formulas (the original, loop-based implementations):
+  def ref_order2(C, x):
+    return C[0] + sum([ C[i*2+1] * x[i] + C[i*2+2] * x[i]**2 for i in xrange(len(x)) ])
+  def ref_order2_only(C, x):
+    return C[0] + sum([ C[i+1] * x[i]**2 for i in xrange(len(x)) ])
+  def ref_order2x_only(C, x):
+    Cmat = numpy.diag(C[1:ndim+1])
+    j = ndim+1
+    for r in xrange(0, ndim-1):
+      jnew = j + ndim - 1 - r
+      Cmat[r, r+1:] = C[j:jnew]
+      Cmat[r+1:, r] = C[j:jnew]
+      j = jnew
+    return numpy.array([ C[0] + numpy.sum(Cmat * numpy.outer(x[:,r], x[:,r]))
+                         for r in xrange(x.shape[1]) ])
+
+  for (cls, ref) in ((funcs_poly.Poly_order2, ref_order2),
+                     (funcs_poly.Poly_order2_only, ref_order2_only),
+                     (funcs_poly.Poly_order2x_only, ref_order2x_only)):
+    func = cls(ndim=ndim)
+    nparams = func.NParams()
+    C0 = rng.normal(size=nparams)
+    assert func.design_matrix(x).shape == (x.shape[1], nparams)
+    assert numpy.allclose(func(C0, x), ref(C0, x), rtol=1e-13, atol=1e-13), cls.__name__
+
+    dy = 0.05 * (1 + rng.uniform(size=x.shape[1]))
+    Y = func(C0, x) + dy * rng.normal(size=(5, x.shape[1]))
+    rec = func.linear_fit(x, Y, dy=dy)
+    assert rec['xopt'].shape == (5, nparams)
+    assert rec['cov'].shape == (5, nparams, nparams)
+    for k in xrange(len(Y)):
+      rec1 = func.linear_fit(x, Y[k], dy=dy, method='lstsq')
+      assert numpy.allclose(rec1['xopt'], rec['xopt'][k], rtol=1e-10, atol=1e-12)
+      assert numpy.allclose(rec1['xerr'], rec['xerr'][k], rtol=1e-8)
+      # the nonlinear machinery must reach the same minimum:
+      rec2 = fit_func(func, x=x, y=Y[k], dy=dy, Guess=func.Guess(Y[k]),
+                      Jacobian=func.jacobian, outfmt=0)
+      assert numpy.allclose(rec2['xopt'], rec['xopt'][k], rtol=1e-6, atol=1e-8)
+      assert numpy.allclose(rec2['xerr'], rec['xerr'][k], rtol=1e-5)
+
+
+def test_varpro_fit1():
+  """Variable-projection fits must reach the same minimum as the plain
+  nonlinear fits, with fewer function calls."""
+  print("test_varpro_fit1::")
+  from test_stochastic_fitting import setup_MC_TZ
+  import test_stochastic_fitting
+  setup_MC_TZ()
+  D = test_stochastic_fitting.Cr2_TZ_data_20140728uhf
+  x, y, dy = fit_func_base.domain_array(D[:,0]), D[:,1], D[:,2]
+  for cls in (funcs_pec.harm_fit_func, funcs_pec.harmcube_fit_func,
+              funcs_pec.morse2_fit_func, funcs_pec.ext3Bmorse2_fit_func):
+    rslt = {}
+    for use_varpro in (False, True):
+      func = cls()
+      func.use_varpro = use_varpro
+      func.fit(x, y, dy)
+      rslt[use_varpro] = func.last_fit
+    print("  %-22s funcalls %4d (plain) -> %4d (varpro)" \
+          % (cls.__name__, rslt[False]['funcalls'], rslt[True]['funcalls']))
+    assert rslt[True]['funcalls'] < rslt[False]['funcalls'], cls.__name__
+    assert rslt[True]['chi_square'] <= rslt[False]['chi_square'] * (1 + 1e-8)
+    assert numpy.all(abs(rslt[True]['xopt'] - rslt[False]['xopt'])
+                     < 0.01 * rslt[False]['xerr']), cls.__name__
+    assert numpy.allclose(rslt[True]['xerr'], rslt[False]['xerr'], rtol=0.02)
+
+
+def test_residual_engine1():
+  """The preallocated residual engine must reproduce the plain
+  evaluations exactly."""
+  print("test_residual_engine1::")
+  from wpylib.math.fitting import fit_func
+  from wpylib.math.fitting.residual import residual_engine
+  x = sample_x()
+  npts = x.shape[1]
+  for (cls, C0) in ansatz_samples:
+    func = cls()
+    y = numpy.ones(npts) * func(C0, x) * 1.001 + 0.01
+    sqrtw = numpy.linspace(1.0, 2.0, npts)
+    R = residual_engine(func, x, y, sqrtw)
+    r_ref = (numpy.ones(npts) * func(C0, x) - y) * sqrtw
+    assert R.wssr(C0) == numpy.sum(abs(r_ref)**2), cls.__name__
+
+  # Identical fits with the engine and with the classic WSSR function
+  # (which is still used when a Funct_hook is given):
+  func = funcs_pec.morse2_fit_func()
+  C0 = (-2.18, 9.8, 1.80, 1.86)
+  y = func(C0, x) + 0.002 * numpy.random.RandomState(5).normal(size=npts)
+  dy = 0.002 * numpy.ones(npts)
+  hook = lambda C, xx, yy, f, r: None
+  for method in ('fmin', 'bfgs'):
+    rec1 = fit_func(func, x=x, y=y, dy=dy, method=method, outfmt=0)
+    rec2 = fit_func(func, x=x, y=y, dy=dy, method=method, outfmt=0,
+                    Funct_hook=hook)
+    assert numpy.all(rec1['xopt'] == rec2['xopt']), method
+    assert rec1['chi_square'] == rec2['chi_square'], method
+
+
+def bench_residual_eval(num_iter=20000):
+  """Timing of a single WSSR evaluation: classic vs preallocated."""
+  import time
+  from wpylib.math.fitting.residual import residual_engine
+  x = sample_x()
+  npts = x.shape[1]
+  for (cls, C0) in ansatz_samples[:4]:
+    func = cls()
+    y = func(C0, x) * 1.001
+    sqrtw = numpy.linspace(1.0, 2.0, npts)
+    R = residual_engine(func, x, y, sqrtw)
+    C0 = numpy.array(C0)
+    def classic2(C):
+      return numpy.sum(abs((func(C, x) - y) * sqrtw)**2)
+    timings = []
+    for f in (classic2, R.wssr):
+      t1 = time.time()
+      for i in xrange(num_iter):
+        f(C0)
+      timings.append((time.time() - t1) / num_iter * 1e6)
+    print("%-22s wssr: %6.2f -> %6.2f usec" \
+          % ((cls.__name__,) + tuple(timings)))
+
+
+def test_get_params_lmfit1():
+  """Parameter unpacking, and lmfit fits (where the ansatz receives the
+  parameters as a flat vector)."""
+  print("test_get_params_lmfit1::")
+  from wpylib.math.fitting import HAS_LMFIT, lmfit_params_vector
+  func = funcs_pec.morse2_fit_func()
+  C0 = (-2.18, 9.8, 1.80, 1.86)
+  assert func.get_params(numpy.array(C0), *func.param_names) == C0
+  assert func.get_params(list(C0), *func.param_names) == C0
+  if not HAS_LMFIT:
+    return
+  import lmfit
+  P = lmfit.Parameters()
+  for (k, v) in reversed(zip(func.param_names, C0)):
+    P.add(k, value=v)
+  assert func.get_params(P, *func.param_names) == C0
+  assert numpy.all(lmfit_params_vector(P, func.param_names) == C0)
+
+  x = sample_x()
+  y = func(C0, x) + 0.002 * numpy.random.RandomState(5).normal(size=x.shape[1])
+  dy = 0.002 * numpy.ones(x.shape[1])
+  func.fit(x, y, dy)
+  ref = func.last_fit
+  func = funcs_pec.morse2_fit_func()
+  func.fit_method = 'lmfit:leastsq'
+  func.instrument_mode = 'trace'
+  func.fit(x, y, dy)
+  rec = func.last_fit
+  assert numpy.all(abs(numpy.array(rec['xopt']) - ref['xopt']) < 1e-3 * ref['xerr'])
+  assert numpy.allclose(rec['xerr'], ref['xerr'], rtol=1e-3)
+  # (the last evaluation is the final chi-square at xopt)
+  assert all([ type(C) is numpy.ndarray
+               for C in list(func.instrument.params_log)[:-1] ])
+
+
+def bench_get_params(num_iter=100000):
+  """Per-call overhead of get_params, relative to a function evaluation."""
+  import time
+  import lmfit
+  def get_params_old(C, *names):
+    try:
+      from lmfit import Parameters
+      if isinstance(C, Parameters):
+        return tuple(C[k].value for k in names)
+    except:
+      pass
+    return tuple(C)
+  func = funcs_pec.morse2_fit_func()
+  names = func.param_names
+  C0 = numpy.array((-2.18, 9.8, 1.80, 1.86))
+  x = sample_x()
+  for (label, f) in (("get_params (old)", lambda: get_params_old(C0, *names)),
+                     ("get_params", lambda: func.get_params(C0, *names)),
+                     ("morse2 call", lambda: func(C0, x))):
+    t1 = time.time()
+    for i in xrange(num_iter):
+      f()
+    print("%-18s %6.3f usec" % (label, (time.time() - t1) / num_iter * 1e6))
+
+
+def test_least_squares_fit1():
+  """least_squares method: agreement with leastsq, and bounds."""
+  print("test_least_squares_fit1::")
+  C0 = (-2.18, 9.8, 1.80, 1.86)
+  x = sample_x()
+  func = funcs_pec.morse2_fit_func()
+  y = func(C0, x) + 0.002 * numpy.random.RandomState(5).normal(size=x.shape[1])
+  dy = 0.002 * numpy.ones(x.shape[1])
+  func.fit(x, y, dy)
+  ref = func.last_fit
+
+  func = funcs_pec.morse2_fit_func()
+  func.fit_method = 'least_squares'
+  func.fit(x, y, dy)
+  rec = func.last_fit
+  assert rec['fit_method'] == 'least_squares'
+  assert rec['ier'] > 0
+  assert numpy.all(abs(rec['xopt'] - ref['xopt']) < 1e-3 * ref['xerr'])
+  # (the finite-difference Jacobians differ a little)
+  assert numpy.allclose(rec['xerr'], ref['xerr'], rtol=1e-2)
+  assert numpy.allclose(rec['chi_square'], ref['chi_square'], rtol=1e-8)
+
+  # Force the equilibrium distance below its optimum:
+  func.param_bounds = ((-numpy.inf, 0, 0, 0), (numpy.inf, numpy.inf, 1.79, numpy.inf))
+  func.fit(x, y, dy)
+  rec = func.last_fit
+  assert abs(rec['xopt'][2] - 1.79) < 1e-8
+  assert list(rec['active_mask']) == [0, 0, 1, 0]
+  assert rec['chi_square'] > ref['chi_square']
+
+
+class blocked_harm_fit_func(fit_func_base):
+  """A "global" fit made of independent harmonic curves:
+  x[0] is the coordinate, x[1] the index of the curve, which has the
+  parameters (E0, k, r0) in C[3*i:3*i+3]."""
+  def __call__(self, C, x):
+    C = numpy.asarray(C).reshape((-1, 3))
+    i = x[1].astype(int)
+    return C[i,0] + 0.5 * C[i,1] * (x[0] - C[i,2])**2
+  def jac_sparsity(self, x):
+    import scipy.sparse
+    i = x[1].astype(int)
+    npts = len(i)
+    rows = numpy.repeat(numpy.arange(npts), 3)
+    cols = (3 * i[:,numpy.newaxis] + numpy.arange(3)).ravel()
+    return scipy.sparse.csr_matrix((numpy.ones(3*npts), (rows, cols)),
+                                   shape=(npts, 3 * (i.max() + 1)))
+
+def blocked_harm_data(ncurves, npts, seed=11):
+  rng = numpy.random.RandomState(seed)
+  r = numpy.linspace(1.6, 2.0, npts)
+  x = numpy.array([ numpy.tile(r, ncurves),
+                    numpy.repeat(numpy.arange(ncurves), npts) ], dtype=float)
+  C = numpy.array([ -2.1, 9.0, 1.8 ]) * (1 + 0.05 * rng.normal(size=(ncurves, 3)))
+  func = blocked_harm_fit_func()
+  dy = 1e-3 * numpy.ones(x.shape[1])
+  y = func(C.ravel(), x) + dy * rng.normal(size=x.shape[1])
+  return (func, x, y, dy, C)
+
+
+def test_least_squares_sparse1():
+  """least_squares method with the Jacobian sparsity declared by the
+  ansatz: must agree with the curve-by-curve fits, at a fraction of the
+  function calls of dense finite differences."""
+  print("test_least_squares_sparse1::")
+  (func, x, y, dy, C) = blocked_harm_data(40, 25)
+  func.fit_method = 'least_squares'
+  Guess = numpy.tile((-2.1, 9.0, 1.8), 40)
+  func.fit(x, y, dy, Guess=Guess)
+  rec = func.last_fit
+  assert rec['xopt'].shape == (120,)
+  # (40 curves share the 3 finite-difference groups)
+  assert rec['funcalls'] < 50
+  xopt = rec['xopt'].reshape((40, 3))
+  xerr = rec['xerr'].reshape((40, 3))
+  for i in (0, 17, 39):
+    sel = slice(25*i, 25*i+25)
+    f1 = blocked_harm_fit_func()
+    f1.fit(x[:,sel] * [[1],[0]], y[sel], dy[sel], Guess=(-2.1, 9.0, 1.8))
+    # (the global chi square is flat in each block; the NDF differ)
+    assert numpy.all(abs(xopt[i] - f1.last_fit['xopt']) < 1e-3 * xerr[i])
+
+
+def bench_least_squares(ncurves=4000, npts=250):
+  """Timing of a global fit with ncurves*npts residuals (10^6 by default)
+  and 3*ncurves parameters, with a sparse Jacobian."""
+  import time
+  (func, x, y, dy, C) = blocked_harm_data(ncurves, npts)
+  func.fit_method = 'least_squares'
+  t1 = time.time()
+  func.fit(x, y, dy, Guess=numpy.tile((-2.1, 9.0, 1.8), ncurves))
+  rec = func.last_fit
+  print("%d residuals, %d params: %.2f sec, %d funcalls, chi2/N = %.4f" \
+        % (len(y), len(rec['xopt']), time.time() - t1, rec['funcalls'],
+           rec['chi_square'] / len(y)))
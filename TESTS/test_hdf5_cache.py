@@ -0,0 +1,61 @@
+# Created: 20261019
+# Test module for wpylib.db.hdf5_cache
+
+import os.path
+import numpy
+from wpylib.file.tmpdir import tmpdir
+from wpylib.db.hdf5_cache import hdf5_memoize, memo_hash
+
+
+def test_memo_hash1():
+  print("test_memo_hash1::")
+  A = numpy.arange(6.0)
+  assert memo_hash(A, 1) == memo_hash(A.copy(), 1)
+  assert memo_hash(A, 1) != memo_hash(A, 1.0)
+  assert memo_hash(A) != memo_hash(A.reshape((2,3)))
+  assert memo_hash(A) != memo_hash(A.astype(numpy.float32))
+  assert memo_hash((1, 2), x=3) != memo_hash([1, 2], x=3)
+  assert memo_hash(dict(a=1, b=2)) == memo_hash(dict(b=2, a=1))
+
+
+def test_hdf5_memoize1():
+  print("test_hdf5_memoize1::")
+  fname = os.path.join(tmpdir(), "test_hdf5_memoize1.h5")
+  ncalls = [0]
+
+  def grid_func(x, scale=1.0):
+    ncalls[0] += 1
+    return (x * scale, numpy.sum(x) * scale, dict(n=len(x), label="grid"))
+
+  f1 = hdf5_memoize(fname, version=1, max_entries=2, name="grid_func")(grid_func)
+  x = numpy.linspace(0, 1, 11)
+  r1 = f1(x, scale=2.0)
+  r2 = f1(x, scale=2.0)
+  assert ncalls[0] == 1
+  assert (f1.hits, f1.misses) == (1, 1)
+  assert numpy.all(r1[0] == r2[0])
+  assert r1[1] == r2[1]
+  assert r2[2] == dict(n=11, label="grid")
+
+  # A new session (new decorator object) still sees the stored value:
+  f2 = hdf5_memoize(fname, version=1, max_entries=2, name="grid_func")(grid_func)
+  f2(x, scale=2.0)
+  assert ncalls[0] == 1 and f2.hits == 1
+
+  # Bounded size: the least recently used entry gets evicted
+  f2(x, scale=3.0)
+  f2(x, scale=4.0)
+  assert len(f2) == 2
+  assert f2.evictions == 1
+
+  # Version change invalidates everything
+  f3 = hdf5_memoize(fname, version=2, name="grid_func")(grid_func)
+  assert len(f3) == 0
+  f3(x, scale=2.0)
+  assert f3.misses == 1
+  print(f3.stats())
+
+
+if __name__ == '__main__':
+  test_memo_hash1()
+  test_hdf5_memoize1()
@@ -17,3 +17,48 @@ def test_with_text_output1():
     print "### closing now"
   system("lsof -p %d | tail" % mypid)
 
+
+
+def test_text_output_background1():
+  """[20261019]
+  Test text_output in background-writer mode: all text must be
+  delivered, in order, upon close()."""
+  import os.path
+  from wpylib.iofmt.text_output import text_output
+  from wpylib.file.tmpdir import tmpdir
+  fname = os.path.join(tmpdir(), "test_text_output_background1.txt")
+  O = text_output(fname, background=dict(queue_size=16, flush_size=256))
+  for i in xrange(1000):
+    O("line %d\n" % i)
+  O.flush()
+  assert len(open(fname).readlines()) == 1000
+  O.write("last line\n")
+  O.close()
+  lines = open(fname).read().splitlines()
+  assert lines == [ "line %d" % i for i in xrange(1000) ] + [ "last line" ]
+
+  # Reopening must keep the background mode:
+  fname2 = os.path.join(tmpdir(), "test_text_output_background1b.txt")
+  O.open(fname2)
+  assert O._bg is not None
+  for i in xrange(100):
+    O("line %d\n" % i)
+  O.close()
+  assert O._bg is None
+  lines = open(fname2).read().splitlines()
+  assert lines == [ "line %d" % i for i in xrange(100) ]
+
+  # A bad item must not kill the writer thread; its error is reported by
+  # the next flush() or close():
+  for end in ('flush', 'close'):
+    O.open(fname2)
+    O("line 0\n")
+    O.write(123)
+    O("line 1\n")
+    try:
+      getattr(O, end)()
+      assert False, "the bad write must be reported by %s()" % end
+    except TypeError, e:
+      print("  %s: %s" % (end, e))
+    O.close()
+    assert open(fname2).read().splitlines() == [ "line 0", "line 1" ]
@@ -0,0 +1,68 @@
+# Created: 20261019
+# Test module for wpylib.math.fitting.linear
+
+import numpy
+from wpylib.math.fitting.linear import linregr2d_SZ, linregr2d_SZ_batch, \
+     linregr2d_accum
+
+rslt_fields = ('a', 'b', 'sigma', 'sigma_a', 'sigma_b')
+
+
+def sample_series(nseries, npts, seed=7):
+  rng = numpy.random.RandomState(seed)
+  x = numpy.linspace(0.0025, 0.01, npts)
+  dy = 0.0004 * (1 + rng.uniform(size=(nseries, npts)))
+  y = -1392.3 - 0.8 * x + dy * rng.normal(size=(nseries, npts))
+  return (x, y, dy)
+
+
+def test_linregr2d_SZ1():
+  print("test_linregr2d_SZ1::")
+  (x, y, dy) = sample_series(1, 5)
+  dy0 = dy[0].copy()
+  r = linregr2d_SZ(x, y[0], dy[0])
+  assert numpy.all(dy[0] == dy0)   # input must not be clobbered
+  # Same as the weighted polynomial fit:
+  (b, a) = numpy.polyfit(x, y[0], 1, w=1/dy[0])
+  assert numpy.allclose((r['a'], r['b']), (a, b), rtol=1e-10)
+  assert numpy.allclose(r['sigma'], r['sigma_a'], rtol=1e-6)
+
+
+def test_linregr2d_batch_accum1():
+  """The batched form and the streaming accumulator must agree with the
+  one-by-one regressions."""
+  print("test_linregr2d_batch_accum1::")
+  (x, y, dy) = sample_series(20, 1000)
+  ref = [ linregr2d_SZ(x, y1, dy1) for (y1, dy1) in zip(y, dy) ]
+
+  R = linregr2d_SZ_batch(x, y, dy)
+  assert R['fit_method'] == 'linregr2d_SZ'
+  for k in rslt_fields:
+    assert R[k].shape == (20,)
+    assert numpy.allclose(R[k], [ r[k] for r in ref ], rtol=1e-9, atol=0), k
+
+  # Streaming, over uneven chunks, with partial accumulators merged:
+  acc = linregr2d_accum()
+  acc2 = linregr2d_accum()
+  for (i, j) in ((0, 100), (100, 133), (133, 600)):
+    acc.add(x[i:j], y[:, i:j], dy[:, i:j])
+  acc2.add(x[600:], y[:, 600:], dy[:, 600:])
+  acc.merge(acc2)
+  assert acc.N == 1000
+  A = acc.result()
+  for k in rslt_fields:
+    # The slope suffers from cancellation (large y offset), so that the
+    # summation order matters at a level far below its error bar:
+    atol = (1e-6 * R['sigma_b']) if k == 'b' else 0
+    assert numpy.all(abs(A[k] - R[k]) <= 1e-9 * abs(R[k]) + atol), k
+
+  # Single-series accumulation:
+  acc = linregr2d_accum()
+  for i in xrange(0, 1000, 64):
+    acc.add(x[i:i+64], y[3, i:i+64], dy[3, i:i+64])
+  assert abs(acc.result()['b'] - ref[3]['b']) <= 1e-6 * ref[3]['sigma_b']
+
+
+if __name__ == '__main__':
+  test_linregr2d_SZ1()
+  test_linregr2d_batch_accum1()
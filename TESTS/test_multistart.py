@@ -0,0 +1,89 @@
+# Created: 20261019
+# Test module for wpylib.math.fitting.multistart
+
+import numpy
+from wpylib.math.fitting import fit_func_base
+from wpylib.math.fitting import funcs_pec
+from wpylib.math.fitting.multistart import multistart_guesses
+
+
+def test_multistart_guesses1():
+  print("test_multistart_guesses1::")
+  G0 = (-2.0, 10.0, 1.8, 0.0)
+  G = multistart_guesses(G0, 9, spread=0.5, rng=numpy.random.RandomState(3))
+  assert G.shape == (9, 4)
+  assert numpy.all(G[0] == G0)
+  # Latin hypercube: one sample in each of the 8 strata of every parameter
+  U = (G[1:] - G0) / (0.5 * numpy.array([2.0, 10.0, 1.8, 1.0])) * 0.5 + 0.5
+  assert numpy.all(numpy.sort(numpy.floor(U * 8), axis=0)
+                   == numpy.arange(8)[:,numpy.newaxis])
+  G = multistart_guesses(G0, 5, method='random', bounds=([-3, 5, 1, -1], [-1, 15, 3, 1]),
+                         rng=numpy.random.RandomState(3))
+  assert numpy.all((G[1:] >= [-3, 5, 1, -1]) & (G[1:] <= [-1, 15, 3, 1]))
+  try:
+    multistart_guesses(G0, 5, bounds=((-numpy.inf, 0, 0, 0), numpy.inf))
+    assert False, "infinite bounds must be refused"
+  except ValueError, e:
+    print("  refused: %s" % e)
+
+
+def test_fit_multistart1():
+  """Multi-start fit of the fragile ext3Bmorse2 ansatz."""
+  print("test_fit_multistart1::")
+  from test_stochastic_fitting import setup_MC_TZ
+  import test_stochastic_fitting
+  setup_MC_TZ()
+  D = test_stochastic_fitting.Cr2_TZ_data_20140728uhf
+  x, y, dy = fit_func_base.domain_array(D[:,0]), D[:,1], D[:,2]
+
+  func = funcs_pec.ext3Bmorse2_fit_func()
+  func.fit(x, y, dy)
+  chi2_plain = func.last_fit['chi_square']
+
+  xopt = func.fit_multistart(x, y, dy, nstarts=16, seed=1)
+  S = func.last_fit['multistart']
+  print(S)
+  assert func.last_fit['chi_square'] <= chi2_plain
+  assert numpy.all(func.last_fit['xopt'] == xopt)
+  assert S['chi_square'][S['best_index']] == func.last_fit['chi_square']
+  assert S['early_stop'] and S['nfits'] < 16 and S['n_agree'] >= 3
+  assert S['xopt'].shape == (S['nfits'], 5)
+
+  # The outcome does not depend on the number of processes:
+  xopt2 = func.fit_multistart(x, y, dy, nstarts=16, seed=1, nproc=2)
+  assert numpy.all(xopt2 == xopt)
+  assert numpy.all(func.last_fit['multistart']['chi_square'] == S['chi_square'])
+
+  func.fit_multistart(x, y, dy, nstarts=6, seed=1, agree=None)
+  assert func.last_fit['multistart']['nfits'] == 6
+
+
+def test_fit_multistart_lmfit1():
+  """Multi-start fit starting from the lmfit Params of the ansatz."""
+  print("test_fit_multistart_lmfit1::")
+  from wpylib.math.fitting import HAS_LMFIT, lmfit_params_vector
+  if not HAS_LMFIT:
+    return
+  import lmfit
+  func = funcs_pec.morse2_fit_func()
+  C0 = (-2.18, 9.8, 1.80, 1.86)
+  x = fit_func_base.domain_array(numpy.linspace(1.55, 3.0, 13))
+  dy = 0.02 * numpy.ones(x.shape[1])
+  y = func(C0, x) + dy * numpy.random.RandomState(11).normal(size=x.shape[1])
+  func.fit_method = 'lmfit:leastsq'
+  func.Params = lmfit.Parameters()
+  P0 = (-2.0, 9.0, 1.7, 1.5)
+  for (k, v) in zip(func.param_names, P0):
+    func.Params.add(k, value=v)
+  func.fit_multistart(x, y, dy, nstarts=4, seed=1, agree=None)
+  S = func.last_fit['multistart']
+  assert numpy.all(S['guesses'][0] == P0)
+  # the user's Params are not clobbered by the starts:
+  assert numpy.all(lmfit_params_vector(func.Params, func.param_names) == P0)
+  assert abs(func.last_fit['xopt'][2] - C0[2]) < 0.05
+
+
+if __name__ == '__main__':
+  test_multistart_guesses1()
+  test_fit_multistart1()
+  test_fit_multistart_lmfit1()
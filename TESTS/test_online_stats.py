@@ -0,0 +1,75 @@
+# Created: 20261019
+# Test module for wpylib.math.stats.online_stats
+
+import numpy
+from wpylib.math.stats.online_stats import online_stats, reservoir_sample
+
+
+def test_online_stats1():
+  print("test_online_stats1::")
+  rng = numpy.random.RandomState(9876)
+  X = rng.gamma(2.0, size=(1000, 3)) * [1.0, 10.0, 1e-3] + [5.0, -2.0, 1e3]
+  S = online_stats()
+  for x in X:
+    S.add(x)
+  D = X - X.mean(axis=0)
+  assert S.N == 1000
+  assert numpy.allclose(S.mean(), X.mean(axis=0), rtol=1e-13)
+  assert numpy.allclose(S.std(), X.std(axis=0), rtol=1e-10)
+  assert numpy.allclose(S.std(1), X.std(axis=0, ddof=1), rtol=1e-10)
+  assert numpy.allclose(S.M3, numpy.sum(D**3, axis=0), rtol=1e-8)
+  assert numpy.allclose(S.M4, numpy.sum(D**4, axis=0), rtol=1e-8)
+
+  # batched additions and merging give the same result
+  S2 = online_stats().add_batch(X[:300])
+  S3 = online_stats().add_batch(X[300:])
+  S2.merge(S3)
+  for attr in ('M1', 'M2', 'M3', 'M4'):
+    assert numpy.allclose(getattr(S2, attr), getattr(S, attr), rtol=1e-8), attr
+
+
+def test_online_stats_std_err1():
+  """The standard error of the standard deviation, compared to its known
+  value for normal samples and to the spread over many repeats."""
+  print("test_online_stats_std_err1::")
+  rng = numpy.random.RandomState(1357)
+  N = 200
+  X = rng.normal(size=(N, 500)) * 3.0
+  S = online_stats().add_batch(X)
+  assert numpy.allclose(numpy.mean(S.std_rel_err()), 1 / numpy.sqrt(2 * (N - 1)),
+                        rtol=0.05)
+  # the actual spread of the std estimates among the 500 columns:
+  assert numpy.allclose(numpy.std(S.std(1)), numpy.mean(S.std_err()), rtol=0.1)
+
+
+def test_online_stats_cov1():
+  print("test_online_stats_cov1::")
+  rng = numpy.random.RandomState(2468)
+  X = numpy.dot(rng.normal(size=(500, 3)), [[1.0, 0.5, 0.0], [0, 2.0, -1.0], [0, 0, 0.1]]) + 1e3
+  S = online_stats(track_cov=True)
+  for x in X:
+    S.add(x)
+  assert numpy.allclose(S.cov(), numpy.cov(X.T, ddof=0), rtol=1e-10)
+  assert numpy.allclose(numpy.diagonal(S.cov(1)), S.var(1), rtol=1e-12)
+  S2 = online_stats(track_cov=True).add_batch(X[:123]).merge(
+         online_stats(track_cov=True).add_batch(X[123:]))
+  assert numpy.allclose(S2.cov(1), numpy.cov(X.T), rtol=1e-10)
+
+
+def test_reservoir_sample1():
+  """Every item has the same chance to end up in the reservoir."""
+  print("test_reservoir_sample1::")
+  rng = numpy.random.RandomState(11)
+  counts = numpy.zeros(50)
+  for r in xrange(2000):
+    R = reservoir_sample(10, rng=rng)
+    for i in xrange(50):
+      R.add(i)
+    S = R.sample()
+    assert R.N == 50 and len(set(S)) == 10
+    counts[S] += 1
+  # expected: 2000 * 10/50 = 400 +/- 18
+  assert numpy.all(abs(counts - 400) < 5 * 18)
+  R = reservoir_sample(10)
+  R.add([1.0, 2.0])
+  assert R.sample().shape == (1, 2)
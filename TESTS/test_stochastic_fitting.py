@@ -143,5 +143,458 @@ def test_fit_PEC_MC_TZ(show_samples=True, save_fig=False, rng=None, num_iter=200
   print("All testings passed.")
 
 
+def test_fit_PEC_MC_TZ_parallel(num_iter=40, nproc=3):
+  """20261019
+  The parallel MC loop with per-toss random number streams must give
+  results identical to those of the serial loop with the same seed.
+  """
+  from wpylib.math.fitting.funcs_pec import morse2_fit_func
+
+  print("test_fit_PEC_MC_TZ_parallel::")
+  setup_MC_TZ()
+  rawdata = Cr2_TZ_data_20140728uhf
+
+  def run_mcfit(nproc, direct_rng=False):
+    sfit = StochasticFitting()
+    sfit.opt_rng_streams = True
+    sfit.init_func(morse2_fit_func())
+    sfit.init_samples(x=rawdata[:,0], y=rawdata[:,1], dy=rawdata[:,2])
+    if direct_rng:
+      # rng assigned by hand, without init_rng (hence no rng_class)
+      sfit.rng = numpy.random.RandomState(378711)
+      sfit.rng_seed = 378711
+    else:
+      sfit.init_rng(seed=378711)
+    sfit.mcfit_loop_begin_()
+    # two loop calls: the toss indices must continue across calls
+    sfit.mcfit_loop1_(num_iter=num_iter // 2, nproc=nproc)
+    sfit.mcfit_loop1_(num_iter=num_iter - num_iter // 2, nproc=nproc)
+    sfit.mcfit_loop_end_()
+    return sfit
+
+  sfit_serial = run_mcfit(None)
+  sfit_par = run_mcfit(nproc)
+  assert len(sfit_par.mc_params) == num_iter
+  assert numpy.all(sfit_serial.mc_params == sfit_par.mc_params)
+  assert numpy.all(sfit_serial.mc_stats == sfit_par.mc_stats)
+  assert sfit_serial.log_mc_funcalls == sfit_par.log_mc_funcalls
+  assert numpy.all(sfit_serial.dice_y == sfit_par.dice_y)
+
+  sfit_direct = run_mcfit(nproc, direct_rng=True)
+  assert numpy.all(sfit_direct.mc_params == sfit_serial.mc_params)
+  sfit = StochasticFitting()
+  sfit.rng = numpy.random.RandomState(378711)
+  try:
+    sfit.mcfit_rng_stream_(0)
+    assert False, "rng streams without rng_seed must be refused"
+  except RuntimeError, e:
+    print("  refused: %s" % e)
+  print("All testings passed.")
+
+
+def test_fit_PEC_MC_TZ_parallel_warm(num_iter=36, nproc=3):
+  """20261019
+  With the warm start, the parallel MC loop must still give results
+  identical to those of the serial loop, both when the warm start is kept
+  and when it is abandoned after the pilot tosses.
+  """
+  from wpylib.math.fitting.funcs_pec import morse2_fit_func, ext3Bmorse2_fit_func
+
+  print("test_fit_PEC_MC_TZ_parallel_warm::")
+  setup_MC_TZ()
+  rawdata = Cr2_TZ_data_20140728uhf
+
+  def run_mcfit(func_class, nproc):
+    sfit = StochasticFitting()
+    sfit.opt_rng_streams = True
+    sfit.opt_warm_start = True
+    sfit.init_func(func_class())
+    sfit.init_samples(x=rawdata[:,0], y=rawdata[:,1], dy=rawdata[:,2])
+    sfit.init_rng(seed=378711)
+    sfit.mcfit_loop_begin_()
+    # the first loop call ends within the pilot tosses
+    sfit.mcfit_loop1_(num_iter=7, nproc=nproc)
+    sfit.mcfit_loop1_(num_iter=num_iter - 7, nproc=nproc)
+    sfit.mcfit_loop_end_()
+    return sfit
+
+  for func_class in (morse2_fit_func, ext3Bmorse2_fit_func):
+    sfit_serial = run_mcfit(func_class, None)
+    sfit_par = run_mcfit(func_class, nproc)
+    assert len(sfit_par.mc_params) == num_iter
+    assert numpy.all(sfit_serial.mc_params == sfit_par.mc_params)
+    assert sfit_serial.log_mc_funcalls == sfit_par.log_mc_funcalls
+    assert sfit_serial.mcfit_warm_fallbacks == sfit_par.mcfit_warm_fallbacks
+    assert sfit_serial.warm_disabled == sfit_par.warm_disabled \
+           == (func_class is ext3Bmorse2_fit_func)
+  print("All testings passed.")
+
+
+def run_mcfit_TZ(num_iter, seed=378711, sfit=None, **loop_opts):
+  from wpylib.math.fitting.funcs_pec import morse2_fit_func
+  setup_MC_TZ()
+  rawdata = Cr2_TZ_data_20140728uhf
+  if sfit is None:
+    sfit = StochasticFitting()
+  sfit.init_func(morse2_fit_func())
+  sfit.init_samples(x=rawdata[:,0], y=rawdata[:,1], dy=rawdata[:,2])
+  sfit.init_rng(seed=seed)
+  sfit.mcfit_loop_begin_()
+  sfit.mcfit_loop1_(num_iter=num_iter, **loop_opts)
+  sfit.mcfit_loop_end_()
+  sfit.mcfit_analysis_()
+  return sfit
+
+
+def test_fit_PEC_MC_TZ_batch(num_iter=60, batch_size=16):
+  """20261019
+  The batched MC loop must toss the same dice and give the same fit
+  parameters (to within the fit tolerance) as the serial loop.
+  """
+  print("test_fit_PEC_MC_TZ_batch::")
+  sfit_serial = run_mcfit_TZ(num_iter)
+  sfit_batch = run_mcfit_TZ(num_iter, batch_size=batch_size)
+  assert len(sfit_batch.mc_params) == num_iter
+  assert numpy.all(sfit_serial.dice_y == sfit_batch.dice_y)
+  for F in sfit_serial.fit_parameters:
+    err = sfit_serial.final_mc_params[F].err
+    assert numpy.allclose(sfit_batch.mc_params[F], sfit_serial.mc_params[F],
+                          rtol=0, atol=0.01 * err), F
+  # The batched LM iterates to a tighter minimum than MINPACK with
+  # finite-difference derivatives:
+  assert numpy.all(sfit_batch.mc_stats['dice_wssr']
+                   <= sfit_serial.mc_stats['dice_wssr'] * (1 + 1e-8))
+  assert sfit_batch.mcfit_batch_refits == 0
+
+  # Too few batched iterations: the unconverged fits must be redone
+  sfit = StochasticFitting()
+  sfit.opt_batch_maxiter = 6
+  sfit = run_mcfit_TZ(num_iter, sfit=sfit, batch_size=batch_size)
+  assert 0 < sfit.mcfit_batch_refits < num_iter
+  for F in sfit_serial.fit_parameters:
+    err = sfit_serial.final_mc_params[F].err
+    assert numpy.allclose(sfit.mc_params[F], sfit_serial.mc_params[F],
+                          rtol=0, atol=0.01 * err), F
+  print("All testings passed.")
+
+
+def test_fit_PEC_MC_TZ_adaptive(rel_prec=0.1):
+  """20261019
+  Adaptive stopping of the MC loop, once the error bars have converged
+  to the given relative precision.
+  """
+  from wpylib.math.fitting.funcs_pec import morse2_fit_func
+  print("test_fit_PEC_MC_TZ_adaptive::")
+  setup_MC_TZ()
+  rawdata = Cr2_TZ_data_20140728uhf
+  sfit = StochasticFitting()
+  sfit.opt_report_final_params = 2
+  rslt = sfit.mcfit_run1(x=rawdata[:,0], y=rawdata[:,1], dy=rawdata[:,2],
+                         func=morse2_fit_func(), rng_params=dict(seed=378711),
+                         rel_prec=rel_prec, min_iter=20, max_iter=1000,
+                         check_interval=10, batch_size=10)
+  num_iter = len(sfit.mc_params)
+  print("Converged after %d iterations" % num_iter)
+  assert sfit.mcfit_converged
+  assert 20 <= num_iter < 1000 and num_iter % 10 == 0
+  # Roughly 1/(2*rel_prec**2) fits are needed:
+  assert num_iter < 4 / (2 * rel_prec**2)
+  for (i,F) in enumerate(sfit.fit_parameters):
+    assert sfit.final_mc_err_relerr[F] <= rel_prec
+    assert numpy.allclose(sfit.mc_online_stats.mean()[i], rslt[F].val, rtol=1e-12)
+    assert numpy.allclose(sfit.mc_online_stats.std()[i], rslt[F].err, rtol=1e-10)
+  print("All testings passed.")
+
+
+def test_fit_PEC_MC_TZ_warm_start(num_iter=60):
+  """20261019
+  Warm-started MC fits must give the same results with fewer function
+  calls; for a model too nonlinear for the predictor (ext3Bmorse2),
+  the cold start must take over.
+  """
+  from wpylib.math.fitting.funcs_pec import morse2_fit_func, ext3Bmorse2_fit_func
+  print("test_fit_PEC_MC_TZ_warm_start::")
+  setup_MC_TZ()
+  rawdata = Cr2_TZ_data_20140728uhf
+  for (func_class, warm_ok) in ((morse2_fit_func, True), (ext3Bmorse2_fit_func, False)):
+    sfits = []
+    for warm_start in (False, True):
+      sfit = StochasticFitting()
+      sfit.opt_report_final_params = 0
+      sfit.opt_warm_start = warm_start
+      sfit.mcfit_run1(x=rawdata[:,0], y=rawdata[:,1], dy=rawdata[:,2],
+                      func=func_class(), rng_params=dict(seed=378711),
+                      num_iter=num_iter)
+      sfits.append(sfit)
+    (cold, warm) = sfits
+    print("  %s: funcalls/toss %.2f (cold) -> %.2f (warm), %d fallbacks" \
+          % (func_class.__name__, numpy.mean(cold.log_mc_funcalls),
+             numpy.mean(warm.log_mc_funcalls), warm.mcfit_warm_fallbacks))
+    for F in cold.fit_parameters:
+      err = cold.final_mc_params[F].err
+      assert numpy.allclose(warm.mc_params[F], cold.mc_params[F], rtol=0, atol=0.01 * err), F
+    if warm_ok:
+      assert warm.mcfit_warm_fallbacks == 0
+      assert numpy.mean(warm.log_mc_funcalls) < numpy.mean(cold.log_mc_funcalls)
+    else:
+      assert warm.warm_disabled
+      assert warm.mcfit_warm_fallbacks == warm.opt_warm_check_count // 2 + 1
+
+
+def test_fit_PEC_MC_TZ_lincov(num_iter=300):
+  """20261019
+  Linearized covariance error mode vs. MC resampling, and the automatic
+  choice between the two.
+  """
+  from wpylib.math.fitting.funcs_pec import harmcube_fit_func, ext3Bmorse2_fit_func
+  print("test_fit_PEC_MC_TZ_lincov::")
+  setup_MC_TZ()
+  rawdata = Cr2_TZ_data_20140728uhf
+  def run(func_class, error_mode):
+    sfit = StochasticFitting()
+    sfit.opt_report_final_params = 0
+    sfit.mcfit_run1(x=rawdata[:,0], y=rawdata[:,1], dy=rawdata[:,2],
+                    func=func_class(), rng_params=dict(seed=378711),
+                    num_iter=num_iter, error_mode=error_mode)
+    return sfit
+
+  # harmcube is nearly linear: both modes must agree
+  sfit_mc = run(harmcube_fit_func, 'mc')
+  sfit_lin = run(harmcube_fit_func, 'lincov')
+  assert sfit_lin.error_mode_used == 'lincov'
+  assert not hasattr(sfit_lin, "mc_params")
+  for F in sfit_mc.fit_parameters:
+    (p_mc, p_lin) = (sfit_mc.final_mc_params[F], sfit_lin.final_mc_params[F])
+    assert abs(p_mc.val - p_lin.val) < 0.2 * p_mc.err, F
+    assert abs(p_lin.err / p_mc.err - 1) < 0.15, F
+  x = numpy.linspace(1.6, 2.8, 7)
+  (curve_mc, curve_lin) = (sfit_mc.mcfit_eval(x), sfit_lin.mcfit_eval(x))
+  assert numpy.all(abs(curve_lin['val'] - curve_mc['val']) < 0.2 * curve_mc['err'])
+  assert numpy.allclose(curve_lin['err'], curve_mc['err'], rtol=0.15)
+
+  sfit_auto = run(harmcube_fit_func, 'auto')
+  assert sfit_auto.error_mode_used == 'lincov'
+  assert len(sfit_auto.mc_params) == sfit_auto.opt_lincov_pilot_iter
+  assert all([ d['ok'] for d in sfit_auto.lincov_diagnostic.values() ])
+  # a vanishing linearized error bar fails the check, without dividing by 0
+  sfit_auto.lincov_params_cov[0,:] = sfit_auto.lincov_params_cov[:,0] = 0
+  with numpy.errstate(all='raise'):
+    assert not sfit_auto.lincov_check_()
+  d = sfit_auto.lincov_diagnostic[sfit_auto.lincov_param_names[0]]
+  assert d['mean_shift'] == d['err_ratio'] == numpy.inf
+
+  # ext3Bmorse2 is strongly nonlinear in a and C3: auto must use MC
+  sfit_auto = run(ext3Bmorse2_fit_func, 'auto')
+  assert sfit_auto.error_mode_used == 'mc'
+  assert len(sfit_auto.mc_params) == num_iter
+  assert not sfit_auto.lincov_diagnostic['C3']['ok']
+  print("All testings passed.")
+
+
+class killed_run(Exception):
+  pass
+
+class StochasticFitting_killed(StochasticFitting):
+  """Dies after kill_at dice tosses have been recorded."""
+  kill_at = None
+  def mcfit_step1_record_(self, rec):
+    StochasticFitting.mcfit_step1_record_(self, rec)
+    if self.mc_online_stats.N == self.kill_at:
+      raise killed_run
+
+
+def test_fit_PEC_MC_TZ_checkpoint(num_iter=50, tmpdir="/tmp"):
+  """20261019
+  A run killed and resumed from its checkpoint file must give results
+  bit-identical to those of an uninterrupted run.
+  """
+  import os
+  import h5py
+  from wpylib.iofmt.hdf5 import hdf5_write_obj
+  from wpylib.math.fitting.funcs_pec import morse2_fit_func
+  print("test_fit_PEC_MC_TZ_checkpoint::")
+  setup_MC_TZ()
+  rawdata = Cr2_TZ_data_20140728uhf
+  ckpt_file = os.path.join(tmpdir, "test_mcfit_checkpoint-%d.h5" % os.getpid())
+
+  def run(sfit_class, kill_at=None, resume=False, attrs={}, **opts):
+    sfit = sfit_class()
+    sfit.opt_report_final_params = 0
+    sfit.opt_warm_start = True
+    sfit.opt_checkpoint_file = ckpt_file
+    sfit.opt_checkpoint_interval = 8
+    sfit.__dict__.update(attrs)
+    sfit.kill_at = kill_at
+    try:
+      sfit.mcfit_run1(x=rawdata[:,0], y=rawdata[:,1], dy=rawdata[:,2],
+                      func=morse2_fit_func(), rng_params=dict(seed=378711),
+                      num_iter=num_iter, resume=resume, **opts)
+    except killed_run:
+      pass
+    return sfit
+
+  try:
+    low_mem = dict(opt_mc_log_mode='stats', opt_mc_reservoir_size=10)
+    for (opts, attrs) in (({}, {}), (dict(batch_size=6), {}), ({}, low_mem)):
+      ref = run(StochasticFitting_killed, attrs=attrs, **opts)
+      F = h5py.File(ckpt_file, 'r')
+      assert F.attrs['count'] == num_iter
+      if not attrs:
+        assert F['log/mc_params'].shape == (num_iter, 4)
+        assert F['log/mc_params'].maxshape == (None, 4)
+      F.close()
+
+      run(StochasticFitting_killed, kill_at=21, attrs=attrs, **opts)
+      F = h5py.File(ckpt_file, 'r')
+      # last checkpoint: at toss 16 (serial) or 12 (the end of a batch)
+      assert F.attrs['count'] == (16 if not opts else 12)
+      F.close()
+      sfit = run(StochasticFitting_killed, kill_at=39, resume=True, attrs=attrs, **opts)
+      assert sfit.mc_online_stats.N == 39
+      sfit = run(StochasticFitting, resume=True, attrs=attrs, **opts)
+
+      assert numpy.all(sfit.mc_params == ref.mc_params)
+      assert numpy.all(sfit.mc_stats == ref.mc_stats)
+      assert sfit.log_mc_funcalls == ref.log_mc_funcalls
+      assert numpy.all(sfit.dice_y == ref.dice_y)
+      assert sfit.mcfit_warm_fallbacks == ref.mcfit_warm_fallbacks
+      for k in ('N', 'M1', 'M2', 'M3', 'M4'):
+        assert numpy.all(getattr(sfit.mc_online_stats, k)
+                         == getattr(ref.mc_online_stats, k)), k
+      for F in ref.fit_parameters:
+        assert sfit.final_mc_params[F].val == ref.final_mc_params[F].val
+        assert sfit.final_mc_params[F].err == ref.final_mc_params[F].err
+
+    # Incompatible checkpoints must be refused:
+    def resume_fails(attrs):
+      try:
+        run(StochasticFitting, resume=True, attrs=attrs)
+      except ValueError, e:
+        print("  refused: %s" % e)
+        return True
+      return False
+    run(StochasticFitting_killed, kill_at=21, attrs=low_mem)
+    assert resume_fails(dict(low_mem, opt_mc_reservoir_size=5))
+    run(StochasticFitting_killed, kill_at=21)
+    assert resume_fails(low_mem)
+    assert resume_fails(dict(opt_warm_start=False))
+    assert resume_fails(dict(opt_warm_check_count=10))
+    assert resume_fails(dict(opt_rng_streams=True))
+    F = h5py.File(ckpt_file, 'a')
+    hdf5_write_obj(F['setup'], 'fit_method', 'fmin')
+    F.close()
+    assert resume_fails({})
+    F = h5py.File(ckpt_file, 'a')
+    del F['setup/fit_method']
+    F.close()
+    assert resume_fails({})
+    run(StochasticFitting_killed, kill_at=21)
+    F = h5py.File(ckpt_file, 'a')
+    F.attrs['version'] = 1
+    F.close()
+    assert resume_fails({})
+  finally:
+    if os.path.exists(ckpt_file):
+      os.remove(ckpt_file)
+  print("All testings passed.")
+
+
+def test_fit_PEC_MC_TZ_low_memory(num_iter=200):
+  """20261019
+  The per-toss logs kept in growable arrays, or not kept at all
+  (online statistics and a reservoir sample only).
+  """
+  from wpylib.math.fitting.funcs_pec import morse2_fit_func
+  print("test_fit_PEC_MC_TZ_low_memory::")
+  setup_MC_TZ()
+  rawdata = Cr2_TZ_data_20140728uhf
+  def run(mode, reservoir=0):
+    sfit = StochasticFitting()
+    sfit.opt_mc_log_mode = mode
+    sfit.opt_mc_reservoir_size = reservoir
+    sfit.opt_report_final_params = 0
+    sfit.mcfit_run1(x=rawdata[:,0], y=rawdata[:,1], dy=rawdata[:,2],
+                    func=morse2_fit_func(), rng_params=dict(seed=378711),
+                    num_iter=num_iter)
+    return sfit
+
+  ref = run('list')
+  sfit_arr = sfit = run('array', reservoir=20)
+  assert numpy.all(sfit.mc_params == ref.mc_params)
+  assert numpy.all(sfit.mc_stats == ref.mc_stats)
+  assert list(sfit.log_mc_funcalls) == ref.log_mc_funcalls
+  # mc_params is a view of the log, not a copy:
+  assert numpy.may_share_memory(sfit.mc_params, sfit.log_mc_params.data)
+  P = numpy.array([ ref.mc_params[F] for F in ref.fit_parameters ]).T
+  assert numpy.allclose(sfit.final_mc_params_cov, numpy.cov(P.T, ddof=0), rtol=1e-10)
+
+  sfit = run('stats', reservoir=20)
+  assert sfit.log_mc_params is None
+  assert sfit.mc_online_stats.N == num_iter
+  for F in ref.fit_parameters:
+    (p, p_ref) = (sfit.final_mc_params[F], ref.final_mc_params[F])
+    assert numpy.allclose((p.val, p.err), (p_ref.val, p_ref.err), rtol=1e-10), F
+    assert numpy.allclose(sfit.final_mc_err_relerr[F], ref.final_mc_err_relerr[F],
+                          rtol=1e-8), F
+  # The reservoir is a subset of the tosses, the same in all modes:
+  assert len(sfit.mc_params) == 20
+  assert numpy.all(numpy.in1d(sfit.mc_params['k'], ref.mc_params['k']))
+  assert numpy.all(sfit.mc_reservoir.sample() == sfit_arr.mc_reservoir.sample())
+  assert sfit.mcfit_eval(x=[1.8, 2.0]).shape == (2,)
+  print("All testings passed.")
+
+
+def test_fit_PEC_MC_TZ_async_fig(num_iter=20, tmpdir="/tmp"):
+  """20261019
+  Figures of every 3rd MC fit step, rendered in the background.
+  By default none is skipped; with opt_mcfit_fig_drop, the last one is
+  still drawn.
+  """
+  import os
+  import shutil
+  import tempfile
+  print("test_fit_PEC_MC_TZ_async_fig::")
+  ref = run_mcfit_TZ(num_iter)
+  expected = [ "mcfit-%04d.png" % i for i in xrange(0, num_iter, 3) ]
+  for drop in (False, True):
+    fig_dir = tempfile.mkdtemp(dir=tmpdir)
+    try:
+      sfit = StochasticFitting()
+      sfit.opt_mcfit_fig_dir = fig_dir
+      sfit.opt_mcfit_fig_async = True
+      sfit.opt_mcfit_fig_every = 3
+      sfit.opt_mcfit_fig_queue_size = 1
+      sfit.opt_mcfit_fig_drop = drop
+      sfit = run_mcfit_TZ(num_iter, sfit=sfit, save_fig=True)
+      assert numpy.all(sfit.mc_params == ref.mc_params)
+      R = sfit.mcfit_renderer
+      assert R.closed and not R.proc.is_alive()
+      assert R.submitted + R.dropped == len(expected)
+      files = sorted(os.listdir(fig_dir))
+      print(drop, files)
+      if not drop:
+        assert R.dropped == 0
+        assert files == expected
+      else:
+        assert len(files) == R.submitted
+        assert set(files) <= set(expected)
+        assert expected[-1] in files
+    finally:
+      shutil.rmtree(fig_dir)
+  print("All testings passed.")
+
+
+def bench_fit_PEC_MC_TZ_batch(num_iter=2000, batch_sizes=(1, 16, 64, 256)):
+  """Timing of the MC loop, serial (batch_size=1) vs batched fitting."""
+  import time
+  for batch_size in batch_sizes:
+    t1 = time.time()
+    sfit = run_mcfit_TZ(num_iter, batch_size=batch_size)
+    t2 = time.time()
+    print("batch_size=%4d : %8.3f secs  (%.3f ms/fit)  avg funcalls = %.1f" \
+          % (batch_size, t2 - t1, (t2 - t1) / num_iter * 1e3,
+             numpy.mean(sfit.log_mc_funcalls)))
+
+
 if __name__ == '__main__':
   test_fit_PEC_MC_TZ()
@@ -0,0 +1,72 @@
+# Created: 20261019
+# Test module for wpylib.math.fitting.sweep
+
+import numpy
+from wpylib.math.fitting import funcs_pec
+from wpylib.math.fitting.sweep import extrapolate_params, fit_sweep_branches, \
+     GUESS_XY, GUESS_EXTRAP
+
+
+def sweep_datasets(func, C0, coords, seed=2):
+  """Synthetic PEC datasets whose E0, k and r0 drift along the sweep."""
+  x = numpy.linspace(1.55, 3.0, 15)
+  dy = 0.002 * numpy.ones(len(x))
+  rng = numpy.random.RandomState(seed)
+  params = []
+  datasets = []
+  for s in coords:
+    C = numpy.array(C0, dtype=float)
+    C[:3] += (-0.01 * s, 0.2 * s, -0.005 * s)
+    params.append(C)
+    datasets.append((x, func(C, [x]) + dy * rng.normal(size=len(x)), dy))
+  return (datasets, numpy.array(params))
+
+
+def test_extrapolate_params1():
+  print("test_extrapolate_params1::")
+  s = [1.0, 2.0, 4.0]
+  P = numpy.array([ [2*t + 1, t*t] for t in s ])
+  assert numpy.allclose(extrapolate_params(s, P, 5.0), [11.0, 25.0])
+  assert numpy.allclose(extrapolate_params(s[1:], P[1:], 5.0)[0], 11.0)
+
+
+def test_fit_sweep1():
+  """Continuation fits: same minima as the independent fits, fewer
+  function calls, and rescue of the fragile ext3Bmorse2 fits."""
+  print("test_fit_sweep1::")
+  coords = numpy.linspace(2, 6, 12)
+  func = funcs_pec.ext3Bmorse2_fit_func()
+  (D, params) = sweep_datasets(func, (-2.18, 9.8, 1.80, 1.86, 0.3), coords)
+  tbl0 = func.fit_sweep(D, coords=coords, extrapolate=None, Guess=params[0])
+  tbl1 = func.fit_sweep(D, coords=coords, extrapolate=1, Guess=params[0])
+  print(tbl0['chi_square'], tbl0['funcalls'])
+  print(tbl1['chi_square'], tbl1['funcalls'], tbl1['guess'])
+  assert numpy.all(tbl0['guess'] == GUESS_XY)
+  assert numpy.any(tbl1['guess'] == GUESS_EXTRAP)
+  assert numpy.all(tbl1['ok'])
+  assert numpy.all(tbl1['index'] == numpy.arange(12))
+  assert numpy.all(tbl1['coord'] == coords)
+  # Guess_xy is not good enough for this ansatz; continuation is:
+  assert numpy.all(tbl1['chi_square'] <= tbl0['chi_square'] * (1 + 1e-6))
+  assert numpy.all(abs(tbl1['r0'] - params[:,2]) < 5 * tbl1['r0_err'])
+  assert tbl1['funcalls'].sum() < tbl0['funcalls'].sum()
+
+  func = funcs_pec.morse2_fit_func()
+  (D, params) = sweep_datasets(func, (-2.18, 9.8, 1.80, 1.86), coords)
+  tbl0 = func.fit_sweep(D, coords=coords, extrapolate=None)
+  tbl1 = func.fit_sweep(D, coords=coords)
+  assert numpy.allclose(tbl1['chi_square'], tbl0['chi_square'], rtol=1e-6)
+  assert numpy.all(abs(tbl1['k'] - tbl0['k']) < 0.01 * tbl0['k_err'])
+  assert tbl1['funcalls'].sum() < tbl0['funcalls'].sum()
+
+  # Branches, serial and in parallel:
+  T1 = fit_sweep_branches(func, [D[:6], D[6:]], coords=[coords[:6], coords[6:]])
+  T2 = fit_sweep_branches(func, [D[:6], D[6:]], coords=[coords[:6], coords[6:]],
+                          nproc=2)
+  assert numpy.all(T1['branch'] == [0]*6 + [1]*6)
+  assert numpy.all(T1 == T2)
+
+
+if __name__ == '__main__':
+  test_extrapolate_params1()
+  test_fit_sweep1()
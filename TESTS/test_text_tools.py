@@ -0,0 +1,36 @@
+# Created: 20261019
+# Test module for wpylib.text_tools
+
+import numpy
+from StringIO import StringIO
+from wpylib.text_tools import matrix_str, matrix_write, table_write
+
+
+def test_matrix_write1():
+  """matrix_write must produce the same text as matrix_str,
+  regardless of the chunking."""
+  print("test_matrix_write1::")
+  A = numpy.arange(35.0).reshape((7,5)) * 1.25 - 3
+  Z = A[:,:3] + 1j * A[:,2:]
+  for (M, fmt) in ((A, None), (A, " %#17.10g"), (Z, None),
+                   (Z, '(%+#22.15e,%+#22.15e)')):
+    for chunk_rows in (1, 3, 7, 100):
+      O = StringIO()
+      matrix_write(O, M, fmt=fmt, chunk_rows=chunk_rows)
+      assert O.getvalue() == matrix_str(M, fmt=fmt) + "\n"
+
+
+def test_table_write1():
+  """Mixed-type columns with header and per-column formats."""
+  print("test_table_write1::")
+  x = numpy.array([1.5, 2.5, 3.25])
+  n = numpy.array([10, 20, 2**60])
+  z = numpy.array([1+2j, 3-4j, 0.5j])
+  O = StringIO()
+  table_write(O, [x, n, z], fmt=["%5.2f", "%d", "(%g,%g)"], header="# x n z",
+              chunk_rows=2)
+  assert O.getvalue() == \
+    "# x n z\n" \
+    " 1.50 10 (1,2)\n" \
+    " 2.50 20 (3,-4)\n" \
+    " 3.25 %d (0,0.5)\n" % 2**60
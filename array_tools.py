@@ -85,3 +85,83 @@ def array_vstack(arrays):
   return vstack(stk)
 
 
+
+
+class growable_array(object):
+  """A numpy array that grows at the end, like a list of rows.
+  The storage is preallocated and its capacity doubled when exhausted,
+  so that appending is cheap on average, and the filled part is always
+  available as a numpy array (without copying) through array().
+
+  The shape of the rows is set by the `shape` argument, or taken from the
+  first row appended if shape is None.
+
+      A = growable_array(shape=(3,))
+      for x in samples:
+        A.append(x)
+      print A.array().mean(axis=0)
+  """
+  def __init__(self, shape=None, dtype=float, capacity=16):
+    self.shape = (tuple(shape) if shape is not None else None)
+    self.dtype = numpy.dtype(dtype)
+    self.capacity = max(int(capacity), 1)
+    self.N = 0
+    self.data = None
+
+  def reserve(self, capacity):
+    """Makes room for (at least) `capacity` rows in total."""
+    if self.data is None:
+      self.capacity = max(self.capacity, capacity)
+    elif capacity > len(self.data):
+      data = numpy.empty((capacity,) + self.shape, dtype=self.dtype)
+      data[:self.N] = self.data[:self.N]
+      self.data = data
+    return self
+
+  def append(self, x):
+    """Appends a row."""
+    if self.data is None:
+      if self.shape is None:
+        self.shape = numpy.shape(x)
+      self.data = numpy.empty((self.capacity,) + self.shape, dtype=self.dtype)
+    elif self.N == len(self.data):
+      self.reserve(2 * self.N)
+    self.data[self.N] = x
+    self.N += 1
+
+  def extend(self, X):
+    """Appends many rows; the first dimension of X runs over the rows."""
+    X = numpy.asarray(X, dtype=self.dtype)
+    if len(X) == 0:
+      return
+    if self.data is None:
+      self.append(X[0])
+      X = X[1:]
+    n = self.N + len(X)
+    if n > len(self.data):
+      self.reserve(max(n, 2 * len(self.data)))
+    self.data[self.N:n] = X
+    self.N = n
+
+  def clear(self):
+    self.N = 0
+
+  def array(self):
+    """Returns the filled part of the storage (a view, not a copy)."""
+    if self.data is None:
+      return numpy.empty((0,) + (self.shape or ()), dtype=self.dtype)
+    return self.data[:self.N]
+
+  def __len__(self):
+    return self.N
+
+  def __getitem__(self, idx):
+    return self.array()[idx]
+
+  def __iter__(self):
+    return iter(self.array())
+
+  def __array__(self, dtype=None):
+    if dtype is None:
+      return self.array()
+    return self.array().astype(dtype)
@@ -0,0 +1,290 @@
+#
+# wpylib.db.hdf5_cache module
+# Created: 20261019
+# Wirawan Purwanto
+#
+
+"""
+wpylib.db.hdf5_cache module
+Persistent (on-disk) memoization of expensive functions using HDF5.
+
+Typical use:
+
+    from wpylib.db.hdf5_cache import hdf5_memoize
+
+    @hdf5_memoize("analysis-cache.h5", version=3, max_entries=200)
+    def refit_grid(x, y, dy, order=3):
+      ...expensive stuff producing numpy arrays...
+      return (grid, vals)
+
+The first call of refit_grid with a given set of arguments computes the
+value and stores it in the HDF5 file; subsequent calls with identical
+arguments (possibly in another python session) return the stored value.
+
+The cache key is a SHA1 hash of the function identity (module and
+function name) and all the arguments.
+Only "value-like" arguments are supported: None, numbers, strings,
+numpy arrays and scalars, and tuples/lists/dicts thereof.
+Calls with other kinds of arguments are passed on to the function
+without caching.
+The function result must be storable by wpylib.iofmt.hdf5.hdf5_write_obj;
+otherwise it is returned but not stored.
+
+Cache invalidation is explicit: change the `version` tag whenever the
+function's code changes in a way that affects its results.
+All stored values of a function are discarded when a different version
+tag is encountered.
+
+Eviction: if `max_entries` and/or `max_bytes` are set, the least recently
+used entries are removed when the limits are exceeded.
+Note that HDF5 does not return the freed space to the operating system;
+use the `h5repack` tool to compact a cache file that has seen many
+evictions.
+"""
+
+import hashlib
+import os.path
+import time
+import numpy
+
+from wpylib.iofmt.hdf5 import hdf5_write_obj, hdf5_read_obj
+
+
+def memo_hash_update(H, obj):
+  """Feeds a value-like object into a hashlib object H.
+  The feed is unambiguous: the type and size of each object are fed
+  as well.
+  Raises TypeError for unsupported object types.
+  """
+  if obj is None:
+    H.update("N;")
+  elif isinstance(obj, (bool, int, long, float, complex)):
+    H.update("%s:%r;" % (type(obj).__name__, obj))
+  elif isinstance(obj, basestring):
+    if isinstance(obj, unicode):
+      obj = obj.encode('utf-8')
+    H.update("s%d:" % len(obj))
+    H.update(obj)
+  elif isinstance(obj, (numpy.ndarray, numpy.generic)):
+    A = numpy.ascontiguousarray(obj)
+    if A.dtype.hasobject:
+      raise TypeError, "Cannot hash numpy object arrays."
+    H.update("a%s%r:" % (A.dtype.str, A.shape))
+    H.update(A.tostring())
+  elif isinstance(obj, (tuple, list)):
+    H.update("%s%d:" % (type(obj).__name__[0], len(obj)))
+    for o in obj:
+      memo_hash_update(H, o)
+  elif isinstance(obj, dict):
+    H.update("d%d:" % len(obj))
+    for k in sorted(obj.keys()):
+      memo_hash_update(H, k)
+      memo_hash_update(H, obj[k])
+  else:
+    raise TypeError, "Cannot hash object of type %s" % (type(obj),)
+
+
+def memo_hash(*args, **kwargs):
+  """Computes the SHA1 hex digest of a set of value-like arguments.
+  Raises TypeError for unsupported object types."""
+  H = hashlib.sha1()
+  memo_hash_update(H, args)
+  memo_hash_update(H, kwargs)
+  return H.hexdigest()
+
+
+def func_identity(func):
+  """Returns a string identifying a function (or callable object)
+  across python sessions."""
+  name = getattr(func, "__name__", None) or type(func).__name__
+  return "%s.%s" % (getattr(func, "__module__", None), name)
+
+
+class hdf5_memo_function(object):
+  """A memoized function backed by an HDF5 cache file.
+  Normally created via the hdf5_memoize decorator.
+
+  Statistics counters (attributes):
+  - hits: number of calls served from the cache file
+  - misses: number of calls that had to invoke the function
+  - stores: number of results written to the cache file
+  - evictions: number of cache entries removed to satisfy the size bounds
+  - uncacheable: number of calls (or results) that cannot be cached
+  """
+  def __init__(self, func, filename, version=None,
+               max_entries=None, max_bytes=None, name=None):
+    self.func = func
+    self.filename = filename
+    self.version = version
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+    self.name = name or func_identity(func)
+    for attr in ('__name__', '__module__', '__doc__'):
+      try:
+        setattr(self, attr, getattr(func, attr))
+      except (AttributeError, TypeError):
+        pass
+    self.reset_stats()
+
+  def reset_stats(self):
+    self.hits = 0
+    self.misses = 0
+    self.stores = 0
+    self.evictions = 0
+    self.uncacheable = 0
+
+  def stats(self):
+    """Returns the cache statistics as a dict."""
+    return dict(hits=self.hits, misses=self.misses, stores=self.stores,
+                evictions=self.evictions, uncacheable=self.uncacheable)
+
+  def group_name(self):
+    # HDF5 group names cannot contain '/'
+    return self.name.replace("/", "|")
+
+  def key(self, *args, **kwargs):
+    """Computes the cache key for a given set of arguments.
+    Raises TypeError if the arguments are not value-like."""
+    return memo_hash(self.name, repr(self.version), args, kwargs)
+
+  def open_group(self, F):
+    """Opens (or creates) the HDF5 group for this function in file F,
+    discarding stale entries if the version tag has changed."""
+    gname = self.group_name()
+    ver = repr(self.version)
+    if gname in F:
+      G = F[gname]
+      if G.attrs.get('version', None) != ver:
+        del F[gname]
+    if gname not in F:
+      G = F.create_group(gname)
+      G.attrs['version'] = ver
+    return F[gname]
+
+  def __call__(self, *args, **kwargs):
+    try:
+      key = self.key(*args, **kwargs)
+    except TypeError:
+      self.uncacheable += 1
+      return self.func(*args, **kwargs)
+
+    (found, val) = self.lookup(key)
+    if found:
+      return val
+
+    self.misses += 1
+    val = self.func(*args, **kwargs)
+    self.store(key, val)
+    return val
+
+  def lookup(self, key):
+    """Looks up a stored value by its cache key.
+    Returns a (found, value) tuple.
+    A successful lookup counts as a hit and refreshes the access time
+    of the entry."""
+    import h5py
+    if not os.path.isfile(self.filename):
+      return (False, None)
+    F = h5py.File(self.filename, 'a')
+    try:
+      G = self.open_group(F)
+      if key in G:
+        E = G[key]
+        val = hdf5_read_obj(E['value'])
+        E.attrs['atime'] = time.time()
+        self.hits += 1
+        return (True, val)
+    finally:
+      F.close()
+    return (False, None)
+
+  def store(self, key, val):
+    """Stores a value in the cache file, evicting the old entries as
+    needed."""
+    import h5py
+    F = h5py.File(self.filename, 'a')
+    try:
+      G = self.open_group(F)
+      if key in G:
+        del G[key]
+      E = G.create_group(key)
+      try:
+        nbytes = hdf5_write_obj(E, 'value', val)
+      except TypeError:
+        del G[key]
+        self.uncacheable += 1
+        return False
+      E.attrs['nbytes'] = nbytes
+      E.attrs['atime'] = time.time()
+      self.stores += 1
+      self.evict_(G, keep=key)
+    finally:
+      F.close()
+    return True
+
+  def evict_(self, G, keep=None):
+    """Removes the least recently used entries from group G until
+    the cache bounds are satisfied.
+    The entry named by `keep` (i.e. the most recent one) is never evicted."""
+    if self.max_entries is None and self.max_bytes is None:
+      return
+    entries = sorted([ (E.attrs['atime'], k, E.attrs['nbytes'])
+                       for (k,E) in G.iteritems() ])
+    num_entries = len(entries)
+    tot_bytes = sum([ e[2] for e in entries ])
+    for (atime, k, nbytes) in entries:
+      if (self.max_entries is None or num_entries <= self.max_entries) \
+         and (self.max_bytes is None or tot_bytes <= self.max_bytes):
+        break
+      if k == keep:
+        continue
+      del G[k]
+      num_entries -= 1
+      tot_bytes -= nbytes
+      self.evictions += 1
+
+  def clear(self):
+    """Removes all cached values of this function."""
+    import h5py
+    if not os.path.isfile(self.filename):
+      return
+    F = h5py.File(self.filename, 'a')
+    try:
+      if self.group_name() in F:
+        del F[self.group_name()]
+    finally:
+      F.close()
+
+  def __len__(self):
+    """Number of cached values currently stored for this function."""
+    import h5py
+    if not os.path.isfile(self.filename):
+      return 0
+    F = h5py.File(self.filename, 'r')
+    try:
+      gname = self.group_name()
+      if gname in F and F[gname].attrs.get('version', None) == repr(self.version):
+        return len(F[gname])
+      return 0
+    finally:
+      F.close()
+
+
+def hdf5_memoize(filename, version=None, max_entries=None, max_bytes=None, name=None):
+  """Decorator to memoize a function onto an HDF5 cache file.
+  See the module documentation for details.
+
+  Arguments:
+  - filename: the HDF5 cache file (can be shared by many functions)
+  - version: version tag for explicit invalidation of stale values
+  - max_entries: maximum number of stored values for this function
+  - max_bytes: maximum total size (in bytes) of stored values for this
+    function
+  - name: override the function identity used in the cache key and
+    as the group name in the cache file
+  """
+  def decorate(func):
+    return hdf5_memo_function(func, filename, version=version,
+                              max_entries=max_entries, max_bytes=max_bytes,
+                              name=name)
+  return decorate
@@ -26,6 +26,7 @@ import glob
 import gzip
 import os
 import os.path
+import zlib
 try:
   import subprocess
   has_subprocess = True
@@ -72,7 +73,153 @@ class super_file(object):
     self.pushback.append(s)
 
 
-def open_input_file(fname, superize=0):
+class readahead_file(object):
+  """A read-only file-like wrapper that reads (and thus decompresses)
+  the underlying file object in a background thread.
+
+  The background thread reads blocks of `bufsize' bytes into a bounded
+  ring of (at most) `nbuffers' buffers, while the consumer thread splits
+  the data into lines.
+  Decompression (e.g. by bz2, gzip, or lzma module, or an external
+  decompressor feeding a pipe) thus overlaps with the parsing done by the
+  consumer.
+  The compression modules release the global interpreter lock while
+  decompressing, so the two jobs can run on different cores.
+
+  This object supports iteration, next(), readline(), readlines(), read(),
+  and close().
+  An exception raised in the reader thread is re-raised in the consumer
+  thread.
+  """
+  def __init__(self, fobj, nbuffers=4, bufsize=1<<20):
+    import threading
+    try:
+      import Queue as queue
+    except ImportError:
+      import queue
+    self.obj = fobj
+    self.bufsize = bufsize
+    self.queue = queue.Queue(nbuffers)
+    self.queue_Full = queue.Full
+    self.stopping = False
+    self.eof = False
+    self.lines = []      # complete lines of the current buffer
+    self.iline = 0       # index of the next line in self.lines
+    self.partial = ""    # incomplete line at the end of the current buffer
+    self.thread = threading.Thread(target=self.reader_, name="readahead_file")
+    self.thread.daemon = True
+    self.thread.start()
+
+  def reader_(self):
+    """The background reader loop."""
+    try:
+      while not self.stopping:
+        data = self.obj.read(self.bufsize)
+        self.put_(data)
+        if not data:
+          return
+    except Exception, e:
+      self.put_(e)
+
+  def put_(self, item):
+    while not self.stopping:
+      try:
+        self.queue.put(item, timeout=0.1)
+        return
+      except self.queue_Full:
+        pass
+
+  def fill_(self):
+    """Fetches the next buffer from the reader thread.
+    Returns False at end of file."""
+    if self.eof:
+      return False
+    data = self.queue.get()
+    if isinstance(data, Exception):
+      self.eof = True
+      raise data
+    if not data:
+      self.eof = True
+      if self.partial:
+        self.lines = [self.partial]
+        self.iline = 0
+        self.partial = ""
+        return True
+      return False
+    self.split_lines_(self.partial + data)
+    return True
+
+  def split_lines_(self, S):
+    """Sets the complete lines of text S as the current lines, and keeps
+    the unterminated tail as the partial line."""
+    lines = S.split("\n")
+    self.partial = lines.pop()
+    self.lines = [ L + "\n" for L in lines ]
+    self.iline = 0
+
+  def __iter__(self):
+    return self
+
+  def next(self):
+    while self.iline >= len(self.lines):
+      if not self.fill_():
+        raise StopIteration
+    L = self.lines[self.iline]
+    self.iline += 1
+    return L
+  __next__ = next
+
+  def readline(self):
+    try:
+      return self.next()
+    except StopIteration:
+      return ""
+
+  def readlines(self):
+    return list(self)
+
+  def read(self, size=-1):
+    chunks = []
+    nread = 0
+    while size < 0 or nread < size:
+      if self.iline >= len(self.lines):
+        if not self.fill_():
+          break
+        continue
+      # gather the remaining lines of the current buffer
+      S = "".join(self.lines[self.iline:])
+      self.lines = []
+      self.iline = 0
+      chunks.append(S)
+      nread += len(S)
+    S = "".join(chunks)
+    if size >= 0 and len(S) > size:
+      # put the rest back as lines
+      self.split_lines_(S[size:] + self.partial)
+      if self.eof and self.partial:
+        self.lines.append(self.partial)
+        self.partial = ""
+      S = S[:size]
+    return S
+
+  def close(self):
+    self.stopping = True
+    self.thread.join()
+    return self.obj.close()
+
+
+def open_input_file(fname, superize=0, readahead=0):
+  """Opens a file for reading, automatically decompressing it according
+  to the file name extension (.bz2, .gz, .Z, .lzma, .xz).
+
+  Options:
+  * superize: wraps the file object with super_file (to allow pushing
+    back lines).
+  * readahead: if nonzero, the file is read (and decompressed) in a
+    background thread (see readahead_file).
+    An integer value greater than one specifies the number of read-ahead
+    buffers (of 1 MiB each).
+  """
   if fname.endswith(".bz2"):
     fobj = bz2.BZ2File(fname, "r")
   elif fname.endswith(".gz") or fname.endswith(".Z"):
@@ -104,12 +251,214 @@ def open_input_file(fname, superize=0):
   else:
     fobj = open(fname, "r")
 
+  if readahead:
+    if readahead is True or readahead == 1:
+      fobj = readahead_file(fobj)
+    else:
+      fobj = readahead_file(fobj, nbuffers=readahead)
+
   if superize:
     return super_file(fobj)
   else:
     return fobj
 
 
+def default_num_threads():
+  """Default number of worker threads for parallel I/O tasks:
+  the number of available CPU cores."""
+  try:
+    import multiprocessing
+    return multiprocessing.cpu_count()
+  except:
+    return 1
+
+
+def gzip_compress_member(data, level=6):
+  """Compresses a string as a complete, standalone gzip member.
+  Concatenation of gzip members is a valid (multi-member) gzip stream."""
+  C = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  return C.compress(data) + C.flush()
+
+
+def xz_compress_stream(data, level=6):
+  """Compresses a string as a complete, standalone xz stream.
+  Concatenation of xz streams is a valid xz file."""
+  return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+
+class block_compressed_file(object):
+  """A write-only file-like object that compresses its content in
+  independent blocks, using a pool of worker threads.
+
+  The text written to this object is accumulated into blocks of (at least)
+  `blocksize' bytes.
+  Each block is compressed independently by `compress_block' (which must
+  produce a standalone compressed member, e.g. gzip_compress_member)
+  on a thread pool, and the compressed members are written out in order.
+  The zlib and lzma compressors release the global interpreter lock while
+  compressing, so the throughput scales with the number of threads.
+
+  At most 2*nthreads blocks are in flight at a time, so the memory use is
+  bounded by about 4*nthreads*blocksize bytes.
+  """
+  def __init__(self, fname, compress_block, mode="w", nthreads=None,
+               blocksize=1<<20):
+    from multiprocessing.pool import ThreadPool
+    from collections import deque
+    if mode not in ("w", "a", "wb", "ab"):
+      raise ValueError, "Invalid mode for block_compressed_file: %s" % (mode,)
+    if nthreads == None:
+      nthreads = default_num_threads()
+    self.name = fname
+    self.compress_block = compress_block
+    self.nthreads = nthreads
+    self.blocksize = blocksize
+    self.fobj = open(fname, mode[0] + "b")
+    self.pool = ThreadPool(nthreads)
+    self.pending = deque()
+    self.buf = []
+    self.nbuf = 0
+    self.nmembers = 0
+    self.closed = False
+
+  def __enter__(self):
+    return self
+  def __exit__(self, type, value, traceback):
+    self.close()
+  def __del__(self):
+    if not getattr(self, "closed", True):
+      self.close()
+
+  def write(self, s):
+    if self.closed:
+      raise ValueError, "I/O operation on closed file"
+    self.buf.append(s)
+    self.nbuf += len(s)
+    if self.nbuf >= self.blocksize:
+      self.submit_block_()
+
+  def writelines(self, lines):
+    for L in lines:
+      self.write(L)
+
+  def submit_block_(self):
+    if self.nbuf == 0:
+      return
+    data = "".join(self.buf)
+    self.buf = []
+    self.nbuf = 0
+    self.pending.append(self.pool.apply_async(self.compress_block, (data,)))
+    while len(self.pending) > 2 * self.nthreads:
+      self.write_member_(self.pending.popleft().get())
+
+  def write_member_(self, member):
+    self.fobj.write(member)
+    self.nmembers += 1
+
+  def flush(self):
+    """Compresses and writes out all the pending text.
+    Note: each flush ends the current compressed block; frequent flushing
+    degrades the compression ratio."""
+    self.submit_block_()
+    while self.pending:
+      self.write_member_(self.pending.popleft().get())
+    self.fobj.flush()
+
+  def close(self):
+    if self.closed:
+      return
+    try:
+      self.flush()
+      if self.nmembers == 0:
+        # an empty file is not a valid compressed stream
+        self.write_member_(self.compress_block(""))
+    finally:
+      self.closed = True
+      self.pool.close()
+      self.pool.join()
+      self.fobj.close()
+
+
+class pipe_output_file(object):
+  """A write-only file-like object that feeds an external filter program
+  (e.g. a compressor), whose output goes to a file."""
+  def __init__(self, fname, cmd, mode="w"):
+    self.name = fname
+    self.cmd = cmd
+    self.fobj = open(fname, mode[0] + "b")
+    self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=self.fobj)
+    self.closed = False
+  def __enter__(self):
+    return self
+  def __exit__(self, type, value, traceback):
+    self.close()
+  def write(self, s):
+    self.proc.stdin.write(s)
+  def writelines(self, lines):
+    self.proc.stdin.writelines(lines)
+  def flush(self):
+    self.proc.stdin.flush()
+  def close(self):
+    if self.closed:
+      return
+    self.closed = True
+    self.proc.stdin.close()
+    retcode = self.proc.wait()
+    self.fobj.close()
+    if retcode != 0:
+      raise IOError("Filter program %s failed with exit code %d" \
+                    % (self.cmd[0], retcode))
+
+
+def open_output_file(fname, mode="w", nthreads=None, blocksize=1<<20, level=6):
+  """Opens a file for writing, compressing the output according to
+  the file name extension.
+  This is the counterpart of open_input_file.
+
+  * .gz: the output is compressed in independent blocks on a thread pool
+    (see block_compressed_file), yielding a valid multi-member gzip file.
+  * .xz: same as .gz, yielding a concatenation of xz streams, if the
+    lzma module is available.
+    Otherwise, the `xz' program is used (which can use multiple threads by
+    itself).
+  * .bz2 and .lzma: compressed serially.
+    (The python 2 bz2 module cannot read multi-stream bzip2 files, and the
+    legacy lzma format does not support concatenation.)
+  * other files are opened as plain files.
+
+  The `mode' can be "w" or "a" (append).
+  The compression `level' ranges from 1 (fastest) to 9 (best).
+  The default number of threads is the number of CPU cores.
+  """
+  if fname.endswith(".gz"):
+    return block_compressed_file(fname,
+                                 lambda data: gzip_compress_member(data, level),
+                                 mode=mode, nthreads=nthreads,
+                                 blocksize=blocksize)
+  elif fname.endswith(".xz"):
+    if has_lzma:
+      return block_compressed_file(fname,
+                                   lambda data: xz_compress_stream(data, level),
+                                   mode=mode, nthreads=nthreads,
+                                   blocksize=blocksize)
+    else:
+      if nthreads == None:
+        nthreads = default_num_threads()
+      return pipe_output_file(fname, ("xz", "-c", "-%d" % level, "-T%d" % nthreads),
+                              mode=mode)
+  elif fname.endswith(".bz2"):
+    if mode.startswith("a"):
+      raise ValueError, "Appending to a bz2 file is not supported."
+    return bz2.BZ2File(fname, "w", compresslevel=level)
+  elif fname.endswith(".lzma"):
+    if has_lzma:
+      return lzma.LZMAFile(fname, mode[0], format=lzma.FORMAT_ALONE, preset=level)
+    else:
+      return pipe_output_file(fname, ("lzma", "-c", "-%d" % level), mode=mode)
+  else:
+    return open(fname, mode)
+
+
 # Miscellaneous functions:
 # - extended path manipulation/file inquiries (os.path-like functionalities)
 
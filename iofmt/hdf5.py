@@ -62,3 +62,113 @@ def hdf5_write_values(filename, keyvals):
     raise
   F.close()
 
+
+
+# Structured python objects
+#
+# The routines below store (nested) python values onto an HDF5 group.
+# Supported values are: None, scalars (bool, int, long, float, complex,
+# numpy scalars), strings, numpy arrays (non-object dtype), as well as
+# tuples, lists and dicts (with string keys) made up of these values.
+# The python kind of each node is recorded in its "pykind" attribute,
+# so that hdf5_read_obj can reconstruct the original value.
+
+def hdf5_write_obj(G, key, value):
+  """Writes a (possibly nested) python value to group G under the
+  given key.
+  Overwrites the existing node, if it exists.
+  Raises TypeError if the value (or one of its members) cannot be
+  represented in HDF5.
+  Returns the number of bytes of data stored (a rough measure of the
+  storage used by the value).
+  """
+  if key in G:
+    del G[key]
+  try:
+    return _hdf5_write_obj1(G, key, value)
+  except TypeError:
+    # do not leave half-written object behind
+    if key in G:
+      del G[key]
+    raise
+
+
+def _hdf5_write_obj1(G, key, value):
+  if value is None:
+    G.create_group(key).attrs['pykind'] = 'none'
+    return 0
+  elif isinstance(value, (tuple, list)):
+    S = G.create_group(key)
+    S.attrs['pykind'] = ('tuple' if isinstance(value, tuple) else 'list')
+    S.attrs['len'] = len(value)
+    return sum([ _hdf5_write_obj1(S, str(i), v) for (i,v) in enumerate(value) ])
+  elif isinstance(value, dict):
+    S = G.create_group(key)
+    S.attrs['pykind'] = 'dict'
+    nbytes = 0
+    for (k,v) in value.iteritems():
+      if not isinstance(k, basestring) or "/" in k or k in (".", ""):
+        raise TypeError, "Unsupported dict key for HDF5 storage: %r" % (k,)
+      nbytes += _hdf5_write_obj1(S, k, v)
+    return nbytes
+  elif isinstance(value, bool):
+    kind = 'bool'
+  elif isinstance(value, (int, long)):
+    kind = 'int'
+  elif isinstance(value, float):
+    kind = 'float'
+  elif isinstance(value, complex):
+    kind = 'complex'
+  elif isinstance(value, str):
+    kind = 'str'
+  elif isinstance(value, unicode):
+    kind = 'unicode'
+    value = value.encode('utf-8')
+  elif isinstance(value, numpy.ndarray):
+    kind = 'ndarray'
+  elif isinstance(value, numpy.generic):
+    kind = 'npscalar'
+  else:
+    raise TypeError, "Unsupported value type for HDF5 storage: %s" % (type(value),)
+
+  if kind in ('ndarray', 'npscalar') and numpy.asarray(value).dtype.hasobject:
+    raise TypeError, "Cannot store object arrays in HDF5."
+  D = G.create_dataset(key, data=value)
+  D.attrs['pykind'] = kind
+  return D.dtype.itemsize * D.size
+
+
+def hdf5_read_obj(node):
+  """Reads back a python value stored by hdf5_write_obj.
+  The argument is the HDF5 node (group or dataset) of the value.
+  """
+  kind = node.attrs.get('pykind', 'ndarray')
+  if kind == 'none':
+    return None
+  elif kind in ('tuple', 'list'):
+    rslt = [ hdf5_read_obj(node[str(i)]) for i in xrange(node.attrs['len']) ]
+    if kind == 'tuple':
+      rslt = tuple(rslt)
+    return rslt
+  elif kind == 'dict':
+    return dict((k, hdf5_read_obj(v)) for (k,v) in node.iteritems())
+
+  val = node[()]
+  if kind == 'ndarray':
+    return numpy.asarray(val)
+  elif kind == 'npscalar':
+    return val
+  elif kind == 'bool':
+    return bool(val)
+  elif kind == 'int':
+    return int(val)
+  elif kind == 'float':
+    return float(val)
+  elif kind == 'complex':
+    return complex(val)
+  elif kind == 'str':
+    return str(val)
+  elif kind == 'unicode':
+    return str(val).decode('utf-8')
+  else:
+    raise ValueError, "Unknown stored python kind: %s" % (kind,)
@@ -57,6 +57,9 @@ class text_input(object):
   To support more fancy options (e.g., rewinding), use "superize=1" when
   creating the instance.
 
+  To decompress the input in a background thread (overlapping with the
+  parsing), use "readahead=1" (see wpylib.file.file_utils.readahead_file).
+
   Other valid constructor flags:
   - expand_errorbar (default: False)
   - comment_char (default: "#")
@@ -64,11 +67,11 @@ class text_input(object):
   '''
 
   def __init__(self, fname, **opts):
-    if opts.get("superize", 0):
-      open_opts = { "superize" : opts["superize"] }
-      del opts["superize"]
-    else:
-      open_opts = {}
+    open_opts = {}
+    for o in ("superize", "readahead"):
+      if opts.get(o, 0):
+        open_opts[o] = opts[o]
+      opts.pop(o, None)
     self.file = open_input_file(fname, **open_opts)
     # Do NOT touch the "next_" field below unless you know what you're doing:
     self.set_next_proc(self.next_line)
@@ -22,6 +22,12 @@ This module is part of wpylib project.
 """
 
 import sys
+import threading
+import time
+try:
+  import Queue as queue
+except ImportError:
+  import queue
 
 class text_output(object):
   """A simple text output.
@@ -49,6 +55,18 @@ class text_output(object):
   To mute the output completely, set the `out' argument to None when
   creating the object.
 
+  Background (buffered) mode:
+  If the `background' argument is true, the written strings are put in
+  a bounded in-memory queue, which is drained to the output by a
+  background thread (see bg_writer class).
+  This mode is useful if the output lives on a slow (e.g. network)
+  filesystem and we do not want the computation to stall on log writes.
+  The `background' argument can also be a dict of options to be passed
+  to bg_writer (queue_size, flush_size, flush_interval).
+  All the queued text is guaranteed to be written out upon close(),
+  or at the latest when the python interpreter exits.
+  The background mode is kept when the object is reopened with open().
+
   Caveat:
   * If the file-like object is closed, then we will do nothing
     for the rest of the __call__ invocation.
@@ -93,13 +111,16 @@ class text_output(object):
     extra restrictions.
   ---------------------------------------------------------------------"""
 
-  def __init__(self, out=sys.stdout, flush=False, mode="w"):
+  def __init__(self, out=sys.stdout, flush=False, mode="w", background=False):
     """Initializes the text output.
     Options:
     - flush: if true, will flush every time the default action is invoked.
+    - background: if true, the output is written by a background thread.
     """
     #print sys.getrefcount(self)
     self.out = None
+    self._bg = None
+    self._background = background
     self.open(out, mode=mode)
     #print sys.getrefcount(self)
     if flush:
@@ -140,11 +161,21 @@ class text_output(object):
       self.out = open(out, mode)
       self.outfilename = out
       self._autoopen = True
+    background = getattr(self, "_background", False)
+    if background and self.out != None:
+      if isinstance(background, dict):
+        self._bg = bg_writer(self.out, **background)
+      else:
+        self._bg = bg_writer(self.out)
   def close(self):
     """Closes the text_output's output object.
     At least, flushes everything at the end of the output's association
     with this text_output object.
     """
+    if getattr(self, "_bg", None):
+      # drain the queued text first
+      self._bg.close()
+      self._bg = None
     if self.out:
       if self._autoopen:
         #print "Closing file " + self.out.name
@@ -168,11 +199,18 @@ class text_output(object):
   # self.out is yet another text_output instance.
   # But beware of possible method polymorphism if you do this. (!!!)
   def _write(self, s):
-    if self.out != None: self.out.write(s)
+    if self._bg != None:
+      self._bg.write(s)
+    elif self.out != None: self.out.write(s)
   def _flush(self):
-    if self.out != None: self.out.flush()
+    if self._bg != None:
+      self._bg.flush()
+    elif self.out != None: self.out.flush()
   def _write_flush(self, s):
-    if self.out != None:
+    if self._bg != None:
+      # the background thread takes care of flushing
+      self._bg.write(s)
+    elif self.out != None:
       self.out.write(s)
       self.out.flush()
   # The logger itself is a file-like object, too:
@@ -181,6 +219,146 @@ class text_output(object):
   write_flush = _write_flush
 
 
+class bg_writer(object):
+  """Background writer thread for a file-like object.
+
+  The strings passed to write() are put on a bounded queue and the
+  background thread writes them to the `out' object.
+  The queue bound (`queue_size', the number of pending strings) limits
+  the memory use: write() blocks if the writer thread cannot keep up.
+
+  The writer thread accumulates strings and writes them out in one go
+  (followed by out.flush()) when:
+  - the accumulated text reaches `flush_size' bytes, or
+  - `flush_interval' seconds have passed since the oldest pending text, or
+  - flush() or close() is called.
+
+  Delivery of all queued text is guaranteed upon close().
+  Writers that are still open when the python interpreter exits are
+  closed by an atexit handler.
+  An exception raised in the writer thread (e.g. by a write of a non-string
+  object, or by the `out' object) does not stop the thread; it is re-raised
+  in the calling thread by the next write(), flush() or close() call.
+  """
+  _FLUSH = object()
+  _CLOSE = object()
+  def __init__(self, out, queue_size=1024, flush_size=65536, flush_interval=1.0):
+    self.out = out
+    self.queue = queue.Queue(queue_size)
+    self.flush_size = flush_size
+    self.flush_interval = flush_interval
+    self.error = None
+    self.closed = False
+    self.thread = threading.Thread(target=self.run_, name="bg_writer")
+    self.thread.daemon = True
+    self.thread.start()
+    _bg_writers_register(self)
+
+  def check_error_(self):
+    if self.error != None:
+      err, self.error = self.error, None
+      raise err
+
+  def write(self, s):
+    self.check_error_()
+    if self.closed:
+      raise ValueError, "I/O operation on closed bg_writer"
+    self.queue.put(s)
+
+  def flush(self):
+    """Waits until all the queued text has been written and flushed."""
+    self.check_error_()
+    if self.closed:
+      return
+    done = threading.Event()
+    self.queue.put((self._FLUSH, done))
+    done.wait()
+    self.check_error_()
+
+  def close(self):
+    """Writes out all the queued text and stops the writer thread.
+    The `out' object itself is not closed."""
+    if not self.closed:
+      self.closed = True
+      self.queue.put((self._CLOSE, None))
+      self.thread.join()
+      _bg_writers_unregister(self)
+    self.check_error_()
+
+  def run_(self):
+    Q = self.queue
+    buf = []
+    nbuf = 0
+    t_first = None
+    while True:
+      if buf:
+        timeout = self.flush_interval - (time.time() - t_first)
+        try:
+          item = Q.get(timeout=max(timeout, 0))
+        except queue.Empty:
+          item = None
+      else:
+        item = Q.get()
+
+      cmd = None
+      if isinstance(item, basestring):
+        if not buf:
+          t_first = time.time()
+        buf.append(item)
+        nbuf += len(item)
+        if nbuf < self.flush_size:
+          continue
+      elif item is None:
+        pass  # timeout
+      elif isinstance(item, tuple) and len(item) == 2 \
+           and (item[0] is self._FLUSH or item[0] is self._CLOSE):
+        (cmd, done) = item
+      else:
+        # (the item is skipped; the thread must go on serving the queue)
+        self.error = TypeError("bg_writer can only write strings, not %s" \
+                               % (type(item).__name__,))
+        continue
+
+      try:
+        if buf:
+          self.out.write("".join(buf))
+          buf = []
+          nbuf = 0
+        self.out.flush()
+      except Exception, e:
+        buf = []
+        nbuf = 0
+        self.error = e
+      if cmd is self._FLUSH:
+        done.set()
+      elif cmd is self._CLOSE:
+        return
+
+
+_bg_writers = set()
+
+def _bg_writers_register(w):
+  import atexit
+  global _bg_writers_atexit
+  if not _bg_writers_atexit:
+    atexit.register(_bg_writers_close_all)
+    _bg_writers_atexit = True
+  _bg_writers.add(w)
+
+def _bg_writers_unregister(w):
+  _bg_writers.discard(w)
+
+def _bg_writers_close_all():
+  """Closes all pending background writers at interpreter exit."""
+  for w in list(_bg_writers):
+    try:
+      w.close()
+    except:
+      pass
+
+_bg_writers_atexit = False
+
+
 def test1():
   O = text_output("/tmp/test1abc.txt", flush=1)
   O("this is a test\n")
@@ -35,10 +35,16 @@ The following methods are currently supported for scipy.optimize:
 
 * `anneal`
   Similated annealing algorithm
+  (removed from scipy 0.16 on; available only with older versions)
 
 * `leastsq`
   The Levenberg-Marquardt nonlinear least square (NLLS) method
 
+* `least_squares`
+  The trust-region reflective NLLS method (scipy 0.17 or later).
+  This is the method of choice for large problems, as it supports bounds
+  on the parameters and sparse Jacobians (see fit_func).
+
 See the documentation of `scipy.optimize` for more details.
 The `fmin` algorithm is the slowest although it is fairly foor proof to
 converge it (it may take very many iterations).
@@ -46,6 +52,9 @@ The `leastsq` algorithm is the best, but it requires parameter guess that is
 reasonable.
 I don't have much success with `anneal`--it seems to behave erratically in
 my limited experience. YMMV.
+The `least_squares` algorithm converges much like `leastsq` for small
+problems, but it also scales to fits of very many data points (10^5 and
+beyond) and parameters, if the Jacobian is sparse.
 
 
 The lmfit package is supported if it can be found at runtime.
@@ -61,17 +70,49 @@ http://cars9.uchicago.edu/software/python/lmfit/fitting.html#fit-methods-label
 
 import numpy
 import scipy.optimize
+import scipy.sparse
 from wpylib.db.result_base import result_base
 
 try:
   import lmfit
+  from lmfit import Parameters as lmfit_Parameters
   HAS_LMFIT = True
 except ImportError:
   HAS_LMFIT = False
+  lmfit_Parameters = None
 
 last_fit_rslt = None
 last_chi_sqr = None
 
+def lmfit_params_vector(Params, names):
+  """Returns the values of the named parameters in an lmfit Parameters
+  object as a flat numpy array (in the order of `names')."""
+  return numpy.array([ Params[k].value for k in names ], dtype=float)
+
+
+def lsq_cov_diagonal(J, chunk_size=256):
+  """Returns the diagonal of inv(J^T J) for a sparse Jacobian J, or None
+  if J^T J is singular.
+  Only the diagonal is computed, from the sparse LU decomposition of J^T J,
+  chunk_size columns at a time, so that the (dense) inverse is never
+  formed."""
+  import scipy.sparse.linalg
+  JTJ = scipy.sparse.csc_matrix(J.T.dot(J))
+  n = JTJ.shape[0]
+  try:
+    LU = scipy.sparse.linalg.splu(JTJ)
+  except RuntimeError:
+    # exactly singular
+    return None
+  diag = numpy.empty(n)
+  for i in xrange(0, n, chunk_size):
+    j = min(i + chunk_size, n)
+    E = numpy.zeros((n, j - i))
+    E[numpy.arange(i, j), numpy.arange(j - i)] = 1.0
+    diag[i:j] = LU.solve(E)[numpy.arange(i, j), numpy.arange(j - i)]
+  return diag
+
+
 class fit_result(result_base):
   """The basic values expected in fit_result are:
   - xopt
@@ -89,7 +130,10 @@ def fit_func(Funct, Data=None, Guess=None, Params=None,
              debug=0,
              outfmt=1,
              Funct_hook=None,
-             method='leastsq', opts={}):
+             Jacobian=None,
+             Bounds=None, JacSparsity=None,
+             method='leastsq', opts={},
+             cache=None):
   """
   Performs a function fitting.
   The domain of the function is a D-dimensional vector, and the function
@@ -123,6 +167,8 @@ def fit_func(Funct, Data=None, Guess=None, Params=None,
 
   Inspect Poly_base, Poly_order2, and other similar function classes in the
   funcs_poly module to see the example of the Funct function.
+  (Being linear in their coefficients, these polynomials are better fitted
+  in closed form with their linear_fit method.)
 
   The measurement (input) datasets, against which the function is to be fitted,
   can be specified in one of two ways:
@@ -151,6 +197,56 @@ def fit_func(Funct, Data=None, Guess=None, Params=None,
   Note that the reference to the hook object is passed as the first argument
   to facilitate object oriented programming.
 
+  ANALYTIC JACOBIAN
+
+  If "Jacobian" is given, it is a callable with the same (C, x) argument
+  list as Funct, returning the derivatives of the function values with
+  respect to the parameters, i.e. a 2-D array of shape (M, number of
+  parameters).
+  The (weighted) Jacobian is passed on to the `leastsq' and `lmfit:leastsq'
+  minimizers, which otherwise estimate it by finite differences at the
+  cost of (number of parameters) extra function calls per iteration.
+  It is ignored by the other methods.
+  The number of Jacobian evaluations is reported as `njev' in the full
+  result.
+
+  BOUNDS AND SPARSE JACOBIANS (least_squares method)
+
+  The `least_squares' method accepts lower and upper bounds on the
+  parameters via "Bounds", a pair (lb, ub) of arrays (or scalars) in the
+  format of scipy.optimize.least_squares; use -numpy.inf and numpy.inf
+  for the unbounded sides.
+  The guess is moved into the bounds if necessary.
+  Without an analytic Jacobian, "JacSparsity" may give the sparsity
+  pattern of the Jacobian (an (M, number of parameters) array or
+  scipy.sparse matrix, nonzero where a function value depends on a
+  parameter).
+  The finite-difference Jacobian then costs only as many function calls as
+  there are groups of parameters not sharing any data point, and the
+  trust-region subproblems are solved iteratively (LSMR) on the sparse
+  Jacobian, which is what makes fits of 10^5-10^6 data points feasible.
+  The analytic Jacobian (above) may also return a scipy.sparse matrix.
+  Bounds and JacSparsity are ignored by the other methods (lmfit supports
+  bounds through the min/max attributes of its Parameters).
+  The parameter uncertainties (xerr) are computed from the Jacobian at the
+  solution, as for `leastsq'; they are not meaningful for parameters
+  sitting at their bounds.
+
+  RESIDUAL EVALUATION
+
+  For the methods minimizing the WSSR alone (fmin, bfgs, anneal; without
+  Funct_hook), the WSSR is computed by a
+  wpylib.math.fitting.residual.residual_engine object, which reuses
+  preallocated work arrays.
+  See the residual module for details.
+
+  FIT CACHE
+
+  If "cache" is given (a wpylib.math.fitting.fit_cache.fit_cache object),
+  a previously computed result for the same ansatz, data, guess, method
+  and options is returned instead of refitting.
+  See the fit_cache module for details.
+
 
   SUPPORT FOR LMFIT MODULE
 
@@ -169,7 +265,13 @@ def fit_func(Funct, Data=None, Guess=None, Params=None,
   be defined and the initial values will be used as Guess.
   """
   global last_fit_rslt, last_chi_sqr
-  from scipy.optimize import fmin, fmin_bfgs, leastsq, anneal
+  if cache is not None:
+    return cache.fit_func(Funct, Data=Data, Guess=Guess, Params=Params,
+                          x=x, y=y, w=w, dy=dy, debug=debug, outfmt=outfmt,
+                          Funct_hook=Funct_hook, Jacobian=Jacobian,
+                          Bounds=Bounds, JacSparsity=JacSparsity,
+                          method=method, opts=opts)
+  from scipy.optimize import fmin, fmin_bfgs, leastsq
   # We want to minimize this error:
   if Data != None:
     # an alternative way to specifying x and y
@@ -198,8 +300,15 @@ def fit_func(Funct, Data=None, Guess=None, Params=None,
     param_names = Funct.param_names
     if debug >= 10:
       print "param names: ", param_names
+    def Funct_eval(CC, xx):
+      # The function receives the parameter values as a flat vector,
+      # extracted once per evaluation:
+      if isinstance(CC, lmfit_Parameters):
+        CC = lmfit_params_vector(CC, param_names)
+      return Funct(CC, xx)
   else:
     use_lmfit = False
+    Funct_eval = Funct
 
   if Guess != None:
     pass
@@ -256,18 +365,18 @@ def fit_func(Funct, Data=None, Guess=None, Params=None,
       * yy = target points of the ("measured") data
       * ww = weights of the ("measured") data (usually, 1/error**2 of the data)
       """
-      ff = Funct(CC,xx)
+      ff = Funct_eval(CC,xx)
       r = (ff - yy) * ww
       Funct_hook(CC, xx, yy, ff, r)
       return r
   elif debug < 20:
     def fun_err(CC, xx, yy, ww):
-      ff = Funct(CC,xx)
+      ff = Funct_eval(CC,xx)
       r = (ff - yy) * ww
       return r
   else:
     def fun_err(CC, xx, yy, ww):
-      ff = Funct(CC,xx)
+      ff = Funct_eval(CC,xx)
       r = (ff - yy) * ww
       print "  err: %s << %s << %s, %s, %s" % (r, ff, CC, xx, ww)
       return r
@@ -283,6 +392,25 @@ def fit_func(Funct, Data=None, Guess=None, Params=None,
   else:
     sqrtw = 1.0
 
+  if Jacobian != None:
+    def fun_jac(CC, xx, yy, ww):
+      """Computes the Jacobian of fun_err, i.e. the derivatives of the
+      weighted residuals with respect to the parameters."""
+      J = numpy.asarray(Jacobian(CC, xx))
+      if numpy.ndim(ww) > 0:
+        return J * ww[:,numpy.newaxis]
+      else:
+        return J * ww
+  else:
+    fun_jac = None
+
+  if Funct_hook == None and debug < 20 and y.ndim == 1 \
+     and method in ('fmin', 'fmin_bfgs', 'bfgs', 'anneal'):
+    # Allocation-free WSSR evaluation with preallocated buffers;
+    # see wpylib.math.fitting.residual
+    from wpylib.math.fitting.residual import residual_engine
+    fun_err2 = residual_engine(Funct, x, y, sqrtw).wssr
+
   # Full result is stored in rec
   rec = fit_result()
   extra_keys = {}
@@ -292,6 +420,7 @@ def fit_func(Funct, Data=None, Guess=None, Params=None,
     rslt = leastsq(fun_err,
                    x0=Guess, # initial coefficient guess
                    args=(x,y,sqrtw), # data onto which the function is fitted
+                   Dfun=fun_jac,
                    full_output=1,
                    **opts
                    )
@@ -300,6 +429,8 @@ def fit_func(Funct, Data=None, Guess=None, Params=None,
       # map the output values to the same keyword as other methods below:
       'funcalls': (lambda : rslt[2]['nfev']),
     }
+    if fun_jac != None:
+      extra_keys['njev'] = (lambda : rslt[2]['njev'])
     # Added estimate of fit parameter uncertainty (matching GNUPLOT parameter
     # uncertainty.
     # The error is estimated to be the diagonal of cov_x, multiplied by the WSSR
@@ -329,7 +460,62 @@ def fit_func(Funct, Data=None, Guess=None, Params=None,
                      **opts
                     )
     keys = ('xopt', 'fopt', 'funcalls', 'gradcalls', 'warnflag', 'allvecs')
+  elif method == 'least_squares':
+    # Trust-region reflective algorithm, with bounds and sparse Jacobians
+    from scipy.optimize import least_squares
+    ls_opts = dict(opts)
+    x0 = numpy.array(Guess, dtype=float)
+    if Bounds is not None:
+      ls_opts['bounds'] = Bounds
+      x0 = numpy.clip(x0, Bounds[0], Bounds[1])
+    if Jacobian != None:
+      sqrtw_full = numpy.ones(len(y)) * sqrtw
+      def fun_jac_ls(CC, xx, yy, ww):
+        J = Jacobian(CC, xx)
+        if scipy.sparse.issparse(J):
+          return scipy.sparse.diags(sqrtw_full).dot(J)
+        return numpy.asarray(J, dtype=float) * sqrtw_full[:,numpy.newaxis]
+      ls_opts['jac'] = fun_jac_ls
+    elif JacSparsity is not None:
+      ls_opts['jac_sparsity'] = JacSparsity
+    lsrec = least_squares(fun_err, x0,
+                          args=(x,y,sqrtw), # data onto which the function is fitted
+                          **ls_opts
+                         )
+    keys = ('xopt', 'lsrec')
+    rslt = (lsrec.x, lsrec)
+    if ls_opts.get('loss', 'linear') == 'linear':
+      chi_sqr = 2 * lsrec.cost
+    # map the output values to the same keyword as the other methods:
+    rec['funcalls'] = lsrec.nfev
+    if Jacobian != None:
+      rec['njev'] = lsrec.njev
+    rec['ier'] = lsrec.status
+    rec['mesg'] = lsrec.message
+    rec['active_mask'] = lsrec.active_mask
+    # Parameter uncertainties in the convention of leastsq (see above):
+    if outfmt == 0 and len(y) > len(lsrec.x):
+      J = lsrec.jac
+      if scipy.sparse.issparse(J):
+        # (the full covariance matrix may be too large to keep)
+        cov_diag = lsq_cov_diagonal(J)
+      else:
+        try:
+          rec['cov_x'] = numpy.linalg.inv(numpy.dot(J.T, J))
+          cov_diag = numpy.diagonal(rec['cov_x'])
+        except numpy.linalg.LinAlgError:
+          cov_diag = None
+      if cov_diag is not None:
+        NDF = len(y) - len(lsrec.x)
+        extra_keys['xerr'] = (lambda:
+            numpy.sqrt(numpy.abs(cov_diag) * rec['chi_square'] / NDF)
+        )
   elif method == 'anneal':
+    # removed from scipy 0.16 on
+    anneal = getattr(scipy.optimize, "anneal", None)
+    if anneal is None:
+      raise ValueError, \
+        "scipy.optimize.anneal is not available, cannot use `anneal' minimization method."
     rslt = anneal(fun_err2,
                   x0=Guess, # initial coefficient guess
                   args=(x,y,sqrtw), # data onto which the function is fitted
@@ -339,6 +525,14 @@ def fit_func(Funct, Data=None, Guess=None, Params=None,
     keys = ('xopt', 'fopt', 'T', 'funcalls', 'iter', 'accept', 'retval')
   elif use_lmfit:
     submethod = method.split(":",1)[1]
+    if fun_jac != None and submethod == 'leastsq':
+      # lmfit wants the Jacobian columns of the varying parameters only,
+      # in the order of its `var_names'.
+      var_names = [ k for k in Params if Params[k].vary and not Params[k].expr ]
+      if set(var_names) <= set(param_names):
+        var_idx = [ list(param_names).index(k) for k in var_names ]
+        opts = dict(opts)
+        opts['Dfun'] = lambda CC, xx, yy, ww: fun_jac(CC, xx, yy, ww)[:,var_idx]
     minrec = minimize(fun_err, Params,
                       args=(x,y,sqrtw),
                       method=submethod,
@@ -346,7 +540,8 @@ def fit_func(Funct, Data=None, Guess=None, Params=None,
                       full_output=1,
                       **opts
                      )
-   
+    # Newer lmfit versions return the fitted parameters as a copy:
+    Params = getattr(minrec, "params", Params)
     xopt = [ Params[k1].value for k1 in param_names ]
     keys = ('xopt', 'minobj', 'params')
     rslt = [ xopt, minrec, Params ]
@@ -453,7 +648,7 @@ class fit_func_base(object):
   - fit_method
   - fit_opts (a dict or multi_fit_opts object)
   - debug
-  - dbg_params
+  - instrument_mode
   - Params
 
   `fit_method' is a string containing the name of the fitting method to use,
@@ -464,6 +659,114 @@ class fit_func_base(object):
   - param_names: a list/tuple of parameter names, in the same order as in
     the legacy 'C' __call__ argument above.
 
+  ANALYTIC JACOBIAN
+
+  A derived class can provide the analytic derivatives of the function
+  with respect to its parameters via a method with this prototype:
+
+      def jacobian(self, C, x)
+
+  returning an array of shape (npoints, nparams).
+  The jacobian_stack() helper assembles the array from the list of
+  partial derivatives.
+  The analytic Jacobian is used by the fits only on request (opt-in):
+  setting `use_jacobian = True' (on the class or on the object) passes it
+  to the minimizer (see fit_func), which saves the function calls otherwise
+  spent on finite-difference derivatives (e.g. for morse2_fit_func on the
+  Cr2 data of the tests, 46 -> 11 calls).
+  The default is False, so that the fits reproduce the previous
+  (finite-difference) results to the last digit; the two agree well within
+  the parameter uncertainties.
+  The batched fits (wpylib.math.fitting.batch) and the warm start of
+  StochasticFitting use the analytic Jacobian whenever it is defined.
+  The eval_jacobian() method returns the analytic Jacobian if available,
+  or a finite-difference estimate otherwise.
+
+  BOUNDS AND SPARSE JACOBIANS
+
+  With fit_method = 'least_squares', the bounds on the parameters are
+  taken from the `param_bounds' attribute, a pair (lower, upper) of
+  per-parameter arrays (or scalars), e.g.
+
+      param_bounds = ((-numpy.inf, 0, 0, 0), numpy.inf)
+
+  An ansatz with many parameters, each of which affects only a part of the
+  data points (e.g. a global PES fit made of local terms), declares the
+  sparsity pattern of its Jacobian by overriding the method
+
+      def jac_sparsity(self, x)
+
+  which returns an (npoints, nparams) array or scipy.sparse matrix,
+  nonzero where the function value depends on the parameter.
+  See fit_func for details.
+  The other fit methods ignore both.
+  With use_varpro, only the bounds of the nonlinear parameters are
+  enforced.
+
+  INSTRUMENTATION
+
+  The fits and function evaluations are monitored by an instrument object
+  (the `instrument' attribute, created on first use from the class
+  attributes instrument_mode and instrument_ring_size).
+  The default mode ('counters') only counts the fits and the function calls
+  and measures the wall time of the fits; the 'ring' and 'trace' modes
+  also record the parameters of the function evaluations and the time spent
+  in them. See wpylib.math.fitting.instrument for details.
+  For backward compatibility, setting `dbg_params = 1' selects the 'trace'
+  mode, and dbg_params_log then refers to the parameter log of the last fit.
+  NOTE: dbg_params used to default to 1, i.e. the parameters of all the
+  function evaluations were logged unless turned off; it now defaults to 0,
+  so the parameter log must be requested explicitly.
+  Changes of dbg_params or instrument_mode take effect at the next fit,
+  unless the instrument object was assigned explicitly.
+  The instrument is resolved once per fit, and its on_call method is then
+  installed as func_call_hook (None in the 'off' mode), so a function
+  evaluation costs at most one extra call.
+  An instrument assigned explicitly is used from the next fit on.
+
+  MULTI-START FITTING
+
+  The fit_multistart() method repeats the fit from many starting points
+  (Latin hypercube or random perturbations of the standard guess), in a
+  pool of worker processes if desired, and keeps the best result.
+  This is a cure for the occasional convergence to a poor local minimum.
+  See wpylib.math.fitting.multistart.
+
+  PARAMETER SWEEPS
+
+  The fit_sweep() method fits an ordered sequence of related datasets,
+  seeding each fit with the previous solutions (extrapolated along the
+  sweep); see wpylib.math.fitting.sweep, which also provides the
+  multi-process fit_sweep_branches.
+
+  FIT CACHE
+
+  If the `fit_cache' attribute is set to a
+  wpylib.math.fitting.fit_cache.fit_cache object, the fit() method
+  returns the stored result for a previously seen combination of the
+  ansatz (class and attributes), data, guess, fit method and fit options,
+  instead of refitting.
+
+  VARIABLE PROJECTION
+
+  Many ansatzes have parameters that enter the function linearly, e.g.
+  the energy minimum E0 and the spring constant k of the PEC functions.
+  A derived class can declare them in the class attribute
+
+      linear_params = ('E0', 'k')
+
+  (which requires param_names to be defined as well).
+  With `use_varpro = True', the fit() method then optimizes only the
+  nonlinear parameters; the linear ones are solved in closed form
+  (weighted linear least squares) in every function evaluation.
+  The linear basis functions are obtained numerically from the function
+  itself (via eval_batch), so no extra code is needed in the derived class.
+  The final result (xopt, xerr, chi_square) is reported for the full set
+  of parameters; `funcalls' counts the evaluations by the outer (nonlinear)
+  minimizer.
+  Variable projection is not supported by the lmfit methods, which
+  ignore the use_varpro flag.
+
   The input-data-based automatic parameter guess is specified via Guess parameter.
   See wpylib.math.fitting.fit_func for detail.
 
@@ -476,6 +779,25 @@ class fit_func_base(object):
 
   Refer to various function objects in wpylib.math.fitting.funcs_simple
   for actual examples of how to use and create your own fit_func_base object.
+
+  BATCHED EVALUATION
+
+  The eval_batch(C, x) method evaluates the function for many parameter
+  sets at once; here C is a 2-D array of shape (nsamples, nparams), and
+  the result is an (nsamples, npoints) array.
+  By default this is done by calling the function once per parameter set.
+  A derived class can opt in to a single, vectorized evaluation by setting
+  the class attribute
+
+      batch_call = True
+
+  which declares that its __call__ method is broadcast-safe:
+  eval_batch will then call it once with `C' being an array of shape
+  (nparams, nsamples, 1), so that each parameter obtained via
+  get_params() is a column of shape (nsamples, 1), which broadcasts
+  against x[i] (of shape (npoints,)).
+  Plain elementwise numpy arithmetic (as used in the funcs_pec,
+  funcs_simple, and funcs_physics modules) satisfies this requirement.
   """
   class multi_fit_opts(dict):
     """A class for defining default control parameters for different fit methods.
@@ -490,8 +812,17 @@ class fit_func_base(object):
     leastsq=dict(xtol=1e-8, epsfcn=1e-6),
   )
   fit_default_opts["lmfit:leastsq"] = dict(xtol=1e-8, epsfcn=1e-6)
+  fit_default_opts["least_squares"] = dict(xtol=1e-8)
   debug = 0
-  dbg_params = 1
+  dbg_params = 0
+  instrument_mode = 'counters'
+  instrument_ring_size = 100
+  batch_call = False
+  use_jacobian = False
+  use_varpro = False
+  linear_params = ()
+  param_bounds = None
+  fit_cache = None
   fit_method = 'leastsq'  # changed 20150529 from fmin. Leastsq is much faster.
   fit_opts = fit_default_opts
   #fit_opts = dict(xtol=1e-5, maxfun=100000, maxiter=10000, disp=0)
@@ -501,20 +832,95 @@ class fit_func_base(object):
     if len(x.shape) == 1:
       # fix common "mistake" for 1-D domain: make it 2-D
       x = x.reshape((1, x.shape[0]))
-    if fit_opts == None:
-      # Use class default if it is available
-      fit_opts = getattr(self, "fit_opts", {})
-    if isinstance(fit_opts, self.multi_fit_opts):  # multiple choice :-)
-      fit_opts = fit_opts.get(self.fit_method, {})
+    fit_opts = self.fit_opts_effective(fit_opts)
     if Guess == None:
       Guess = getattr(self, "Guess", None)
-    if self.dbg_params:
-      self.dbg_params_log = []
     if self.debug >= 5:
       print "fit: Input Params = ", getattr(self, "Params", None)
+
+    cache = self.fit_cache
+    cache_key = None
+    if cache is not None:
+      try:
+        cache_key = cache.fit_key(self, x, y, dy, fit_opts, Guess)
+      except TypeError:
+        cache.uncacheable += 1
+    if cache_key is not None:
+      val = cache.lookup(cache_key)
+      if val is not None:
+        from wpylib.math.fitting.fit_cache import lmfit_params_restore
+        self.last_fit = fit_result(val['rec'])
+        if val['guess_params'] is not None:
+          self.guess_params = val['guess_params']
+        if val.get('params') is not None:
+          self.last_fit['params'] = lmfit_params_restore(val['params'])
+          if not hasattr(self, "Params"):
+            self.Params = self.last_fit['params']
+        return self.last_fit['xopt']
+      cache.misses += 1
+
+    I = self.bind_instrument_()
+    I.begin_fit()
+    if I.log_params:
+      self.dbg_params_log = I.params_log
+    try:
+      xopt = self.fit1_(x, y, dy=dy, fit_opts=fit_opts,
+                        Funct_hook=Funct_hook, Guess=Guess)
+    finally:
+      I.end_fit()
+    if cache_key is not None:
+      from wpylib.math.fitting.fit_cache import storable_record, \
+        lmfit_params_fitted_state
+      guess_params = getattr(self, "guess_params", None)
+      try:
+        cache.key(guess_params)
+      except TypeError:
+        guess_params = None
+      if self.use_lmfit_method:
+        params = lmfit_params_fitted_state(self.last_fit['params'])
+      else:
+        params = None
+      cache.store(cache_key, dict(rec=storable_record(self.last_fit),
+                                  guess_params=guess_params,
+                                  params=params))
+    return xopt
+
+  def fit_multistart(self, x, y, dy=None, nstarts=16, **opts):
+    """Multi-start fit: fits from nstarts starting points around the
+    standard guess, optionally in parallel, and keeps the best result.
+    See wpylib.math.fitting.multistart.fit_multistart for the options and
+    the diagnostic summary (stored in last_fit['multistart'])."""
+    from wpylib.math.fitting.multistart import fit_multistart
+    return fit_multistart(self, x, y, dy=dy, nstarts=nstarts, **opts)
+
+  def fit_sweep(self, datasets, coords=None, **opts):
+    """Continuation fit over an ordered sequence of (x, y, dy) datasets,
+    each fit starting from the (extrapolated) previous solutions.
+    See wpylib.math.fitting.sweep.fit_sweep for the options.
+    Returns the results as a numpy structured array."""
+    from wpylib.math.fitting.sweep import fit_sweep
+    return fit_sweep(self, datasets, coords=coords, **opts)
+
+  def fit1_(self, x, y, dy=None, fit_opts={}, Funct_hook=None, Guess=None):
+    """Performs the actual fit for the fit() method (bypassing the fit
+    cache); the arguments are already preprocessed."""
+    if self.use_varpro and self.linear_params and not self.use_lmfit_method:
+      return self.fit_varpro_(x, y, dy=dy, fit_opts=fit_opts,
+                              Funct_hook=Funct_hook, Guess=Guess)
+    if self.use_jacobian:
+      Jacobian = getattr(self, "jacobian", None)
+    else:
+      Jacobian = None
+    if self.fit_method == 'least_squares':
+      JacSparsity = self.jac_sparsity(x)
+    else:
+      JacSparsity = None
     self.last_fit = fit_func(
-                      Funct=self,
+                      Funct=self.get_instrument().timed(self),
                       Funct_hook=Funct_hook,
+                      Jacobian=Jacobian,
+                      Bounds=self.param_bounds,
+                      JacSparsity=JacSparsity,
                       x=x, y=y, dy=dy,
                       Guess=Guess,
                       Params=getattr(self, "Params", None),
@@ -528,14 +934,161 @@ class fit_func_base(object):
         self.Params = self.last_fit.params
     return self.last_fit['xopt']
 
+  def varpro_split_(self):
+    """Returns the indices of the nonlinear and linear parameters."""
+    names = list(self.param_names)
+    lin_idx = [ names.index(p) for p in self.linear_params ]
+    nl_idx = [ i for i in xrange(len(names)) if i not in lin_idx ]
+    return (nl_idx, lin_idx)
+
+  def varpro_solve_(self, Cnl, x, y, sqrtw, nl_idx, lin_idx):
+    """Solves for the linear parameters at a given set of nonlinear
+    parameters (Cnl) by weighted linear least squares.
+    Returns the full parameter vector and the function values."""
+    nparams = len(nl_idx) + len(lin_idx)
+    nlin = len(lin_idx)
+    # Row 0: all linear params zero; row j: the j-th linear param set to 1.
+    Cb = numpy.zeros((nlin+1, nparams))
+    Cb[:, nl_idx] = Cnl
+    Cb[numpy.arange(1, nlin+1), lin_idx] = 1.0
+    F = self.eval_batch(Cb, x)
+    f0 = F[0]
+    B = (F[1:] - f0).T
+    coef = numpy.linalg.lstsq(B * sqrtw[:,numpy.newaxis], (y - f0) * sqrtw)[0]
+    C = Cb[0]
+    C[lin_idx] = coef
+    return (C, f0 + numpy.dot(B, coef))
+
+  def fit_varpro_(self, x, y, dy=None, fit_opts={}, Funct_hook=None, Guess=None):
+    """Variable projection fit; see the class documentation.
+    Called by fit(); the arguments are already preprocessed."""
+    y = numpy.asarray(y, dtype=float)
+    (nl_idx, lin_idx) = self.varpro_split_()
+    if dy is not None:
+      sqrtw = 1.0 / numpy.asarray(dy, dtype=float)
+    else:
+      sqrtw = numpy.ones(len(y))
+    if Guess is None:
+      Guess = self.Guess_xy(x, y)
+    Guess = numpy.asarray(Guess, dtype=float)
+    if self.param_bounds is not None:
+      nl_bounds = tuple([ (numpy.ones(len(Guess)) * b)[nl_idx]
+                          for b in self.param_bounds ])
+    else:
+      nl_bounds = None
+
+    I = self.get_instrument()
+    last_C = [ Guess ]
+    def Funct(Cnl, xx):
+      (C, f) = self.varpro_solve_(Cnl, xx, y, sqrtw, nl_idx, lin_idx)
+      last_C[0] = C
+      I.record_params(C)
+      return f
+    if Funct_hook is not None:
+      def Funct_hook_nl(CC, xx, yy, ff, r):
+        return Funct_hook(last_C[0], xx, yy, ff, r)
+    else:
+      Funct_hook_nl = None
+
+    log_params = I.log_params
+    I.log_params = False  # the basis evaluations are not logged
+    try:
+      if nl_idx:
+        nl_fit = fit_func(Funct=I.timed(Funct),
+                          Funct_hook=Funct_hook_nl,
+                          Bounds=nl_bounds,
+                          x=x, y=y, dy=dy,
+                          Guess=Guess[nl_idx],
+                          method=self.fit_method,
+                          opts=fit_opts,
+                          debug=self.debug,
+                          outfmt=0,
+                         )
+        Funct(nl_fit['xopt'], x)
+        funcalls = nl_fit['funcalls']
+      else:
+        nl_fit = None
+        Funct([], x)
+        funcalls = 1
+    finally:
+      I.log_params = log_params
+
+    C = last_C[0]
+    resid = (self(C, x) - y) * sqrtw
+    chi_sqr = numpy.sum(resid**2)
+    rec = fit_result()
+    rec['xopt'] = C
+    rec['chi_square'] = chi_sqr
+    rec['funcalls'] = funcalls
+    rec['fit_method'] = self.fit_method
+    rec['varpro'] = True
+    rec['nl_fit'] = nl_fit
+    # Parameter uncertainties from the full Jacobian at the minimum,
+    # in the same convention as fit_func:
+    NDF = len(y) - len(C)
+    if NDF > 0:
+      J = self.eval_jacobian(C, x) * sqrtw[:,numpy.newaxis]
+      try:
+        cov = numpy.linalg.inv(numpy.dot(J.T, J))
+        rec['xerr'] = numpy.sqrt(numpy.abs(numpy.diagonal(cov)) * chi_sqr / NDF)
+      except numpy.linalg.LinAlgError:
+        pass
+    self.last_fit = rec
+    return rec['xopt']
+
+  def fit_opts_effective(self, fit_opts=None):
+    """Returns the dict of fit control options to be used for the current
+    fit_method, given the fit_opts argument of fit() (or the class default
+    if that is None)."""
+    if fit_opts == None:
+      # Use class default if it is available
+      fit_opts = getattr(self, "fit_opts", {})
+    if isinstance(fit_opts, self.multi_fit_opts):  # multiple choice :-)
+      fit_opts = fit_opts.get(self.fit_method, {})
+    return fit_opts
+
+  def get_instrument(self):
+    """Returns the instrument object of this function ansatz, creating
+    it on first use, or anew if the requested mode has changed since then.
+    An instrument assigned explicitly is always kept."""
+    I = self.__dict__.get("instrument")
+    if self.dbg_params:
+      mode = 'trace'
+    else:
+      mode = self.instrument_mode
+    if I is None or getattr(I, "auto_mode", mode) != mode:
+      from wpylib.math.fitting.instrument import make_instrument
+      I = self.instrument = make_instrument(mode, ring_size=self.instrument_ring_size)
+      I.auto_mode = mode
+    return I
+
+  def bind_instrument_(self):
+    """Resolves the instrument object (see get_instrument) and installs
+    its on_call method as the func_call_hook of this object, so that the
+    function evaluations notify it directly.
+    In the `off' mode, func_call_hook is set to None.
+    Called at the beginning of every fit.
+    Returns the instrument object."""
+    I = self.get_instrument()
+    if I.mode == 'off':
+      self.func_call_hook = None
+    else:
+      self.func_call_hook = I.on_call
+    return I
+
   def func_call_hook(self, C, x, y):
     """Common hook function called when calling 'THE'
-    function, e.g. for debugging purposes."""
-    from copy import copy
-    if self.dbg_params:
-      if not hasattr(self, "dbg_params_log"):
-        self.dbg_params_log = []
-      self.dbg_params_log.append(copy(C))
+    function, e.g. for debugging purposes.
+    Notifies the instrument object (see the class documentation).
+    This method is only used until the first fit (or the first function
+    evaluation), which replaces it by the instrument's own hook (see
+    bind_instrument_).
+    Function ansatzes should call it as
+
+        if self.func_call_hook: self.func_call_hook(C, x, y)
+    """
+    if self.bind_instrument_().mode != 'off':
+      self.func_call_hook(C, x, y)
     #print "Call morse2_fit_func(%s, %s) -> %s" % (C, x, y)
 
   def get_params(self, C, *names):
@@ -546,18 +1099,98 @@ class fit_func_base(object):
     In the legacy case, C is simply a tuple/list of numbers.
 
     In the lmfit case, C is a Parameters object.
+    (During fits, fit_func always passes a flat numpy array, even with
+    the lmfit methods, so the first test below takes care of nearly all
+    the calls.)
     """
-    try:
-      from lmfit import Parameters
-      # new way: using lmfit.Parameters:
-      if isinstance(C, Parameters):
-        return tuple(C[k].value for k in names)
-    except:
-      pass
+    if C.__class__ is numpy.ndarray:
+      return tuple(C)
+    # new way: using lmfit.Parameters:
+    if lmfit_Parameters is not None and isinstance(C, lmfit_Parameters):
+      return tuple([ C[k].value for k in names ])
 
     # old way: using positional parameters
     return tuple(C)
 
+  def jac_sparsity(self, x):
+    """Returns the sparsity pattern of the Jacobian at the domain points
+    x, for the least_squares fit method; None (the default) means a dense
+    Jacobian.
+    See the class documentation."""
+    return None
+
+  def eval_batch(self, C, x):
+    """Evaluates the function for many parameter sets at once.
+    C is a 2-D array of shape (nsamples, nparams); each row is a parameter
+    set.
+    Returns a 2-D array of shape (nsamples, npoints).
+    See the class documentation for the batch_call protocol.
+    """
+    C = numpy.asarray(C)
+    x = self.domain_array(x)
+    nsamples = C.shape[0]
+    npts = x.shape[1]
+    if self.batch_call:
+      y = self(C.T[:, :, numpy.newaxis], x)
+      rslt = numpy.empty((nsamples, npts), dtype=numpy.result_type(y, float))
+      rslt[...] = y
+    else:
+      rslt = None
+      for (i,Ci) in enumerate(C):
+        y = self(Ci, x)
+        if rslt is None:
+          rslt = numpy.empty((nsamples, npts), dtype=numpy.result_type(y, float))
+        rslt[i] = y
+      if rslt is None:
+        rslt = numpy.empty((0, npts))
+    return rslt
+
+  @staticmethod
+  def jacobian_stack(*derivs):
+    """Assembles the Jacobian array from the partial derivatives of the
+    function with respect to each parameter (in the parameter order).
+    The derivatives are broadcast against each other (so constants are
+    fine), and stacked along the last axis.
+    For the batched parameters (see eval_batch), the result has the shape
+    (nsamples, npoints, nparams).
+    """
+    derivs = numpy.broadcast_arrays(*derivs)
+    return numpy.concatenate([ d[..., numpy.newaxis] for d in derivs ], axis=-1)
+
+  def eval_jacobian(self, C, x, analytic=True, rel_step=1e-6):
+    """Evaluates the Jacobian (derivatives of the function values with
+    respect to the parameters) at parameter C, as an array of shape
+    (npoints, nparams).
+    Uses the analytic jacobian method, if available (and analytic=True);
+    otherwise, the central finite-difference estimate is computed.
+    """
+    x = self.domain_array(x)
+    jac = getattr(self, "jacobian", None)
+    if analytic and jac is not None:
+      return numpy.asarray(jac(C, x), dtype=float)
+    C = numpy.array(self.get_params(C, *getattr(self, "param_names", ())), dtype=float)
+    nparams = len(C)
+    h = rel_step * numpy.maximum(numpy.abs(C), 1.0)
+    dC = numpy.diag(h)
+    Y = self.eval_batch(numpy.concatenate((C + dC, C - dC)), x)
+    return ((Y[:nparams] - Y[nparams:]) / (2 * h[:,numpy.newaxis])).T
+
+  def worker_copy(self, keep=()):
+    """Returns a (shallow) working copy of this ansatz, for the fits done
+    on its behalf, e.g. in worker processes (see worker_pool).
+    The copy does not carry the per-fit state, the instrument and the
+    fit cache (see fit_cache.ansatz_volatile_attrs), except for the lmfit
+    Params and the attributes listed in `keep'."""
+    import copy
+    from wpylib.math.fitting.fit_cache import ansatz_volatile_attrs
+    func = copy.copy(self)
+    for attr in ansatz_volatile_attrs:
+      if attr != 'Params' and attr not in keep:
+        func.__dict__.pop(attr, None)
+    if 'fit_cache' not in keep:
+      func.fit_cache = None
+    return func
+
   @property
   def use_lmfit_method(self):
     return self.fit_method.startswith("lmfit:")
@@ -575,3 +1208,24 @@ class fit_func_base(object):
     return x
 
 
+# Process pools for the parallel fitting routines (multistart, sweep,
+# stochastic): the bulky shared arguments (e.g. the working copy of the
+# function ansatz) are sent once to every worker process, where the
+# worker function fetches them with worker_args().
+
+_worker_args = None
+
+def _worker_init(args):
+  global _worker_args
+  _worker_args = args
+
+def worker_args():
+  """Returns the shared arguments given to worker_pool, in a worker
+  process."""
+  return _worker_args
+
+def worker_pool(nproc, args):
+  """Creates a multiprocessing pool of nproc worker processes, sharing
+  the arguments `args' (see worker_args)."""
+  import multiprocessing
+  return multiprocessing.Pool(nproc, initializer=_worker_init, initargs=(args,))
@@ -0,0 +1,273 @@
+#
+# wpylib.math.fitting.fit_cache module
+# Created: 20261019
+# Wirawan Purwanto
+#
+
+"""
+wpylib.math.fitting.fit_cache module
+Caching of curve fitting results.
+
+A fit_cache object remembers the results of fit_func calls (or of the
+fit method of fit_func_base objects), keyed on everything that
+determines the outcome of the fit:
+
+- the function ansatz: its class (or function) identity, its instance
+  attributes (i.e. the ansatz parameters), the lmfit Params (if any), and
+  the value-like attributes of its class and base classes (e.g.
+  fit_method, use_jacobian, use_varpro, linear_params, or the constants
+  used by Guess_xy); the class attributes that cannot be hashed (such as
+  the methods), and the debugging and instrumentation settings, are left
+  out;
+- the input data (x, y, and dy or w) and the initial guess;
+- the fit method and the fit control options in effect.
+
+The results are kept in an in-memory LRU store, optionally backed by an
+HDF5 file (via wpylib.db.hdf5_cache), so that they survive across python
+sessions.
+
+Usage:
+
+    from wpylib.math.fitting.fit_cache import fit_cache
+    cache = fit_cache("fits-cache.h5", version=1)
+
+    # with fit_func:
+    rec = fit_func(func, x=x, y=y, dy=dy, outfmt=0, cache=cache)
+
+    # with fit_func_base objects:
+    func = morse2_fit_func()
+    func.fit_cache = cache
+    func.fit(x, y, dy)
+
+Only the "value-like" fields of the fit result (numbers, strings, numpy
+arrays, and containers thereof; e.g. xopt, xerr, chi_square, funcalls) are
+cached; the other fields (such as the lmfit minimizer objects) are dropped.
+On a cache hit, the Funct_hook and the instrumentation of the fit
+are skipped, since the function is not called at all.
+For lmfit fits, the fitted Parameters are cached as well: they are
+restored into last_fit.params (and into the Params attribute of the
+ansatz, if it has none, as fit() does).
+
+As with hdf5_memoize, invalidation is explicit: bump the `version` tag
+when the code of the ansatzes or the minimizer changes the results.
+Calls with arguments that cannot be hashed (e.g. arbitrary objects as
+ansatz attributes) are simply not cached.
+"""
+
+import copy
+import inspect
+import numpy
+from collections import OrderedDict
+
+from wpylib.db.hdf5_cache import memo_hash, func_identity, hdf5_memo_function
+from wpylib.math.fitting import fit_result
+
+# Instance attributes of fit_func_base objects that do not affect the
+# outcome of a fit:
+ansatz_volatile_attrs = ('dbg_params_log', 'last_fit', 'guess_params',
+                         'fit_cache', 'instrument', 'func_call_hook', 'Params')
+# Class-level attributes that do not (the fit options are part of the key
+# on their own):
+ansatz_class_ignored_attrs = ('debug', 'dbg_params', 'instrument_mode',
+                              'instrument_ring_size', 'fit_opts',
+                              'fit_default_opts')
+
+
+def lmfit_params_state(Params):
+  """Returns a value-like representation of an lmfit Parameters object."""
+  if Params is None:
+    return None
+  return tuple([ (k, Params[k].value, Params[k].vary, Params[k].min,
+                  Params[k].max, Params[k].expr)
+                 for k in Params ])
+
+
+def lmfit_params_fitted_state(Params):
+  """Returns a value-like representation of fitted lmfit Parameters
+  (lmfit_params_state, plus the standard errors)."""
+  return tuple([ (k, Params[k].value, Params[k].vary, Params[k].min,
+                  Params[k].max, Params[k].expr, Params[k].stderr)
+                 for k in Params ])
+
+
+def lmfit_params_restore(state):
+  """Creates an lmfit Parameters object from lmfit_params_fitted_state."""
+  from wpylib.math.fitting import lmfit_Parameters
+  Params = lmfit_Parameters()
+  for (k, value, vary, pmin, pmax, expr, stderr) in state:
+    Params.add(k, value=value, vary=vary, min=pmin, max=pmax, expr=expr)
+  for (k, value, vary, pmin, pmax, expr, stderr) in state:
+    Params[k].stderr = stderr
+  return Params
+
+
+def ansatz_class_state(cls):
+  """Returns the value-like attributes of an ansatz class and its base
+  classes (see the module documentation) as a dict."""
+  state = {}
+  for C in reversed(inspect.getmro(cls)):
+    for (k,v) in C.__dict__.iteritems():
+      if k.startswith("_") or k in ansatz_volatile_attrs \
+         or k in ansatz_class_ignored_attrs:
+        continue
+      # (a derived class may override a value by a method and vice versa)
+      state.pop(k, None)
+      if callable(v) or isinstance(v, (property, staticmethod, classmethod)):
+        continue
+      try:
+        memo_hash(v)
+      except TypeError:
+        continue
+      state[k] = v
+  return state
+
+
+def ansatz_state(func):
+  """Returns a value-like representation of a function ansatz (a plain
+  function or a fit_func_base-like object), to be used in the cache key.
+  """
+  if not hasattr(func, "__dict__") or hasattr(func, "__code__") \
+     or hasattr(func, "im_func"):
+    # plain function or bound method
+    return func_identity(func)
+  state = {}
+  for (k,v) in func.__dict__.iteritems():
+    if k not in ansatz_volatile_attrs and not k.startswith("_"):
+      state[k] = v
+  state['Params'] = lmfit_params_state(getattr(func, "Params", None))
+  return (func_identity(type(func)), ansatz_class_state(type(func)), state)
+
+
+def storable_record(rec):
+  """Returns the value-like (hashable, HDF5-storable) fields of a fit
+  result as a plain dict."""
+  out = {}
+  for (k,v) in rec.iteritems():
+    try:
+      memo_hash(v)
+    except TypeError:
+      continue
+    out[k] = v
+  return out
+
+
+class fit_cache(object):
+  """Cache of fit results; see the module documentation.
+
+  Statistics counters (attributes):
+  - hits: number of results served from memory
+  - disk_hits: number of results served from the HDF5 file
+  - misses: number of fits actually performed
+  - uncacheable: number of fits whose input cannot be hashed
+  """
+  def __init__(self, filename=None, version=None, max_entries=1000,
+               max_disk_entries=None, max_disk_bytes=None):
+    self.max_entries = max_entries
+    self.mem = OrderedDict()
+    if filename is not None:
+      self.disk = hdf5_memo_function(None, filename, version=version,
+                                     max_entries=max_disk_entries,
+                                     max_bytes=max_disk_bytes,
+                                     name="wpylib.math.fitting.fit_cache")
+    else:
+      self.disk = None
+    self.version = version
+    self.reset_stats()
+
+  def reset_stats(self):
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self.uncacheable = 0
+
+  def stats(self):
+    """Returns the cache statistics as a dict."""
+    return dict(hits=self.hits, disk_hits=self.disk_hits,
+                misses=self.misses, uncacheable=self.uncacheable)
+
+  def __len__(self):
+    return len(self.mem)
+
+  def clear(self):
+    """Removes all cached results, in memory and on disk."""
+    self.mem.clear()
+    if self.disk is not None:
+      self.disk.clear()
+
+  def key(self, *args):
+    """Computes the cache key of a set of value-like arguments.
+    Raises TypeError if they cannot be hashed."""
+    return memo_hash(repr(self.version), args)
+
+  def lookup(self, key):
+    """Returns the cached value for a key, or None."""
+    if key in self.mem:
+      val = self.mem.pop(key)
+      self.mem[key] = val  # most recently used
+      self.hits += 1
+      return copy.deepcopy(val)
+    if self.disk is not None:
+      (found, val) = self.disk.lookup(key)
+      if found:
+        self.disk_hits += 1
+        self.store_mem_(key, val)
+        return copy.deepcopy(val)
+    return None
+
+  def store_mem_(self, key, val):
+    self.mem[key] = val
+    while self.max_entries is not None and len(self.mem) > self.max_entries:
+      self.mem.popitem(last=False)
+
+  def store(self, key, val):
+    """Stores a (value-like) value under a given key."""
+    val = copy.deepcopy(val)
+    self.store_mem_(key, val)
+    if self.disk is not None:
+      self.disk.store(key, val)
+
+  def fit_func(self, Funct, Data=None, Guess=None, Params=None,
+               x=None, y=None, w=None, dy=None, outfmt=1,
+               Jacobian=None, Bounds=None, JacSparsity=None,
+               method='leastsq', opts={}, **kwargs):
+    """Cached version of wpylib.math.fitting.fit_func, with the same
+    arguments (except the cache argument itself)."""
+    from wpylib.math.fitting import fit_func
+    def fit():
+      return fit_func(Funct, Data=Data, Guess=Guess, Params=Params,
+                      x=x, y=y, w=w, dy=dy, outfmt=0,
+                      Jacobian=Jacobian, Bounds=Bounds, JacSparsity=JacSparsity,
+                      method=method, opts=opts, **kwargs)
+    try:
+      key = self.key("fit_func", ansatz_state(Funct), Data, x, y, w, dy, Guess,
+                     lmfit_params_state(Params), method, opts,
+                     None if Jacobian is None else func_identity(Jacobian),
+                     Bounds, JacSparsity)
+    except TypeError:
+      self.uncacheable += 1
+      rec = fit()
+    else:
+      lmfit = method.startswith("lmfit:")
+      val = self.lookup(key)
+      if val is not None:
+        rec = fit_result(val)
+        if lmfit:
+          rec['params'] = lmfit_params_restore(rec['params'])
+      else:
+        self.misses += 1
+        rec = fit()
+        val = storable_record(rec)
+        if lmfit:
+          val['params'] = lmfit_params_fitted_state(rec['params'])
+        self.store(key, val)
+
+    if outfmt == 0:
+      return rec
+    elif outfmt == 1:
+      return rec['xopt']
+    else:
+      raise ValueError, "Invalid `outfmt' argument = %s" % (outfmt,)
+
+  def fit_key(self, func, x, y, dy, fit_opts, Guess):
+    """Cache key for the fit method of a fit_func_base object."""
+    return self.key("fit", ansatz_state(func), x, y, dy, Guess, fit_opts)
@@ -34,13 +34,19 @@ class harm_fit_func(fit_func_base):
   * C[2] = r0 = equilibrium distance
   """
   dim = 1  # a function with 1-D domain
+  batch_call = True
   param_names = ('E0', 'k', 'r0')
+  linear_params = ('E0', 'k')
   def __call__(self, C, x):
     E0, k, r0 = self.get_params(C, *(self.param_names))
     xdisp = (x[0] - r0)
     y = E0 + 0.5 * k * xdisp**2
-    self.func_call_hook(C, x, y)
+    if self.func_call_hook: self.func_call_hook(C, x, y)
     return y
+  def jacobian(self, C, x):
+    E0, k, r0 = self.get_params(C, *(self.param_names))
+    xdisp = (x[0] - r0)
+    return self.jacobian_stack(1.0, 0.5 * xdisp**2, -k * xdisp)
   def Guess_xy(self, x, y):
     fit_rslt = fit_harm(x[0], y)
     self.guess_params = tuple(fit_rslt[0])
@@ -62,13 +68,21 @@ class harmcube_fit_func(fit_func_base):
   * C[3] = nonlinear (cubic) constant
   """
   dim = 1  # a function with 1-D domain
+  batch_call = True
   param_names = ('E0', 'k', 'r0', 'c3')
+  linear_params = ('E0', 'k', 'c3')
   def __call__(self, C, x):
     E0, k, r0, c3 = self.get_params(C, *(self.param_names))
     xdisp = (x[0] - r0)
     y = E0 + 0.5 * k * xdisp**2 + c3 * xdisp**3
-    self.func_call_hook(C, x, y)
+    if self.func_call_hook: self.func_call_hook(C, x, y)
     return y
+  def jacobian(self, C, x):
+    E0, k, r0, c3 = self.get_params(C, *(self.param_names))
+    xdisp = (x[0] - r0)
+    return self.jacobian_stack(1.0, 0.5 * xdisp**2,
+                               -k * xdisp - 3 * c3 * xdisp**2,
+                               xdisp**3)
   def Guess_xy(self, x, y):
     fit_rslt = fit_harm(x[0], y)
     self.guess_params = tuple(fit_rslt[0]) + (0,)
@@ -93,13 +107,25 @@ class morse2_fit_func(fit_func_base):
   * C[3] = a  = nonlinear constant
   """
   dim = 1  # a function with 1-D domain
+  batch_call = True
   param_names = ('E0', 'k', 'r0', 'a')
+  linear_params = ('E0', 'k')
   def __call__(self, C, x):
     from numpy import exp
     E0, k, r0, a = self.get_params(C, *(self.param_names))
     y = E0 + 0.5 * k / a**2 * (1 - exp(-a * (x[0] - r0)))**2
-    self.func_call_hook(C, x, y)
+    if self.func_call_hook: self.func_call_hook(C, x, y)
     return y
+  def jacobian(self, C, x):
+    from numpy import exp
+    E0, k, r0, a = self.get_params(C, *(self.param_names))
+    xdisp = (x[0] - r0)
+    X = exp(-a * xdisp)
+    E = 1 - X
+    return self.jacobian_stack(1.0,
+                               0.5 / a**2 * E**2,
+                               -k / a * E * X,
+                               -k / a**3 * E**2 + k / a**2 * E * X * xdisp)
   def Guess_xy(self, x, y):
     imin = numpy.argmin(y)
     harm_params = fit_harm(x[0], y)
@@ -129,14 +155,28 @@ class ext3Bmorse2_fit_func(fit_func_base):
   * C[4] = C3 = coefficient of cubic term
   """
   dim = 1  # a function with 1-D domain
+  batch_call = True
   param_names = ('E0', 'k', 'r0', 'a', 'C3')
+  linear_params = ('E0', 'k', 'C3')
   def __call__(self, C, x):
     from numpy import exp
     E0, k, r0, a, C3 = self.get_params(C, *(self.param_names))
     E = 1 - exp(-a * (x[0] - r0))
     y = E0 + 0.5 * k / a**2 * E**2 + C3 * E**3
-    self.func_call_hook(C, x, y)
+    if self.func_call_hook: self.func_call_hook(C, x, y)
     return y
+  def jacobian(self, C, x):
+    from numpy import exp
+    E0, k, r0, a, C3 = self.get_params(C, *(self.param_names))
+    xdisp = (x[0] - r0)
+    X = exp(-a * xdisp)
+    E = 1 - X
+    return self.jacobian_stack(1.0,
+                               0.5 / a**2 * E**2,
+                               -k / a * E * X - 3 * C3 * a * E**2 * X,
+                               -k / a**3 * E**2 + k / a**2 * E * X * xdisp
+                                 + 3 * C3 * E**2 * X * xdisp,
+                               E**3)
   def Guess_xy(self, x, y):
     imin = numpy.argmin(y)
     harm_params = fit_harm(x[0], y)
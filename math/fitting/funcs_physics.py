@@ -32,7 +32,9 @@ class FermiDirac_fit_func(fit_func_base):
   * C[2] = "smearing temperature"
   """
   dim = 1  # a function with 1-D domain
+  batch_call = True
   param_names = ('A', 'F', 'T')
+  linear_params = ('A',)
   # FIXME: Not good yet!!!
   F_guess = 1.9
   T_guess = 0.05
@@ -40,7 +42,7 @@ class FermiDirac_fit_func(fit_func_base):
     from numpy import exp
     A, F, T = self.get_params(C, *(self.param_names))
     y = A * (exp((x[0] - F) / T) + 1)**(-1)
-    self.func_call_hook(C, x, y)
+    if self.func_call_hook: self.func_call_hook(C, x, y)
     return y
   def Guess_xy(self, x, y):
     imin = numpy.argmin(y)
@@ -13,6 +13,11 @@ Legacy examples for 2-D polynomial function ansatz for fitting.
 Newer applications should
 """
 
+import numpy
+import numpy.linalg
+
+from wpylib.math.fitting import fit_result
+
 
 class Poly_base(object):
   """Typical base class for a function to fit a polynomial. (?)
@@ -24,6 +29,25 @@ class Poly_base(object):
     A 2-dimensional (y vs x) fitting will have dim==1.
     A 3-dimensional (z vs (x,y)) fitting will have dim==2.
     And so on.
+
+  The polynomial is represented by its design matrix, i.e. the values of
+  the basis functions (monomials) at the domain points (one row per point,
+  one column per coefficient), such that
+
+      f(C, x) = dot(design_matrix(x), C)
+
+  The default design_matrix is for the polynomial without cross terms,
+  whose coefficients are ordered as
+
+      C[0] + sum_i (C[i*order+1] * x[i] + ... + C[i*order+order] * x[i]**order)
+
+  Derived classes with other basis functions must redefine design_matrix
+  and NParams.
+
+  These polynomials are linear in their coefficients.
+  Thus they can be fitted in closed form (a single weighted linear
+  least-squares solve) by the linear_fit method, bypassing the nonlinear
+  fit_func machinery altogether.
   """
   # Must set the following:
   # * order = ?
@@ -46,52 +70,140 @@ class Poly_base(object):
     '''Default NParams for polynomial without cross term.'''
     return 1 + self.order*self.dim
 
+  def domain_array(self, x):
+    """Converts the domain points to a 2-D float array of shape
+    (dim, npoints)."""
+    x = numpy.asarray(x, dtype=float)
+    if x.ndim == 1:
+      x = x.reshape((self.dim, -1))
+    return x
+
+  def design_matrix(self, x):
+    """Returns the design matrix (npoints, NParams) of the polynomial
+    without cross terms."""
+    x = self.domain_array(x)
+    (ndim, npts) = x.shape
+    D = numpy.empty((npts, 1 + self.order*ndim))
+    D[:,0] = 1.0
+    for i in xrange(ndim):
+      xp = D[:,i*self.order+1] = x[i]
+      for p in xrange(2, self.order+1):
+        xp = D[:,i*self.order+p] = xp * x[i]
+    return D
+
+  def __call__(self, C, x):
+    return numpy.dot(self.design_matrix(x), C)
+
+  def jacobian(self, C, x):
+    """The derivatives with respect to the coefficients, which is simply
+    the design matrix."""
+    return self.design_matrix(x)
+
+  def linear_fit(self, x, y, dy=None, w=None, method='qr'):
+    """Fits the polynomial coefficients by weighted linear least squares.
+
+    y can be a 1-D array of npoints values, or a 2-D array of shape
+    (K, npoints), i.e. K datasets on the same domain points, which are
+    all fitted in a single solve.
+    Only one of dy (error bars) or w (weights) can be specified.
+    The solver `method` is either 'qr' (the default) or 'lstsq' (via SVD;
+    slower, but tolerates rank-deficient design matrices).
+
+    Returns a fit_result object (also stored as `last_fit`) with:
+    * xopt: the fitted coefficients, (NParams,) or (K, NParams)
+    * chi_square: the weighted sum of the squared residuals, scalar or (K,)
+    * cov: the covariance matrix of the coefficients, scaled by
+      chi_square / NDF (matching the xerr convention of fit_func),
+      (NParams, NParams) or (K, NParams, NParams)
+    * xerr: the coefficient uncertainties, sqrt(diag(cov))
+    """
+    if w is not None and dy is not None:
+      raise TypeError, "Only one of w or dy can be specified."
+    D = self.design_matrix(x)
+    (npts, nparams) = D.shape
+    y = numpy.asarray(y, dtype=float)
+    single = (y.ndim == 1)
+    Y = numpy.atleast_2d(y).T    # (npoints, K)
+    if dy is not None:
+      sqrtw = 1.0 / numpy.asarray(dy, dtype=float)
+    elif w is not None:
+      sqrtw = numpy.sqrt(numpy.asarray(w, dtype=float))
+    else:
+      sqrtw = numpy.ones(npts)
+    sqrtw = numpy.ones(npts) * sqrtw
+    A = D * sqrtw[:,numpy.newaxis]
+    B = Y * sqrtw[:,numpy.newaxis]
+
+    if method == 'qr':
+      (Q, R) = numpy.linalg.qr(A)
+      X = numpy.linalg.solve(R, numpy.dot(Q.T, B))
+      Rinv = numpy.linalg.inv(R)
+      cov0 = numpy.dot(Rinv, Rinv.T)
+    elif method == 'lstsq':
+      X = numpy.linalg.lstsq(A, B)[0]
+      cov0 = numpy.linalg.pinv(numpy.dot(A.T, A))
+    else:
+      raise ValueError, "Unsupported linear_fit method: %s" % method
+
+    resid = numpy.dot(A, X) - B
+    chi2 = numpy.sum(resid**2, axis=0)    # (K,)
+    NDF = npts - nparams
+    if NDF > 0:
+      cov = cov0[numpy.newaxis,:,:] * (chi2 / NDF)[:,numpy.newaxis,numpy.newaxis]
+    else:
+      cov = numpy.tile(cov0, (len(chi2), 1, 1)) * numpy.nan
+    xerr = numpy.sqrt(numpy.diagonal(cov, axis1=1, axis2=2))
+
+    rec = fit_result()
+    if single:
+      rec['xopt'] = X[:,0]
+      rec['chi_square'] = chi2[0]
+      rec['cov'] = cov[0]
+      rec['xerr'] = xerr[0]
+    else:
+      rec['xopt'] = X.T
+      rec['chi_square'] = chi2
+      rec['cov'] = cov
+      rec['xerr'] = xerr
+    rec['fit_method'] = 'linear:' + method
+    self.last_fit = rec
+    return rec
+
 
 class Poly_order2(Poly_base):
   """Multidimensional polynomial of order 2 without cross terms."""
   order = 2
-  def __call__(self, C, x):
-    return C[0] \
-      + sum([ C[i*2+1] * x[i] + C[i*2+2] * x[i]**2 \
-              for i in xrange(len(x)) ])
 
 
 class Poly_order2_only(Poly_base):
   """Multidimensional polynomial of order 2 without cross terms.
   The linear terms are deleted."""
   order = 1 # HACK: the linear term is deleted
-  def __call__(self, C, x):
-    return C[0] \
-      + sum([ C[i+1] * x[i]**2 \
-              for i in xrange(len(x)) ])
+  def design_matrix(self, x):
+    x = self.domain_array(x)
+    return numpy.concatenate((numpy.ones((1, x.shape[1])), x**2)).T
 
 
 class Poly_order2x_only(Poly_base):
   '''Multidimensional order-2-only polynomial with all the cross terms.'''
   order = 2 # but not used
-  def __call__(self, C, x):
-    ndim = self.dim
-    # Reorganize the coeffs in the form of symmetric square matrix
+  def design_matrix(self, x):
+    # The coefficients form a symmetric square matrix Cmat, such that
+    # f = C[0] + x^T . Cmat . x;
     # For 4x4 it will become like:
     #   [ 1,  5,  6,  7]
     #   [ 5,  2,  8,  9]
     #   [ 6,  8,  3, 10]
     #   [ 7,  9, 10,  4]
-    Cmat = numpy.diag(C[1:ndim+1])
-    j = ndim+1
-    for r in xrange(0, ndim-1):
-      jnew = j + ndim - 1 - r
-      Cmat[r, r+1:] = C[j:jnew]
-      Cmat[r+1:, r] = C[j:jnew]
-      j = jnew
-    #print Cmat
-    #print x
-    nrec = len(x[0]) # assume a 2-D array
-    rslt = numpy.empty((nrec,), dtype=numpy.float64)
-    for r in xrange(nrec):
-      rslt[r] = C[0] \
-              + numpy.sum( Cmat * numpy.outer(x[:,r], x[:,r]) )
-    return rslt
+    # The off-diagonal coefficients appear twice, hence the factor of 2
+    # for the cross terms.
+    x = self.domain_array(x)
+    ndim = x.shape[0]
+    xx = numpy.einsum('in,jn->ijn', x, x)
+    (rows, cols) = numpy.triu_indices(ndim, 1)
+    return numpy.concatenate((numpy.ones((1, x.shape[1])),
+                              xx[numpy.arange(ndim), numpy.arange(ndim)],
+                              2 * xx[rows, cols])).T
 
   def NParams(self):
     # 1 is for the constant term
@@ -102,18 +214,10 @@ class Poly_order3(Poly_base):
   """Multidimensional polynomial of order 3 without cross terms.
   The linear terms are deleted."""
   order = 3
-  def __call__(self, C, x):
-    return C[0] \
-         + sum([ C[i*3+1] * x[i] + C[i*3+2] * x[i]**2 + C[i*3+3] * x[i]**3 \
-                 for i in xrange(len(x)) ])
 
 class Poly_order4(Poly_base):
   """Multidimensional polynomial of order 4 without cross terms.
   The linear terms are deleted."""
   order = 4
-  def __call__(self, C, x):
-    return C[0] \
-         + sum([ C[i*4+1] * x[i] + C[i*4+2] * x[i]**2 + C[i*4+3] * x[i]**3 + C[i*4+4] * x[i]**4 \
-                 for i in xrange(len(x)) ])
 
 
@@ -74,12 +74,15 @@ class const_fit_func(fit_func_base):
   * C[0] = the constant sought
   """
   dim = 1  # a function with 1-D domain
+  batch_call = True
   param_names = ('c')
   def __call__(self, C, x):
     from numpy import exp
     y = C[0]
-    self.func_call_hook(C, x, y)
+    if self.func_call_hook: self.func_call_hook(C, x, y)
     return y
+  def jacobian(self, C, x):
+    return self.jacobian_stack(numpy.ones_like(x[0]))
   def Guess_xy(self, x, y):
     self.guess_params = (numpy.average(y),)
     return self.guess_params
@@ -98,11 +101,15 @@ class linear_fit_func(fit_func_base):
   * C[1] = b
   """
   dim = 1  # a function with 1-D domain
+  batch_call = True
   param_names = ('a', 'b')
+  linear_params = ('a', 'b')
   def __call__(self, C, x):
     y = C[0] + C[1] * x[0]
-    self.func_call_hook(C, x, y)
+    if self.func_call_hook: self.func_call_hook(C, x, y)
     return y
+  def jacobian(self, C, x):
+    return self.jacobian_stack(1.0, x[0])
   def Guess_xy(self, x, y):
     fit_rslt = fit_linear(x[0], y)
     self.guess_params = tuple(fit_rslt[0])
@@ -137,7 +144,9 @@ class exp_fit_func(fit_func_base):
   * C[2] = offset
   """
   dim = 1  # a function with 1-D domain
+  batch_call = True
   param_names = ['A', 'B', 'x0']
+  linear_params = ('A',)
   # FIXME: AD HOC PARAMETERS!
   A_guess =  -2.62681
   B_guess =  -9.05046
@@ -146,8 +155,14 @@ class exp_fit_func(fit_func_base):
     from numpy import exp
     A, B, x0 = self.get_params(C, *(self.param_names))
     y = A * exp(B * (x[0] - x0))
-    self.func_call_hook(C, x, y)
+    if self.func_call_hook: self.func_call_hook(C, x, y)
     return y
+  def jacobian(self, C, x):
+    from numpy import exp
+    A, B, x0 = self.get_params(C, *(self.param_names))
+    xdisp = (x[0] - x0)
+    X = exp(B * xdisp)
+    return self.jacobian_stack(X, A * X * xdisp, -A * B * X)
   def Guess_xy(self, x, y):
     from numpy import abs
     #y_abs = abs(y)
@@ -161,11 +176,12 @@ class exp_fit_func(fit_func_base):
 class expm_fit_func(exp_fit_func):
   """Similar to exp_fit_func but the exponent is always negative.
   """
+  jacobian = None  # abs(B) is not differentiable at B=0
   def __call__(self, C, x):
     from numpy import exp,abs
     A, B, x0 = self.get_params(C, *(self.param_names))
     y = A * exp(-abs(B) * (x[0] - x0))
-    self.func_call_hook(C, x, y)
+    if self.func_call_hook: self.func_call_hook(C, x, y)
     return y
 
 
@@ -183,7 +199,9 @@ class powx_fit_func(fit_func_base):
   * C[2] = offset
   """
   dim = 1  # a function with 1-D domain
+  batch_call = True
   param_names = ['A', 'B', 'x0']
+  linear_params = ('A',)
   # FIXME: AD HOC PARAMETERS!
   A_guess =  -2.62681
   B_guess =  -9.05046
@@ -192,8 +210,14 @@ class powx_fit_func(fit_func_base):
     from numpy import exp
     A, B, x0 = self.get_params(C, *(self.param_names))
     y = A * (x[0] - x0)**B
-    self.func_call_hook(C, x, y)
+    if self.func_call_hook: self.func_call_hook(C, x, y)
     return y
+  def jacobian(self, C, x):
+    from numpy import log
+    A, B, x0 = self.get_params(C, *(self.param_names))
+    xdisp = (x[0] - x0)
+    X = xdisp**B
+    return self.jacobian_stack(X, A * X * log(xdisp), -A * B * X / xdisp)
   def Guess_xy(self, x, y):
     from numpy import abs
     #y_abs = abs(y)
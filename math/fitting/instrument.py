@@ -0,0 +1,233 @@
+#
+# wpylib.math.fitting.instrument module
+# Created: 20261019
+# Wirawan Purwanto
+#
+
+"""
+wpylib.math.fitting.instrument module
+Bounded-memory instrumentation of curve fitting.
+
+Every fit_func_base object carries an instrument object (attribute
+`instrument', created on first use), which is notified at the beginning
+and end of each fit and on every function evaluation (its on_call method
+is installed as fit_func_base.func_call_hook at the beginning of each
+fit).
+The following instrumentation modes are available:
+
+* `off'
+  Nothing is recorded.
+
+* `counters' (the default)
+  Counts the fits and function evaluations and accumulates the wall time
+  of the fits. The per-call cost is a single integer increment.
+
+* `ring'
+  In addition to the counters, keeps the parameters of the last
+  `ring_size' function evaluations, and the statistics of the last
+  `ring_size' fits, in ring buffers (collections.deque).
+
+* `trace'
+  Full trace: keeps the parameters of all the function evaluations of the
+  current fit (this is the old dbg_params_log behavior), and the
+  statistics of all the fits.
+
+The time spent in the function evaluations (the residual evaluation cost)
+is measured if `time_calls' is enabled; this is the default for the
+ring and trace modes only, since it wraps every function evaluation in an
+extra python call.
+
+Usage:
+
+    from wpylib.math.fitting.instrument import make_instrument
+    func = morse2_fit_func()
+    func.instrument = make_instrument('ring', ring_size=50)
+    func.fit(x, y, dy)
+    print func.instrument.last_fit_stats
+    print func.instrument.stats()
+
+The mode for all objects of a class can also be selected via the class
+attributes fit_func_base.instrument_mode and instrument_ring_size.
+"""
+
+import time
+from collections import deque
+from copy import copy
+
+timer = time.time
+
+
+class timed_funct(object):
+  """Wraps a function ansatz to measure the time spent in its evaluations.
+  All the other attributes are those of the wrapped object."""
+  def __init__(self, func, instrument):
+    self.func = func
+    self.instrument = instrument
+
+  def __call__(self, C, x):
+    t0 = timer()
+    y = self.func(C, x)
+    self.instrument.eval_time += timer() - t0
+    return y
+
+  def __getattr__(self, attr):
+    return getattr(self.func, attr)
+
+
+class fit_instrument(object):
+  """Base instrument class; records nothing (the `off' mode).
+  Derived classes override the begin_fit, end_fit, and on_call methods."""
+  mode = 'off'
+  time_calls = False
+  log_params = False
+  params_log = None
+  last_fit_stats = None
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.nfits = 0
+    self.ncalls = 0
+    self.fit_time = 0.0
+    self.eval_time = 0.0
+
+  def begin_fit(self):
+    pass
+
+  def end_fit(self):
+    pass
+
+  def on_call(self, C, x, y):
+    pass
+
+  def record_params(self, C):
+    """Records a parameter set explicitly (used where the logged
+    parameters differ from those passed to the function itself, e.g. in
+    the variable projection fit)."""
+    pass
+
+  def timed(self, func):
+    """Returns the function ansatz, wrapped for timing if time_calls
+    is enabled."""
+    if self.time_calls:
+      return timed_funct(func, self)
+    else:
+      return func
+
+  def stats(self):
+    """Returns the accumulated statistics as a dict."""
+    rslt = dict(mode=self.mode, nfits=self.nfits, ncalls=self.ncalls,
+                fit_time=self.fit_time)
+    if self.nfits:
+      rslt['fit_time_mean'] = self.fit_time / self.nfits
+    if self.time_calls:
+      rslt['eval_time'] = self.eval_time
+      if self.ncalls:
+        rslt['eval_cost'] = self.eval_time / self.ncalls
+    return rslt
+
+
+class fit_counters(fit_instrument):
+  """Counters-only instrument: number of fits and function calls, and
+  the wall time of the fits (and the function evaluations, if time_calls
+  is enabled).
+  The statistics of the last fit are stored in last_fit_stats."""
+  mode = 'counters'
+
+  def __init__(self, time_calls=False):
+    self.time_calls = time_calls
+    fit_instrument.__init__(self)
+
+  def begin_fit(self):
+    self.fit_ncalls0 = self.ncalls
+    self.fit_eval_time0 = self.eval_time
+    self.fit_t0 = timer()
+
+  def end_fit(self):
+    wall_time = timer() - self.fit_t0
+    self.nfits += 1
+    self.fit_time += wall_time
+    st = dict(wall_time=wall_time, ncalls=self.ncalls - self.fit_ncalls0)
+    if self.time_calls:
+      st['eval_time'] = self.eval_time - self.fit_eval_time0
+    self.last_fit_stats = st
+    return st
+
+  def on_call(self, C, x, y):
+    self.ncalls += 1
+
+
+class fit_ring(fit_counters):
+  """Ring-buffer instrument: the counters, plus the parameters of the last
+  ring_size function evaluations (params_log) and the statistics of the
+  last ring_size fits (fit_log)."""
+  mode = 'ring'
+
+  def __init__(self, ring_size=100, time_calls=True):
+    self.ring_size = ring_size
+    fit_counters.__init__(self, time_calls=time_calls)
+
+  def reset(self):
+    fit_counters.reset(self)
+    self.log_params = True
+    self.params_log = deque(maxlen=self.ring_size)
+    self.fit_log = deque(maxlen=self.ring_size)
+
+  def end_fit(self):
+    st = fit_counters.end_fit(self)
+    self.fit_log.append(st)
+    return st
+
+  def on_call(self, C, x, y):
+    self.ncalls += 1
+    if self.log_params:
+      self.params_log.append(copy(C))
+
+  def record_params(self, C):
+    self.params_log.append(copy(C))
+
+
+class fit_trace(fit_ring):
+  """Full-trace instrument: the parameters of all the function evaluations
+  of the current fit (params_log is restarted by every fit), and the
+  statistics of all the fits (fit_log).
+  Memory use grows with the number of fits; use for debugging only."""
+  mode = 'trace'
+
+  def reset(self):
+    fit_counters.reset(self)
+    self.log_params = True
+    self.params_log = []
+    self.fit_log = []
+
+  def begin_fit(self):
+    fit_ring.begin_fit(self)
+    self.params_log = []
+
+
+instrument_classes = {
+  'off': fit_instrument,
+  'counters': fit_counters,
+  'ring': fit_ring,
+  'trace': fit_trace,
+}
+
+
+def make_instrument(mode='counters', ring_size=100, time_calls=None):
+  """Creates an instrument object for a given mode (see the module
+  documentation).
+  If time_calls is None, the mode's default is used.
+  An existing instrument object is returned as is."""
+  if isinstance(mode, fit_instrument):
+    return mode
+  if mode not in instrument_classes:
+    raise ValueError, "Invalid instrumentation mode: %s" % (mode,)
+  if mode == 'off':
+    return fit_instrument()
+  opts = {}
+  if time_calls is not None:
+    opts['time_calls'] = time_calls
+  if mode in ('ring', 'trace'):
+    opts['ring_size'] = ring_size
+  return instrument_classes[mode](**opts)
@@ -21,44 +21,69 @@ def linregr2d_SZ(x, y, sigma=None):
 
   where the input y has uncertainty given by sigma.
   """
-  from numpy import sum, sqrt
+  from numpy import sum
 
   # Based on Shiwei's regr.F code (from email received 20060102).
   # See Linear-regression.txt in my repository of Shiwei's files.
   # See also Numerical Recipes in C, 2nd ed, Sec. 15.2.
   xx = numpy.array(x, copy=False)
   yy = numpy.array(y, copy=False)
-  if sigma == None:
-    # My addition -- can be dangerous
-    # In case of no errorbar, we proceed as if all measurement
-    # data have the same uncertainty, taken to be 1.
-    ww = numpy.ones_like(y)
-  else:
-    ww = numpy.array(sigma, copy=False)
-    ww **= -2      # make 1/sigma**2 array
+  ww = linregr2d_weights_(yy, sigma)
 
   e1 = sum(xx * yy * ww)
   e2 = sum(yy * ww)
   d11 = sum(xx * ww)
   d12 = sum(xx**2 * ww)
   d21 = sum(ww)
+
+  # Shiwei's old method of computing the uncertainty of the
+  # y-intersect (sigma_a):
+  varsum = sum((xx*d11 - d12)**2 * ww)
+  return linregr2d_SZ_solve_(e1, e2, d11, d12, d21, varsum)
+
+
+def linregr2d_weights_(y, sigma):
+  """Returns the weights (1/sigma**2) of the linear regression."""
+  if sigma is None:
+    # My addition -- can be dangerous
+    # In case of no errorbar, we proceed as if all measurement
+    # data have the same uncertainty, taken to be 1.
+    return numpy.ones_like(y, dtype=float)
+  else:
+    # (not in-place: the input sigma array must not be clobbered)
+    return numpy.asarray(sigma, dtype=float)**-2  # make 1/sigma**2 array
+
+
+def linregr2d_SZ_solve_(e1, e2, d11, d12, d21, varsum=None):
+  """Solves the linear regression from the weighted sufficient
+  statistics:
+
+    e1 = sum(x*y*w),  e2 = sum(y*w),
+    d11 = sum(x*w),   d12 = sum(x**2*w),  d21 = sum(w).
+
+  These can be scalars (one regression) or arrays (many regressions).
+  The old-style `sigma' requires a second pass over the data (varsum);
+  if that is not available, the (mathematically identical) NR estimate
+  sigma_a is used in its place.
+  """
+  from numpy import sqrt
   d22 = d11
 
   detinv = 1.0 / (d11*d22 - d12*d21)
   a = (e1*d22 - e2*d12) * detinv
   b = (e2*d11 - e1*d21) * detinv
 
-  # Shiwei's old method of computing the uncertainty of the
-  # y-intersect (sigma_a):
-  varsum = sum((xx*d11 - d12)**2 * ww)
-  var = varsum * detinv**2
-  sigma = sqrt(var)
-
   # New method based on NR chapter: sqrt(sigma_a2) must give
   # identical result to sigma or else something is screwy!
   sigma_a2 = d12 * (-detinv)
   sigma_b2 = d21 * (-detinv)
 
+  if varsum is not None:
+    var = varsum * detinv**2
+  else:
+    var = sigma_a2
+  sigma = sqrt(var)
+
   #print sigma_a2
   #print sigma_b2
 
@@ -73,6 +98,92 @@ def linregr2d_SZ(x, y, sigma=None):
   )
 
 
+def linregr2d_SZ_batch(x, y, sigma=None):
+  """Batched form of linregr2d_SZ: performs many independent linear
+  regressions in one vectorized call.
+  The last axis of the arrays runs over the data points; y is a 2-D array
+  (one regression per row), while x and sigma are either shared by all
+  the rows (1-D arrays) or given per row.
+  Returns a fit_result object with the same fields as linregr2d_SZ,
+  where a, b, sigma, sigma_a, sigma_b are arrays (one element per row).
+  """
+  from numpy import sum
+  yy = numpy.asarray(y, dtype=float)
+  xx = numpy.asarray(x, dtype=float)
+  ww = linregr2d_weights_(yy, sigma)
+  (xx, yy, ww) = numpy.broadcast_arrays(xx, yy, ww)
+
+  e1 = sum(xx * yy * ww, axis=-1)
+  e2 = sum(yy * ww, axis=-1)
+  d11 = sum(xx * ww, axis=-1)
+  d12 = sum(xx**2 * ww, axis=-1)
+  d21 = sum(ww, axis=-1)
+  varsum = sum((xx*d11[...,numpy.newaxis] - d12[...,numpy.newaxis])**2 * ww, axis=-1)
+  return linregr2d_SZ_solve_(e1, e2, d11, d12, d21, varsum)
+
+
+class linregr2d_accum(object):
+  """Streaming accumulator for the weighted linear regression of
+  linregr2d_SZ.
+  The data are fed in chunks (of any size), so the full x, y, and sigma
+  arrays never need to be in memory at once:
+
+      acc = linregr2d_accum()
+      for (x, y, dy) in chunks:
+        acc.add(x, y, dy)
+      rslt = acc.result()
+
+  Partial accumulators (e.g. from parallel workers) are combined with
+  the merge method.
+  Many independent series can be accumulated at once by feeding 2-D
+  chunks (one series per row; the last axis runs over the data points).
+
+  The result has the same fields as that of linregr2d_SZ, except that
+  `sigma' is computed as sigma_a (the two are mathematically identical,
+  but the former needs a second pass over the data).
+  """
+  def __init__(self):
+    self.clear()
+
+  def clear(self):
+    self.N = 0
+    self.e1 = 0.0
+    self.e2 = 0.0
+    self.d11 = 0.0
+    self.d12 = 0.0
+    self.d21 = 0.0
+
+  def add(self, x, y, sigma=None):
+    """Adds a chunk of data points."""
+    from numpy import sum
+    yy = numpy.asarray(y, dtype=float)
+    xx = numpy.asarray(x, dtype=float)
+    ww = linregr2d_weights_(yy, sigma)
+    (xx, yy, ww) = numpy.broadcast_arrays(xx, yy, ww)
+    xw = xx * ww
+    self.N += yy.shape[-1]
+    self.e1 = self.e1 + sum(xw * yy, axis=-1)
+    self.e2 = self.e2 + sum(yy * ww, axis=-1)
+    self.d11 = self.d11 + sum(xw, axis=-1)
+    self.d12 = self.d12 + sum(xw * xx, axis=-1)
+    self.d21 = self.d21 + sum(ww, axis=-1)
+    return self
+
+  def merge(self, other):
+    """Merges the sums of another accumulator into this one."""
+    self.N += other.N
+    self.e1 = self.e1 + other.e1
+    self.e2 = self.e2 + other.e2
+    self.d11 = self.d11 + other.d11
+    self.d12 = self.d12 + other.d12
+    self.d21 = self.d21 + other.d21
+    return self
+
+  def result(self):
+    """Returns the regression result (see linregr2d_SZ)."""
+    return linregr2d_SZ_solve_(self.e1, self.e2, self.d11, self.d12, self.d21)
+
+
 
 def Test_1():
   """Testcase 1.
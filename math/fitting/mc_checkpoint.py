@@ -0,0 +1,153 @@
+#
+# wpylib.math.fitting.mc_checkpoint module
+# Created: 20261019
+# Wirawan Purwanto
+#
+
+"""
+wpylib.math.fitting.mc_checkpoint module
+On-disk checkpoints of stochastic (Monte Carlo) fitting runs.
+
+A long StochasticFitting run can be saved periodically to an HDF5 file
+and resumed later from the last checkpoint, continuing exactly where it
+stopped (see the `opt_checkpoint_file` attribute of StochasticFitting and
+mcfit_run1(resume=True)).
+
+File layout:
+
+- /setup: the samples (x, y, dy), the random number seed, the fit
+  function (class and parameter names), the fit method and the fit
+  options of the run (written once);
+- /nlf: the results of the non-stochastic fit (written once);
+- /log/mc_params, /log/mc_stats, /log/mc_funcalls, /log/guess_params:
+  the per-toss logs, one row per dice toss, in resizable datasets;
+- /states/<count>: the state of the run (random number generator, online
+  statistics, warm-start bookkeeping) after `count` tosses;
+- the `count` attribute of the root group: the number of tosses of the
+  last complete checkpoint.
+
+A checkpoint appends only the log rows added since the previous one,
+writes the new state, then updates `count`, so the logs are never
+rewritten.
+Rows beyond `count` (left by an interrupted checkpoint) are ignored and
+overwritten by the next one.
+
+Format versions:
+- 1: the first version; the online statistics lack the co-moment matrix
+  (C) needed for the covariance of the parameters.
+- 2: the current version.
+Files of other versions are rejected.
+"""
+
+import numpy
+
+from wpylib.iofmt.hdf5 import hdf5_write_obj, hdf5_read_obj
+
+
+class mcfit_checkpoint(object):
+  """Checkpoint file of a StochasticFitting run; see the module
+  documentation.
+  The file is opened only for the duration of each operation."""
+  version = 2
+  log_fields = ('mc_params', 'mc_stats', 'mc_funcalls', 'guess_params')
+  # Number of rows per HDF5 chunk of the log datasets:
+  chunk_rows = 256
+
+  def __init__(self, filename):
+    self.filename = filename
+
+  def create(self, setup, nlf, state):
+    """Starts a new checkpoint file (overwriting the existing one, if any)
+    with the given setup, NLF results (dicts), and initial state."""
+    import h5py
+    F = h5py.File(self.filename, 'w')
+    try:
+      F.attrs['format'] = 'mcfit_checkpoint'
+      F.attrs['version'] = self.version
+      hdf5_write_obj(F, 'setup', setup)
+      hdf5_write_obj(F, 'nlf', nlf)
+      F.create_group('log')
+      hdf5_write_obj(F.create_group('states'), '0', state)
+      F.attrs['count'] = 0
+    finally:
+      F.close()
+
+  def append_(self, G, name, rows, n0):
+    """Writes the rows of a log dataset starting at row n0."""
+    rows = numpy.asarray(rows)
+    n = n0 + len(rows)
+    if name not in G:
+      G.create_dataset(name, shape=(0,) + rows.shape[1:], dtype=rows.dtype,
+                       maxshape=(None,) + rows.shape[1:],
+                       chunks=(self.chunk_rows,) + rows.shape[1:])
+    D = G[name]
+    D.resize(n, axis=0)
+    D[n0:n] = rows
+
+  def save(self, logs, state, start=0, count=None):
+    """Stores a checkpoint.
+    `logs` is a dict of the per-toss logs (lists of equal length, indexed
+    by log_fields; missing fields are not stored), holding the tosses from
+    index `start` on; only the rows not yet in the file are written.
+    `state` is the (small) dict of the run state after these tosses.
+    The number of tosses, `count`, defaults to the end of the logs; it
+    must be given if the logs are not stored at all.
+    Returns the number of tosses stored."""
+    import h5py
+    if count is None:
+      count = start + len(logs['mc_params'])
+    n = count
+    F = h5py.File(self.filename, 'a')
+    try:
+      n0 = int(F.attrs['count'])
+      if not (start <= n0 <= n):
+        raise ValueError, \
+          "Checkpoint file %s holds %d tosses; cannot append tosses %d-%d" \
+          % (self.filename, n0, start, n)
+      if n == n0:
+        return n
+      G = F['log']
+      for k in self.log_fields:
+        if k in logs:
+          if k not in G and n0 > 0:
+            raise ValueError, \
+              "Checkpoint file %s lacks the earlier rows of log %s" \
+              % (self.filename, k)
+          self.append_(G, k, logs[k][n0-start:], n0)
+      S = F['states']
+      hdf5_write_obj(S, str(n), state)
+      F.attrs['count'] = n
+      for k in S.keys():
+        if k != str(n):
+          del S[k]
+    finally:
+      F.close()
+    return n
+
+  def load(self):
+    """Reads back the last complete checkpoint.
+    Returns (setup, nlf, state, logs), where logs is a dict of arrays
+    with one row per toss."""
+    import h5py
+    F = h5py.File(self.filename, 'r')
+    try:
+      if F.attrs.get('format') != 'mcfit_checkpoint':
+        raise ValueError, "%s is not an MC fit checkpoint file" % (self.filename,)
+      version = int(F.attrs.get('version', 0))
+      if version != self.version:
+        raise ValueError, \
+          "Checkpoint file %s has format version %d; only version %d is supported" \
+          % (self.filename, version, self.version)
+      n = int(F.attrs['count'])
+      setup = hdf5_read_obj(F['setup'])
+      nlf = hdf5_read_obj(F['nlf'])
+      state = hdf5_read_obj(F['states'][str(n)])
+      G = F['log']
+      logs = dict([ (k, G[k][:n]) for k in self.log_fields if k in G ])
+    finally:
+      F.close()
+    if 'C' not in state.get('online_stats', {}):
+      raise ValueError, \
+        "Checkpoint file %s lacks the parameter covariance statistics" \
+        % (self.filename,)
+    return (setup, nlf, state, logs)
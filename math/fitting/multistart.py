@@ -0,0 +1,203 @@
+#
+# wpylib.math.fitting.multistart module
+# Created: 20261019
+# Wirawan Purwanto
+#
+
+"""
+wpylib.math.fitting.multistart module
+Multi-start (global) fitting with fit_func_base objects.
+
+Nonlinear ansatzes such as morse2_fit_func and ext3Bmorse2_fit_func
+occasionally converge to a poor local minimum from the single starting
+point given by Guess_xy.
+fit_multistart runs the same fit from K starting points:
+
+- start #0 is the standard guess (the Guess argument, the values of the
+  lmfit Params of the ansatz, or Guess_xy), so the result is never worse
+  than that of a plain fit;
+- the other starts are drawn around it, either by Latin hypercube
+  sampling ('lhs', the default) or by independent uniform random
+  perturbations ('random'), within +/- spread * |guess| for each
+  parameter (+/- spread for the parameters whose guess is zero), or
+  uniformly within explicit parameter bounds (which must be finite).
+
+The starts are fitted in order, optionally in a pool of nproc worker
+processes.
+The run stops early once `agree' of the completed fits have reached the
+best chi square so far (to within the relative tolerance agree_rtol).
+Since the results are examined in the start order, the outcome does not
+depend on nproc.
+
+Usage:
+
+    func = ext3Bmorse2_fit_func()
+    xopt = func.fit_multistart(x, y, dy, nstarts=16, nproc=4, seed=1)
+    print func.last_fit['multistart']
+
+The full result of the best fit is stored in func.last_fit, with the
+additional key `multistart' containing the diagnostic summary:
+
+- nstarts: number of starts requested
+- nfits: number of starts actually fitted
+- early_stop: whether the run stopped early
+- best_index: index of the best start
+- n_agree: number of fits agreeing with the best chi square
+- guesses: the starting points, (nfits, nparams)
+- xopt: the fitted parameters of every start, (nfits, nparams)
+- chi_square: the chi square of every start (inf for failed fits)
+- funcalls: the number of function calls of every start
+- failures: number of fits that raised an exception
+"""
+
+import numpy
+
+from wpylib.math.fitting import fit_result, worker_pool, worker_args, \
+  lmfit_params_vector
+
+
+def lhs_unit(nsamples, ndim, rng):
+  """Latin hypercube sample of nsamples points in the unit hypercube
+  [0,1)**ndim."""
+  U = numpy.empty((nsamples, ndim))
+  for j in xrange(ndim):
+    U[:,j] = (rng.permutation(nsamples) + rng.uniform(size=nsamples)) / nsamples
+  return U
+
+
+def multistart_guesses(Guess, nstarts, method='lhs', spread=0.5, bounds=None,
+                       rng=None):
+  """Generates nstarts starting points around the base guess
+  (see the module documentation).
+  The first row is the base guess itself.
+  If given, bounds is a (lower, upper) pair of parameter arrays (or
+  scalars); ValueError is raised if they are not finite.
+  """
+  Guess = numpy.asarray(Guess, dtype=float)
+  if rng is None:
+    rng = numpy.random.RandomState()
+  nparams = len(Guess)
+  nrand = nstarts - 1
+  if method == 'lhs':
+    U = lhs_unit(nrand, nparams, rng)
+  elif method == 'random':
+    U = rng.uniform(size=(nrand, nparams))
+  else:
+    raise ValueError, "Invalid multistart sampling method: %s" % (method,)
+  if bounds is not None:
+    lo = numpy.asarray(bounds[0], dtype=float) * numpy.ones(nparams)
+    hi = numpy.asarray(bounds[1], dtype=float) * numpy.ones(nparams)
+    if not numpy.all(numpy.isfinite(lo) & numpy.isfinite(hi)):
+      raise ValueError, \
+        "Multistart sampling needs finite bounds for all the parameters; got %s, %s" \
+        % (lo, hi)
+    G = lo + U * (hi - lo)
+  else:
+    scale = numpy.where(Guess != 0, numpy.abs(Guess), 1.0) * spread
+    G = Guess + (2 * U - 1) * scale
+  return numpy.concatenate((Guess[numpy.newaxis, :], G))
+
+
+def multistart_fit1_(func, x, y, dy, fit_opts, Guess):
+  """Fits one start; returns (storable record, error message)."""
+  from wpylib.math.fitting.fit_cache import storable_record
+  try:
+    func.fit(x, y, dy, fit_opts=fit_opts, Guess=tuple(Guess))
+  except Exception, e:
+    return (None, "%s: %s" % (type(e).__name__, e))
+  return (storable_record(func.last_fit), None)
+
+
+def fit_multistart(func, x, y, dy=None, nstarts=16, method='lhs', spread=0.5,
+                   bounds=None, agree=3, agree_rtol=1e-6, nproc=None,
+                   seed=None, fit_opts=None, Guess=None):
+  """Multi-start fit of a fit_func_base object; see the module
+  documentation.
+  Returns the parameters of the best fit; the full record (including the
+  diagnostic summary) is stored in func.last_fit.
+  Set agree=None to always fit all the starts.
+  """
+  x = func.domain_array(x)
+  y = numpy.asarray(y)
+  if Guess is None:
+    if getattr(func, "Params", None) is not None:
+      Guess = lmfit_params_vector(func.Params, func.param_names)
+    else:
+      Guess = func.Guess_xy(x, y)
+  rng = numpy.random.RandomState(seed)
+  guesses = multistart_guesses(Guess, nstarts, method=method, spread=spread,
+                               bounds=bounds, rng=rng)
+
+  # (the fit cache is of no use for distinct starts)
+  if nproc is not None and nproc > 1:
+    pool = worker_pool(nproc, (func.worker_copy(), x, y, dy, fit_opts))
+    results = pool.imap(_multistart_worker_fit, guesses)
+  else:
+    pool = None
+    worker_func = func.worker_copy(keep=('instrument',))
+    if getattr(func, "Params", None) is not None:
+      # (fit_func overwrites the values of Params with each guess)
+      import copy
+      worker_func.Params = copy.deepcopy(func.Params)
+    results = (multistart_fit1_(worker_func, x, y, dy, fit_opts, G)
+               for G in guesses)
+
+  recs = []
+  errors = []
+  chi2 = []
+  early_stop = False
+  try:
+    for (rec, err) in results:
+      recs.append(rec)
+      if rec is None:
+        errors.append(err)
+        chi2.append(numpy.inf)
+        if func.debug >= 1:
+          print "fit_multistart: start #%d failed: %s" % (len(recs)-1, err)
+      else:
+        chi2.append(rec['chi_square'])
+      best = min(chi2)
+      n_agree = sum([ c <= best + agree_rtol * abs(best) for c in chi2 ])
+      if agree is not None and numpy.isfinite(best) and n_agree >= agree \
+         and len(recs) < nstarts:
+        early_stop = True
+        break
+  finally:
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+
+  nfits = len(recs)
+  chi2 = numpy.array(chi2)
+  best_index = int(numpy.argmin(chi2))
+  if recs[best_index] is None:
+    raise RuntimeError, \
+      "fit_multistart: all the %d fits failed; first error: %s" % (nfits, errors[0])
+  nparams = guesses.shape[1]
+  summary = dict(
+    nstarts=nstarts,
+    nfits=nfits,
+    early_stop=early_stop,
+    best_index=best_index,
+    n_agree=n_agree,
+    guesses=guesses[:nfits],
+    xopt=numpy.array([ rec['xopt'] if rec is not None else [numpy.nan] * nparams
+                       for rec in recs ], dtype=float),
+    chi_square=chi2,
+    funcalls=numpy.array([ rec.get('funcalls', 0) if rec is not None else 0
+                           for rec in recs ]),
+    failures=len(errors),
+  )
+  if func.debug >= 1:
+    print "fit_multistart: %d/%d starts fitted, best = #%d (chi_square = %g), %d agree" \
+          % (nfits, nstarts, best_index, chi2[best_index], n_agree)
+  func.last_fit = fit_result(recs[best_index])
+  func.last_fit['multistart'] = summary
+  return func.last_fit['xopt']
+
+
+# Worker-process routines for parallel multi-start fitting
+
+def _multistart_worker_fit(Guess):
+  (func, x, y, dy, fit_opts) = worker_args()
+  return multistart_fit1_(func, x, y, dy, fit_opts, Guess)
@@ -0,0 +1,59 @@
+#
+# wpylib.math.fitting.residual module
+# Created: 20261019
+# Wirawan Purwanto
+#
+
+"""
+wpylib.math.fitting.residual module
+Allocation-free evaluation of the weighted sum of squared residuals.
+
+The residual_engine object computes the weighted sum of squared residuals
+(WSSR)
+
+    chi2 = sum( ((f(C,x) - y) * sqrt(w))**2 )
+
+for the minimizers in fit_func that work on the WSSR alone (fmin,
+fmin_bfgs and anneal).
+The work arrays are allocated once, when the engine is created, and reused
+in every evaluation through the `out=' argument of the numpy ufuncs.
+For the small data sets typical of PEC fitting (a dozen points or so),
+the cost of a function evaluation is dominated by the python overhead
+and the array allocations rather than by the arithmetic, so this matters.
+
+The residual vector of leastsq and least_squares is still computed by
+the plain closure in fit_func: those minimizers hold on to the arrays
+returned by the residual function, so a new array must be made in every
+call anyway, and the engine was measured to be slower there.
+"""
+
+import numpy
+
+
+class residual_engine(object):
+  """WSSR evaluator with preallocated work buffers.
+
+      R = residual_engine(Funct, x, y, sqrtw)
+      chi2 = R.wssr(C, x, y, sqrtw)   # same signature as fit_func's fun_err2
+
+  The x, y, and sqrtw arguments of the wssr method are accepted for
+  compatibility with the minimizers' calling convention (args=(x,y,sqrtw)),
+  but the values given to the constructor are used.
+  """
+  def __init__(self, Funct, x, y, sqrtw=1.0):
+    self.Funct = Funct
+    self.x = x
+    self.y = numpy.asarray(y, dtype=float)
+    npts = len(self.y)
+    self.npts = npts
+    # sqrt-weights: broadcast once to a full array
+    self.sqrtw = numpy.empty(npts)
+    self.sqrtw[...] = sqrtw
+    self.r = numpy.empty(npts)
+
+  def wssr(self, C, xx=None, yy=None, ww=None):
+    """Computes the weighted sum of squared residuals."""
+    r = self.r
+    numpy.subtract(self.Funct(C, self.x), self.y, r)
+    r *= self.sqrtw
+    return numpy.square(r, r).sum()
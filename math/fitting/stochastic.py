@@ -15,11 +15,14 @@ wpylib.math.fitting.stochastic module
 Tools for stochastic curve fitting.
 """
 
+import os.path
 import numpy
 import numpy.random
 
-from wpylib.math.fitting import fit_func_base
+from wpylib.math.fitting import fit_func_base, worker_pool, worker_args
 from wpylib.math.stats.errorbar import errorbar
+from wpylib.math.stats.online_stats import online_stats, reservoir_sample
+from wpylib.array_tools import growable_array
 
 
 class StochasticFitting(object):
@@ -35,11 +38,57 @@ class StochasticFitting(object):
     - method `fit`
     - method `__call__` (i.e. a callable object)
 
+  Options (class attributes; see the methods named for details):
+
+  * `opt_rng_streams`: if True, every dice toss draws from its own random
+    number stream, seeded by (rng_seed, toss index), so that serial and
+    parallel runs (mcfit_loop1_ with nproc > 1) give identical results.
+  * batch_size > 1 in mcfit_loop1_: the dice tosses are fitted in batches
+    by wpylib.math.fitting.batch.fit_batch; the datasets not converged
+    within `opt_batch_maxiter` iterations are refitted one by one
+    (counted in `mcfit_batch_refits`).
+  * mcfit_run1(rel_prec=...): runs until every parameter error bar is
+    known to that relative precision (see mcfit_loop1_adaptive_).
+  * `opt_warm_start`: each MC fit starts from the linearized prediction
+    of its solution (see mcfit_warm_start_init_); requires use_nlf_guess,
+    and is not used by the batched loop. Fallbacks to the cold start are
+    counted in `mcfit_warm_fallbacks`.
+  * `error_mode`: 'mc' (default), 'lincov' (linearized covariance, no MC
+    fits; see lincov_analysis_) or 'auto' (lincov if it agrees with an
+    MC pilot run of `opt_lincov_pilot_iter` fits; see lincov_check_).
+    The mode used is recorded in `error_mode_used`.
+  * `opt_checkpoint_file`, `opt_checkpoint_interval`: periodic HDF5
+    checkpoints, resumed by mcfit_run1(resume=True) (see
+    wpylib.math.fitting.mc_checkpoint).
+  * `opt_mcfit_fig_dir`, `opt_mcfit_fig_every`: figures saved with
+    save_fig; `opt_mcfit_fig_async`, `opt_mcfit_fig_queue_size`,
+    `opt_mcfit_fig_drop`: background rendering (see mcfit_async_renderer).
+  * `opt_mc_log_mode`: 'list' (default), 'array' (growable arrays) or
+    'stats' (no per-toss logs; low-memory mode); see mcfit_log_init_.
+    The online statistics (mc_online_stats) are kept in all modes.
+  * `opt_mc_reservoir_size`: keep a uniform random sample of that many
+    tosses in `mc_reservoir`.
+
   """
   debug = 0
   dbg_guess_params = True
+  opt_rng_streams = False
+  opt_warm_start = False
+  opt_warm_check_count = 20
+  opt_batch_maxiter = 200
+  error_mode = 'mc'
+  opt_lincov_pilot_iter = 100
+  opt_lincov_tol = 0.1
   # opt_mcfit_fig_dir: specify subdir for saving figures
   opt_mcfit_fig_dir = "."
+  opt_mcfit_fig_every = 1
+  opt_mcfit_fig_async = False
+  opt_mcfit_fig_queue_size = 16
+  opt_mcfit_fig_drop = False
+  opt_checkpoint_file = None
+  opt_checkpoint_interval = 100
+  opt_mc_log_mode = 'list'
+  opt_mc_reservoir_size = 0
   def_opt_report_final_params = 3
   def __init__(self):
     self.use_nlf_guess = 1
@@ -77,8 +126,23 @@ class StochasticFitting(object):
       seed = numpy.random.randint(numpy.iinfo(int).max)
       print "Using random seed: ", seed
     self.rng_seed = seed
+    self.rng_class = rng_class
     self.rng = rng_class(seed)
 
+  def mcfit_rng_stream_(self, index):
+    """Creates the independent random number stream for the index-th
+    dice toss (see the description of `opt_rng_streams`).
+    If `rng` was assigned directly instead of by init_rng, `rng_seed` must
+    be set too; the streams are then numpy.random.RandomState objects."""
+    if not hasattr(self, "rng_seed"):
+      raise RuntimeError, \
+        "Random number streams need rng_seed; use init_rng to set up rng."
+    seed = int(self.rng_seed)
+    index = int(index)
+    rng_class = getattr(self, "rng_class", numpy.random.RandomState)
+    return rng_class([ seed % 2**32, (seed // 2**32) % 2**32,
+                       index % 2**32, (index // 2**32) % 2**32 ])
+
   def num_fit_params(self):
     """An ad-hoc way to determine the number of fitting parameters.
 
@@ -105,6 +169,10 @@ class StochasticFitting(object):
       return len(self.log_mc_params[0])
     except:
       pass
+    try:
+      return len(self.mc_online_stats.M1)
+    except:
+      pass
     raise RuntimeError, "Cannot determine the number of fit parameters."
 
   def nlfit1(self):
@@ -127,10 +195,12 @@ class StochasticFitting(object):
     self.nlf_funcalls = last_fit['funcalls']
     self.nlf_rec = last_fit
 
-  def mcfit_step1_toss_dice_(self):
+  def mcfit_step1_toss_dice_(self, rng=None):
     """Generates a single Monte Carlo dataset for the mcfit_step1_
     procedure."""
-    self.dice_dy = self.rng.normal(size=len(self.samples_dy))
+    if rng is None:
+      rng = self.rng
+    self.dice_dy = rng.normal(size=len(self.samples_dy))
     self.dice_y = self.samples_y + self.samples_dy * self.dice_dy
 
   def mcfit_step1_(self):
@@ -139,34 +209,162 @@ class StochasticFitting(object):
     # - dice_* = values related to one "dice toss" of the sample
     # - mval_* = values related to the mean value of the samples
     #            (i.e. samples_y)
-    # FIXME: In future this *could* be run in parallel but the state vars
-    # (such as dice_y, dice_dy, etc.) must be stored on per-thread basis.
+    # The state vars (dice_y, dice_dy, etc.) are per-process;
+    # see mcfit_loop1_ for the parallel version.
+    if self.opt_rng_streams:
+      self.mcfit_step1_toss_dice_(self.mcfit_rng_stream_(self.mc_online_stats.N))
+    else:
+      self.mcfit_step1_toss_dice_()
+    self.mcfit_step1_record_(self.mcfit_step1_fit_(self.dice_y))
+
+  def mcfit_warm_start_init_(self):
+    """Prepares the linearized predictor and the variable scaling for the
+    warm-started MC fits (opt_warm_start).
+    The guess of a toss is
+
+        guess = xopt_NLF + pinv(J_w) . ((dice_y - f_NLF) * w)
+
+    where J_w is the weighted Jacobian at the NLF solution; leastsq also
+    gets the column norms of J_w as its `diag' scaling.
+    A toss falls back to the cold start if the guess or its fit is worse
+    than the NLF parameters. The guess is checked only for the first
+    opt_warm_check_count (pilot) tosses; if more than half of them fall
+    back, the warm start is abandoned (see mcfit_warm_guess_)."""
+    if not self.use_nlf_guess:
+      raise RuntimeError, "Warm start requires use_nlf_guess."
+    if self.use_dy_weights:
+      w = 1.0 / self.samples_dy
+    else:
+      w = numpy.ones(len(self.samples_y))
+    xopt = numpy.array(self.func.get_params(self.log_nlf_params,
+                                            *getattr(self.func, "param_names", ())),
+                       dtype=float)
+    Jw = self.func.eval_jacobian(xopt, self.samples_x) * w[:,numpy.newaxis]
+    self.warm_xopt = xopt
+    self.warm_w = w
+    self.warm_pinv = numpy.linalg.pinv(Jw)
+    colnorm = numpy.sqrt(numpy.sum(Jw**2, axis=0))
+    self.warm_diag = numpy.where(colnorm > 0, colnorm, 1.0)
+    self.nlf_wf = self.nlf_f * w
+    self.warm_tries = 0
+    self.warm_fails = 0
+    self.warm_disabled = False
+
+  def mcfit_warm_guess_(self, dice_y):
+    """Returns the predicted (warm) guess parameters for a dice toss,
+    or None if the prediction is worse than the cold start."""
+    w = self.warm_w
+    guess = self.warm_xopt + numpy.dot(self.warm_pinv, dice_y * w - self.nlf_wf)
+    if not numpy.all(numpy.isfinite(guess)):
+      return (None, 0)
+    if self.warm_tries > self.opt_warm_check_count:
+      # past the pilot tosses
+      return (guess, 0)
+    with numpy.errstate(all='ignore'):
+      f_guess = self.func(guess, self.samples_x)
+    wssr_guess = numpy.sum(((f_guess - dice_y) * w)**2)
+    wssr_cold = numpy.sum((self.nlf_wf - dice_y * w)**2)
+    if not (wssr_guess <= wssr_cold):
+      return (None, 1)
+    return (guess, 1)
+
+  def mcfit_step1_fit_(self, dice_y):
+    """Fits a single Monte Carlo dataset.
+    Returns the fit record to be stored by mcfit_step1_record_, which is
+    a tuple of:
+      (dice_params, dice_f, guess_params, stats, funcalls, warm_fallback)
+    """
     from numpy.linalg import norm
-    self.mcfit_step1_toss_dice_()
     if self.use_dy_weights:
       dy = self.samples_dy
     else:
       dy = None
-    rslt = self.func.fit(self.samples_x, self.dice_y, dy=dy,
-                         Guess=self.dice_param_guess,
-                        )
+    warm_fallback = False
+    if self.opt_warm_start and not self.warm_disabled:
+      self.warm_tries += 1
+      (guess, funcalls) = self.mcfit_warm_guess_(dice_y)
+      rslt = None
+      if guess is not None:
+        fit_opts = dict(self.func.fit_opts_effective())
+        if self.func.fit_method == 'leastsq':
+          fit_opts['diag'] = self.warm_diag
+        rslt = self.func.fit(self.samples_x, dice_y, dy=dy,
+                             Guess=guess, fit_opts=fit_opts,
+                            )
+        last_fit = self.func.last_fit
+        funcalls += last_fit['funcalls']
+        wssr_cold = norm((self.nlf_f - dice_y) * self.warm_w)**2
+        if not (numpy.all(numpy.isfinite(rslt))
+                and last_fit.get('ier', 1) in (1, 2, 3, 4)
+                and last_fit['chi_square'] <= wssr_cold):
+          rslt = None
+      if rslt is None:
+        warm_fallback = True
+        self.warm_fails += 1
+        if self.warm_tries <= self.opt_warm_check_count \
+           and self.warm_fails * 2 > self.opt_warm_check_count:
+          self.warm_disabled = True
+        rslt = self.func.fit(self.samples_x, dice_y, dy=dy,
+                             Guess=self.dice_param_guess,
+                            )
+        funcalls += self.func.last_fit['funcalls']
+    else:
+      guess = None
+      rslt = self.func.fit(self.samples_x, dice_y, dy=dy,
+                           Guess=self.dice_param_guess,
+                          )
+      funcalls = self.func.last_fit['funcalls']
     # fit result of the stochastic data
-    self.dice_params = rslt
-    self.log_mc_params.append(rslt)
-    self.dice_f = self.func(self.dice_params, self.samples_x)
+    dice_params = rslt
+    dice_f = self.func(dice_params, self.samples_x)
 
     if self.dbg_guess_params:
-      self.log_guess_params.append(self.func.guess_params)
+      if guess is not None and not warm_fallback:
+        guess_params = guess
+      else:
+        guess_params = self.func.guess_params
+    else:
+      guess_params = None
 
-    last_fit = self.func.last_fit
-    dice_resid = self.dice_f - self.dice_y
-    mval_resid = self.dice_f - self.samples_y
+    dice_resid = dice_f - dice_y
+    mval_resid = dice_f - self.samples_y
     dice_ussr = norm(dice_resid)**2
     dice_wssr = norm(dice_resid / self.samples_dy)**2
     mval_ussr = norm(mval_resid)**2
     mval_wssr = norm(mval_resid / self.samples_dy)**2
-    self.log_mc_stats.append((dice_ussr, dice_wssr, mval_ussr, mval_wssr))
-    self.log_mc_funcalls.append(last_fit['funcalls'])
+    return (dice_params, dice_f, guess_params,
+            (dice_ussr, dice_wssr, mval_ussr, mval_wssr),
+            funcalls, warm_fallback)
+
+  def mcfit_step1_record_(self, rec):
+    """Stores the result of a single Monte Carlo data fit
+    (produced by mcfit_step1_fit_) in the accumulators."""
+    (self.dice_params, self.dice_f, guess_params, stats, funcalls) = rec[:5]
+    if len(rec) > 5 and rec[5]:
+      self.mcfit_warm_fallbacks += 1
+    if self.log_mc_params is not None:
+      self.log_mc_params.append(self.dice_params)
+      if self.dbg_guess_params:
+        if guess_params is None and isinstance(self.log_guess_params, growable_array):
+          guess_params = numpy.nan * numpy.ones(len(self.dice_params))
+        self.log_guess_params.append(guess_params)
+      self.log_mc_stats.append(stats)
+      self.log_mc_funcalls.append(funcalls)
+    self.mc_online_stats.add(self.dice_params)
+    if self.mc_reservoir is not None:
+      self.mc_reservoir.add(self.dice_params)
+
+  def mcfit_viz_plot_x_(self):
+    """Returns the x values of the curves drawn by mcfit_step1_viz_."""
+    x = self.samples_x[0]
+    samples_xmin = x.min()
+    samples_xmax = x.max()
+    samples_xrange = samples_xmax - samples_xmin
+    len_plot_x = 10*len(self.samples_y)
+    return numpy.linspace(start=samples_xmin - 0.03 * samples_xrange,
+                          stop=samples_xmax + 0.03 * samples_xrange,
+                          num=len_plot_x,
+                          endpoint=True)
 
   def mcfit_step1_viz_(self, save=True):
     """Generates a visual representation of the last MC fit step.
@@ -174,49 +372,48 @@ class StochasticFitting(object):
     from matplotlib import pyplot
     if not hasattr(self, "fig"):
       self.fig = pyplot.figure()
-    self.fig.clf()
-    ax = self.fig.add_subplot(1, 1, 1)
-    title = "MC fit step %d" % self.mcfit_iter_num
-    ax.set_title(title)
-    x,y,dy = self.samples_x[0], self.samples_y, self.samples_dy
-    ax.errorbar(x=x, y=y, yerr=dy,
-                fmt="x", color="SlateGray", label="QMC",
-               )
-    samples_xmin = x.min()
-    samples_xmax = x.max()
-    samples_xrange = samples_xmax - samples_xmin
-    samples_ymin = y.min()
-    samples_ymax = y.max()
-    samples_yrange = samples_ymax - samples_ymin
-    len_plot_x = 10*len(y)
-    plot_x = numpy.linspace(start=samples_xmin - 0.03 * samples_xrange,
-                            stop=samples_xmax + 0.03 * samples_xrange,
-                            num=len_plot_x,
-                            endpoint=True)
-    ax.plot(plot_x, self.func(self.nlf_rec.xopt, [plot_x]), "-",
-            color="SlateGray", label="nlfit")
-    ax.errorbar(x=x, y=self.dice_y, yerr=dy,
-                fmt="or", label="MC toss",
-               )
-    ax.plot(plot_x, self.func(self.dice_params, [plot_x]), "-",
-            color="salmon", label="MC fit")
-
-    samples_dy_max = numpy.max(self.samples_dy)
-    ax.set_ylim((samples_ymin - samples_dy_max * 8, samples_ymax + samples_dy_max * 8))
+    plot_x = self.mcfit_viz_plot_x_()
+    mcfit_draw_step1_(self.fig, self.mcfit_iter_num,
+                      self.samples_x[0], self.samples_y, self.samples_dy, plot_x,
+                      self.func(self.nlf_rec.xopt, [plot_x]),
+                      self.dice_y, self.func(self.dice_params, [plot_x]))
     if save:
-      import os.path
       self.fig.savefig(os.path.join(self.opt_mcfit_fig_dir,
                                     "mcfit-%04d.png" % self.mcfit_iter_num))
 
+  def mcfit_step1_fig_(self):
+    """Renders the figure of the last MC fit step (for save_fig in
+    mcfit_loop1_): only every opt_mcfit_fig_every-th step, either right
+    away or in the background (opt_mcfit_fig_async)."""
+    if self.mcfit_iter_num % self.opt_mcfit_fig_every != 0:
+      return
+    if not self.opt_mcfit_fig_async:
+      self.mcfit_step1_viz_(save=True)
+      return
+    R = getattr(self, "mcfit_renderer", None)
+    if R is None or R.closed:
+      plot_x = self.mcfit_viz_plot_x_()
+      R = self.mcfit_renderer = mcfit_async_renderer(
+            self.func, self.samples_x[0], self.samples_y, self.samples_dy,
+            plot_x, self.func(self.nlf_rec.xopt, [plot_x]),
+            fig_dir=self.opt_mcfit_fig_dir,
+            queue_size=self.opt_mcfit_fig_queue_size,
+            drop=self.opt_mcfit_fig_drop)
+    R.submit(self.mcfit_iter_num, self.dice_y, self.dice_params)
+
+  def mcfit_step1_fig_close_(self, abort=False):
+    """Waits for the background rendering (if any) to finish, or stops it
+    right away if abort is True."""
+    R = getattr(self, "mcfit_renderer", None)
+    if R is not None and not R.closed:
+      R.close(abort=abort)
+
   def mcfit_loop_begin_(self):
     """Performs final initialization before firing up mcfit_loop_.
     This need to be done only before the first mcfit_loop_() call;
     if more samples are collected later, then this routine should NOT be
     called again or else all the accumulators would reset."""
-    self.log_guess_params = []
-    self.log_mc_params = []
-    self.log_mc_stats = []
-    self.log_mc_funcalls = []
+    self.mcfit_log_init_()
     if self.use_nlf_guess:
       print "Using guess param from NLF: ",
       self.nlfit1()
@@ -225,13 +422,244 @@ class StochasticFitting(object):
       print self.log_nlf_params
     else:
       self.dice_param_guess = None
+    self.mcfit_warm_fallbacks = 0
+    self.mcfit_batch_refits = 0
+    if self.opt_warm_start:
+      self.mcfit_warm_start_init_()
+    if self.opt_checkpoint_file is not None:
+      self.mcfit_checkpoint_begin_()
+
+  def mcfit_log_init_(self):
+    """Creates the (empty) accumulators of the MC loop according to
+    opt_mc_log_mode:
+    - 'list': python lists (log_mc_params, etc.), copied to the mc_params
+      and mc_stats arrays by mcfit_loop_end_;
+    - 'array': growable numpy arrays (wpylib.array_tools.growable_array);
+      mc_params and mc_stats are then views of these arrays;
+    - 'stats': none (the log_* attributes are None); the final parameters
+      come from the online statistics, and mc_params holds only the
+      reservoir sample (opt_mc_reservoir_size)."""
+    mode = self.opt_mc_log_mode
+    if mode == 'list':
+      self.log_guess_params = []
+      self.log_mc_params = []
+      self.log_mc_stats = []
+      self.log_mc_funcalls = []
+    elif mode == 'array':
+      self.log_guess_params = growable_array()
+      self.log_mc_params = growable_array()
+      self.log_mc_stats = growable_array(shape=(4,))
+      self.log_mc_funcalls = growable_array(shape=(), dtype=int)
+    elif mode == 'stats':
+      self.log_guess_params = None
+      self.log_mc_params = None
+      self.log_mc_stats = None
+      self.log_mc_funcalls = None
+    else:
+      raise ValueError, "Unsupported opt_mc_log_mode: %s" % (mode,)
+    self.mc_online_stats = online_stats(track_cov=True)
+    if self.opt_mc_reservoir_size:
+      self.mc_reservoir = reservoir_sample(self.opt_mc_reservoir_size,
+                                           rng=self.mcfit_rng_stream_(-1))
+    else:
+      self.mc_reservoir = None
+
+  def mcfit_checkpoint_state_(self):
+    """Returns the state of the MC loop to be stored in a checkpoint,
+    besides the logs."""
+    S = self.mc_online_stats
+    rng = getattr(self, "rng", None)
+    state = dict(
+      rng_state=(rng.get_state() if hasattr(rng, "get_state") else None),
+      opt_rng_streams=bool(self.opt_rng_streams),
+      online_stats=dict(N=S.N, M1=S.M1, M2=S.M2, M3=S.M3, M4=S.M4, C=S.C),
+      mcfit_warm_fallbacks=self.mcfit_warm_fallbacks,
+      mcfit_batch_refits=self.mcfit_batch_refits,
+      warm=None,
+      reservoir=None,
+    )
+    R = self.mc_reservoir
+    if R is not None:
+      state['reservoir'] = dict(N=R.N, size=R.size, items=R.sample(),
+                                rng_state=R.rng.get_state())
+    if hasattr(self, "warm_tries"):
+      state['warm'] = dict(tries=self.warm_tries,
+                           fails=self.warm_fails,
+                           disabled=bool(self.warm_disabled))
+    return state
+
+  def mcfit_checkpoint_options_(self):
+    """Returns the settings of the run that must not change when it is
+    resumed from a checkpoint (see mcfit_resume_)."""
+    return dict(func_class=type(self.func).__name__,
+                param_names=[ str(p) for p in self.func.param_names ],
+                fit_method=str(self.func.fit_method),
+                opt_warm_start=bool(self.opt_warm_start),
+                opt_warm_check_count=int(self.opt_warm_check_count),
+                opt_rng_streams=bool(self.opt_rng_streams),
+                rng_class=getattr(self, "rng_class",
+                                  numpy.random.RandomState).__name__)
+
+  def mcfit_checkpoint_begin_(self):
+    """Creates the checkpoint file (opt_checkpoint_file) with the setup
+    of the run and the NLF results."""
+    from wpylib.math.fitting.fit_cache import storable_record
+    from wpylib.math.fitting.mc_checkpoint import mcfit_checkpoint
+    setup = dict(samples_x=self.samples_x,
+                 samples_y=self.samples_y,
+                 samples_dy=self.samples_dy,
+                 rng_seed=self.rng_seed,
+                 use_dy_weights=bool(self.use_dy_weights),
+                 use_nlf_guess=bool(self.use_nlf_guess),
+                 dbg_guess_params=bool(self.dbg_guess_params))
+    setup.update(self.mcfit_checkpoint_options_())
+    if self.use_nlf_guess:
+      nlf = dict(log_nlf_params=numpy.array(self.log_nlf_params, dtype=float),
+                 nlf_f=self.nlf_f,
+                 nlf_ussr=self.nlf_ussr,
+                 nlf_wssr=self.nlf_wssr,
+                 nlf_funcalls=self.nlf_funcalls,
+                 nlf_rec=storable_record(self.nlf_rec))
+    else:
+      nlf = {}
+    self.mcfit_ckpt = mcfit_checkpoint(self.opt_checkpoint_file)
+    self.mcfit_ckpt.create(setup, nlf, self.mcfit_checkpoint_state_())
+    self.mcfit_ckpt_count = 0
+
+  def mcfit_checkpoint_(self, force=False):
+    """Saves a checkpoint if opt_checkpoint_interval tosses have been done
+    since the last one (or unconditionally, if force is True)."""
+    if getattr(self, "mcfit_ckpt", None) is None:
+      return
+    n = self.mc_online_stats.N
+    if n == self.mcfit_ckpt_count or \
+       (not force and n - self.mcfit_ckpt_count < self.opt_checkpoint_interval):
+      return
+    n0 = self.mcfit_ckpt_count
+    if self.log_mc_params is None:
+      logs = {}
+    else:
+      logs = dict(
+        mc_params=[ numpy.asarray(p, dtype=float) for p in self.log_mc_params[n0:n] ],
+        mc_stats=self.log_mc_stats[n0:n],
+        mc_funcalls=self.log_mc_funcalls[n0:n],
+      )
+      if self.dbg_guess_params:
+        nan_row = numpy.nan * numpy.ones(len(self.log_mc_params[0]))
+        logs['guess_params'] = [ (nan_row if g is None else numpy.asarray(g, dtype=float))
+                                 for g in self.log_guess_params[n0:n] ]
+    self.mcfit_ckpt_count = self.mcfit_ckpt.save(logs, self.mcfit_checkpoint_state_(),
+                                                 start=n0, count=n)
+    if self.debug >= 1:
+      print "mcfit_checkpoint_: %d tosses saved to %s" \
+            % (n, self.opt_checkpoint_file)
+
+  def mcfit_resume_(self, filename=None):
+    """Restores the MC loop from a checkpoint file (default:
+    opt_checkpoint_file); this takes the place of mcfit_loop_begin_.
+    The samples are taken from the file if they have not been set by
+    init_samples; otherwise they must be identical to the stored ones.
+    The fit function, fit method, warm-start and random number stream
+    options (mcfit_checkpoint_options_) must also be those of the stored
+    run.
+    If opt_checkpoint_file is set, the checkpoints continue to be saved
+    to the file read here."""
+    from wpylib.math.fitting import fit_result
+    from wpylib.math.fitting.mc_checkpoint import mcfit_checkpoint
+    if filename is None:
+      filename = self.opt_checkpoint_file
+    ckpt = mcfit_checkpoint(filename)
+    (setup, nlf, state, logs) = ckpt.load()
+
+    if hasattr(self, "samples_y"):
+      for k in ('samples_x', 'samples_y', 'samples_dy'):
+        if not numpy.array_equal(getattr(self, k), setup[k]):
+          raise ValueError, \
+            "The data do not match those in checkpoint file %s" % (filename,)
+    else:
+      self.init_samples(x=setup['samples_x'], y=setup['samples_y'],
+                        dy=setup['samples_dy'])
+    for (k, v) in sorted(self.mcfit_checkpoint_options_().iteritems()):
+      if k not in setup:
+        raise ValueError, \
+          "Checkpoint file %s does not record the setting %s" % (filename, k)
+      if setup[k] != v:
+        raise ValueError, \
+          "Checkpoint file %s was made with %s=%r, not %r" \
+          % (filename, k, setup[k], v)
+    self.use_dy_weights = setup['use_dy_weights']
+    self.use_nlf_guess = setup['use_nlf_guess']
+    self.dbg_guess_params = setup['dbg_guess_params']
+    self.opt_rng_streams = state['opt_rng_streams']
+    self.init_rng(seed=setup['rng_seed'],
+                  rng_class=getattr(self, "rng_class", numpy.random.RandomState))
+    if state['rng_state'] is not None:
+      self.rng.set_state(state['rng_state'])
+    elif not self.opt_rng_streams:
+      raise ValueError, \
+        "The random number generator state was not saved in %s" % (filename,)
+
+    if self.use_nlf_guess:
+      for k in ('log_nlf_params', 'nlf_f', 'nlf_ussr', 'nlf_wssr', 'nlf_funcalls'):
+        setattr(self, k, nlf[k])
+      self.nlf_rec = fit_result(nlf['nlf_rec'])
+      self.dice_param_guess = self.log_nlf_params
+    else:
+      self.dice_param_guess = None
+
+    self.mcfit_log_init_()
+    n = state['online_stats']['N']
+    if self.log_mc_params is not None and n > 0:
+      if 'mc_params' not in logs:
+        raise ValueError, \
+          "Checkpoint file %s has no per-toss logs (opt_mc_log_mode='stats')" \
+          % (filename,)
+      if self.opt_mc_log_mode == 'list':
+        self.log_mc_params = list(logs['mc_params'])
+        self.log_mc_stats = [ tuple(s) for s in logs['mc_stats'] ]
+        self.log_mc_funcalls = [ int(k) for k in logs['mc_funcalls'] ]
+        if self.dbg_guess_params:
+          self.log_guess_params = [ (None if numpy.all(numpy.isnan(g)) else g)
+                                    for g in logs['guess_params'] ]
+      else:
+        self.log_mc_params.extend(logs['mc_params'])
+        self.log_mc_stats.extend(logs['mc_stats'])
+        self.log_mc_funcalls.extend(logs['mc_funcalls'])
+        if self.dbg_guess_params:
+          self.log_guess_params.extend(logs['guess_params'])
+    for (k, v) in state['online_stats'].iteritems():
+      setattr(self.mc_online_stats, k, v)
+    if self.mc_reservoir is not None and n > 0:
+      R = self.mc_reservoir
+      if state['reservoir'] is None or state['reservoir']['size'] != R.size:
+        raise ValueError, \
+          "Checkpoint file %s has no reservoir sample of size %d" \
+          % (filename, R.size)
+      R.N = state['reservoir']['N']
+      R.items = list(state['reservoir']['items'])
+      R.rng.set_state(state['reservoir']['rng_state'])
+
+    self.mcfit_warm_fallbacks = state['mcfit_warm_fallbacks']
+    self.mcfit_batch_refits = state.get('mcfit_batch_refits', 0)
+    if self.opt_warm_start:
+      self.mcfit_warm_start_init_()
+      if state['warm'] is not None:
+        W = state['warm']
+        (self.warm_tries, self.warm_fails, self.warm_disabled) \
+          = (W['tries'], W['fails'], W['disabled'])
+
+    if self.opt_checkpoint_file is not None:
+      self.mcfit_ckpt = ckpt
+      self.mcfit_ckpt_count = n
+    if self.debug >= 1:
+      print "mcfit_resume_: %d tosses restored from %s" % (n, filename)
 
   def mcfit_loop_end_(self):
     """Performs final initialization before firing up do_mc_fitting:
     - Repackage log_mc_stats and log_mc_params as numpy array of structs
     """
     # Number of fit parameters:
-    num_params = len(self.log_mc_params[0])
+    num_params = len(self.mc_online_stats.M1)
     #if True:
     try:
       pnames = self.func.param_names
@@ -246,42 +674,263 @@ class StochasticFitting(object):
       param_dtype = [ ("C"+str(i), float) for i in xrange(num_params) ]
     stats_dtype = [ (i, float) for i in ('dice_ussr', 'dice_wssr', 'mval_ussr', 'mval_wssr') ]
 
-    # Can't initialize the self.mc_params array in a single step with
-    # numpy.array construction function; we must copy the records one by one.
-    # The reason is this: each element of the log_mc_params list is already
-    # a numpy ndarray object.
-    self.mc_params = numpy.empty((len(self.log_mc_params),), dtype=param_dtype)
-    for (i,p) in enumerate(self.log_mc_params):
-      if self.func.use_lmfit_method:
-        self.mc_params[i] = tuple(p)
+    if self.log_mc_params is None:
+      # 'stats' mode: only the reservoir sample is available
+      if self.mc_reservoir is not None:
+        P = self.mc_reservoir.sample()
       else:
-        self.mc_params[i] = p
-    self.mc_stats = numpy.array(self.log_mc_stats, dtype=stats_dtype)
+        P = numpy.empty((0, num_params))
+      self.mc_params = numpy.ascontiguousarray(P, dtype=float) \
+                       .view(param_dtype).reshape((len(P),))
+      self.mc_stats = numpy.empty((0,), dtype=stats_dtype)
+    elif isinstance(self.log_mc_params, growable_array):
+      # 'array' mode: the structured arrays are views of the logs
+      n = len(self.log_mc_params)
+      self.mc_params = self.log_mc_params.array().view(param_dtype).reshape((n,))
+      self.mc_stats = self.log_mc_stats.array().view(stats_dtype).reshape((n,))
+    else:
+      # Can't initialize the self.mc_params array in a single step with
+      # numpy.array construction function; we must copy the records one by one.
+      # The reason is this: each element of the log_mc_params list is already
+      # a numpy ndarray object.
+      self.mc_params = numpy.empty((len(self.log_mc_params),), dtype=param_dtype)
+      for (i,p) in enumerate(self.log_mc_params):
+        if self.func.use_lmfit_method:
+          self.mc_params[i] = tuple(p)
+        else:
+          self.mc_params[i] = p
+      self.mc_stats = numpy.array(self.log_mc_stats, dtype=stats_dtype)
     self.fit_parameters = [ p[0] for p in param_dtype ]
 
   def mcfit_analysis_(self):
     """Performs analysis of the Monte Carlo fitting.
     This version does no weighting or filtering based on some cutoff criteria.
+    Without the per-toss logs (opt_mc_log_mode='stats'), the results are
+    taken from the online statistics.
     """
     flds = self.fit_parameters # == self.mc_params.dtype.names
+    S = self.mc_online_stats
     rslt = {}
-    for F in flds:
-      mean = numpy.average(self.mc_params[F])
-      err = numpy.std(self.mc_params[F])
-      rslt[F] = errorbar(mean, err)
+    err_relerr = {}
+    if self.log_mc_params is None:
+      (mean, err, relerr) = (S.mean(), S.std(), S.std_rel_err())
+      for (i,F) in enumerate(flds):
+        rslt[F] = errorbar(mean[i], err[i])
+        err_relerr[F] = relerr[i]
+    else:
+      for F in flds:
+        mean = numpy.average(self.mc_params[F])
+        err = numpy.std(self.mc_params[F])
+        rslt[F] = errorbar(mean, err)
+        err_relerr[F] = online_stats().add_batch(self.mc_params[F]).std_rel_err()
     self.final_mc_params = rslt
+    self.final_mc_params_cov = S.cov()
+    # Relative MC uncertainty of the error bars above:
+    self.final_mc_err_relerr = err_relerr
 
-  def mcfit_loop1_(self, num_iter, save_fig=0):
+  def mcfit_loop1_(self, num_iter, save_fig=0, nproc=None, batch_size=None):
     """Performs the Monte-Carlo fit simulation after the
-    input parameters are set up."""
+    input parameters are set up.
+
+    If batch_size > 1, the Monte Carlo datasets are fitted in batches
+    (see mcfit_loop1_batch_).
+
+    If nproc > 1, the dice tosses are spread over a pool of nproc worker
+    processes.
+    The parallel loop always uses per-toss random number streams (it turns
+    on `opt_rng_streams`, so that subsequent serial steps remain
+    consistent), and the results are stored in the toss order.
+    Thus the result is identical to that of a serial run with
+    opt_rng_streams=True and the same seed, regardless of nproc.
 
-    for i in xrange(num_iter):
+    A checkpoint is saved at the end (if opt_checkpoint_file is set).
+
+    With save_fig, the figures of the MC fit steps are saved (see
+    mcfit_step1_fig_); any background rendering is finished before
+    returning.
+    """
+    if isinstance(self.log_mc_params, growable_array):
+      n = len(self.log_mc_params) + num_iter
+      for L in (self.log_mc_params, self.log_mc_stats, self.log_mc_funcalls,
+                self.log_guess_params):
+        L.reserve(n)
+    try:
+      if nproc is not None and nproc > 1:
+        self.mcfit_loop1_parallel_(num_iter, nproc, save_fig=save_fig)
+      elif batch_size is not None and batch_size > 1:
+        self.mcfit_loop1_batch_(num_iter, batch_size, save_fig=save_fig)
+      else:
+        self.mcfit_loop1_serial_(num_iter, save_fig=save_fig)
+    except:
+      self.mcfit_step1_fig_close_(abort=True)
+      raise
+    self.mcfit_step1_fig_close_()
+    self.mcfit_checkpoint_(force=True)
+
+  def mcfit_loop1_serial_(self, num_iter, save_fig=0, iter0=0):
+    """Serial version of mcfit_loop1_ (the loop proper)."""
+    for i in xrange(iter0, iter0 + num_iter):
       self.mcfit_iter_num = i
       if self.debug >= 2:
         print "mcfit_loop1_: iteration %d" % i
       self.mcfit_step1_()
       if save_fig:
-        self.mcfit_step1_viz_(save=True)
+        self.mcfit_step1_fig_()
+      self.mcfit_checkpoint_()
+
+  def mcfit_converged_(self, rel_prec):
+    """Tells whether the error bars of all the fit parameters have
+    reached the relative precision `rel_prec`."""
+    S = self.mc_online_stats
+    if S.N < 3:
+      return False
+    return bool(numpy.all(S.std_rel_err() <= rel_prec))
+
+  def mcfit_loop1_adaptive_(self, rel_prec, min_iter=100, max_iter=10000,
+                            check_interval=50, **loop_opts):
+    """Performs the Monte-Carlo fit simulation until the error bar
+    (standard deviation) of every fit parameter is estimated to the
+    relative precision `rel_prec`, i.e. until
+
+        std_err(err[p]) / err[p] <= rel_prec
+
+    for all the parameters p, as estimated from the running fourth-order
+    moments.
+    For normally distributed parameters, this requires about
+    1 / (2 * rel_prec**2) Monte Carlo fits (e.g. 200 for rel_prec=0.05).
+    The convergence is checked every `check_interval` fits, after at
+    least min_iter fits (counted from the beginning of the MC loop);
+    the loop stops after max_iter fits in any case.
+    Other keyword arguments (nproc, batch_size, save_fig) are passed on
+    to mcfit_loop1_.
+
+    Sets `mcfit_converged' to the outcome, and returns it.
+    """
+    self.mcfit_converged = False
+    while True:
+      n = self.mc_online_stats.N
+      if n >= min_iter and self.mcfit_converged_(rel_prec):
+        self.mcfit_converged = True
+        break
+      if n >= max_iter:
+        break
+      num_iter = min(max(check_interval, min_iter - n), max_iter - n)
+      self.mcfit_loop1_(num_iter=num_iter, **loop_opts)
+      if self.debug >= 1:
+        print "mcfit_loop1_adaptive_: %d fits, max rel. precision of the errors = %.4g" \
+              % (self.mc_online_stats.N, numpy.max(self.mc_online_stats.std_rel_err()))
+    return self.mcfit_converged
+
+  def mcfit_worker_state_(self):
+    """Returns a trimmed copy of this object to be sent to worker
+    processes (the accumulators and other bulky or unpicklable attributes
+    are removed)."""
+    from copy import copy
+    state = copy(self)
+    # (guess_params is recorded by mcfit_step1_fit_)
+    state.func = self.func.worker_copy(keep=('guess_params',))
+    for attr in ('log_guess_params', 'log_mc_params', 'log_mc_stats',
+                 'log_mc_funcalls', 'mc_online_stats', 'mc_params', 'mc_stats',
+                 'fig', 'rng', 'mcfit_ckpt', 'mc_reservoir', 'mcfit_renderer'):
+      state.__dict__.pop(attr, None)
+    return state
+
+  def mcfit_loop1_parallel_(self, num_iter, nproc, save_fig=0):
+    """Parallel version of mcfit_loop1_; see the documentation there."""
+    self.opt_rng_streams = True
+    # The pilot tosses of the warm start are done here, so that the
+    # workers share their outcome (see mcfit_warm_start_init_), and the
+    # results are identical to those of the serial loop:
+    if self.opt_warm_start and not self.warm_disabled:
+      num_pilot = min(num_iter, max(0, self.opt_warm_check_count - self.warm_tries))
+    else:
+      num_pilot = 0
+    self.mcfit_loop1_serial_(num_pilot, save_fig=save_fig)
+    num_iter -= num_pilot
+    if num_iter <= 0:
+      return
+    i0 = self.mc_online_stats.N
+    pool = worker_pool(nproc, self.mcfit_worker_state_())
+    try:
+      chunksize = max(1, num_iter // (nproc * 4))
+      recs = pool.imap(_mcfit_worker_step1, xrange(i0, i0 + num_iter), chunksize)
+      for (i, (dice_dy, rec)) in enumerate(recs, num_pilot):
+        self.mcfit_iter_num = i
+        if self.debug >= 2:
+          print "mcfit_loop1_: iteration %d" % i
+        self.dice_dy = dice_dy
+        self.dice_y = self.samples_y + self.samples_dy * dice_dy
+        self.mcfit_step1_record_(rec)
+        if save_fig:
+          self.mcfit_step1_fig_()
+        self.mcfit_checkpoint_()
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+
+  def mcfit_loop1_batch_(self, num_iter, batch_size, save_fig=0):
+    """Batched version of mcfit_loop1_: the dice tosses are fitted
+    batch_size at a time by the vectorized Levenberg-Marquardt engine
+    (wpylib.math.fitting.batch.fit_batch).
+    The lmfit fit methods are not supported.
+    Checkpoints are saved only at the end of a batch.
+    """
+    from numpy import einsum
+    from wpylib.math.fitting.batch import fit_batch
+    if self.func.use_lmfit_method:
+      raise NotImplementedError, \
+        "Batched fitting does not support the lmfit methods."
+    if self.use_dy_weights:
+      dy = self.samples_dy
+    else:
+      dy = None
+    x = self.samples_x
+    i = 0
+    while i < num_iter:
+      nb = min(batch_size, num_iter - i)
+      dice_dy = numpy.empty((nb, len(self.samples_dy)))
+      for b in xrange(nb):
+        if self.opt_rng_streams:
+          self.mcfit_step1_toss_dice_(self.mcfit_rng_stream_(self.mc_online_stats.N + b))
+        else:
+          self.mcfit_step1_toss_dice_()
+        dice_dy[b] = self.dice_dy
+      dice_y = self.samples_y + self.samples_dy * dice_dy
+      rslt = fit_batch(self.func, x, dice_y, dy=dy, Guess=self.dice_param_guess,
+                       maxiter=self.opt_batch_maxiter, debug=self.debug)
+      xopt = rslt['xopt']
+      funcalls = rslt['funcalls']
+      # Refit the stragglers one by one:
+      for b in numpy.nonzero(~rslt['converged'])[0]:
+        xopt[b] = self.func.fit(x, dice_y[b], dy=dy, Guess=self.dice_param_guess)
+        funcalls[b] += self.func.last_fit['funcalls']
+        self.mcfit_batch_refits += 1
+      dice_f = self.func.eval_batch(xopt, x)
+      dice_resid = dice_f - dice_y
+      mval_resid = dice_f - self.samples_y
+      wdice_resid = dice_resid / self.samples_dy
+      wmval_resid = mval_resid / self.samples_dy
+      stats = numpy.array([ einsum('ij,ij->i', R, R)
+                            for R in (dice_resid, wdice_resid, mval_resid, wmval_resid) ]).T
+      if self.dbg_guess_params:
+        guess_params = self.dice_param_guess
+      else:
+        guess_params = None
+      for b in xrange(nb):
+        self.mcfit_iter_num = i
+        if self.debug >= 2:
+          print "mcfit_loop1_: iteration %d" % i
+        self.dice_dy = dice_dy[b]
+        self.dice_y = dice_y[b]
+        self.mcfit_step1_record_((xopt[b], dice_f[b], guess_params,
+                                  tuple(stats[b]), funcalls[b]))
+        if save_fig:
+          self.mcfit_step1_fig_()
+        i += 1
+      self.mcfit_checkpoint_()
 
   def mcfit_report_final_params(self, format=None):
     if format == None:
@@ -297,8 +946,11 @@ class StochasticFitting(object):
       ])
     elif format == 2:
       print "Final parameters:"
+      err_relerr = getattr(self, "final_mc_err_relerr", {})
       print "\n".join([
         "  %s = %s" % (k, parm[k])
+          + ("  (errorbar +/- %.1f%%)" % (err_relerr[k] * 100)
+             if k in err_relerr else "")
           for k in self.fit_parameters
       ])
     elif format == 1:
@@ -306,8 +958,26 @@ class StochasticFitting(object):
       print parm
 
   def mcfit_run1(self, x=None, y=None, dy=None, data=None, func=None, rng_params=None,
-                 num_iter=100, save_fig=False):
-    """The main routine to perform stochastic fit."""
+                 num_iter=100, save_fig=False, nproc=None, batch_size=None,
+                 rel_prec=None, min_iter=100, max_iter=None, check_interval=50,
+                 error_mode=None, resume=False):
+    """The main routine to perform stochastic fit.
+    Use nproc > 1 to run the Monte Carlo fits in parallel,
+    or batch_size > 1 to fit them in batches
+    (see mcfit_loop1_).
+
+    If rel_prec is given, the number of Monte Carlo fits is determined
+    adaptively (see mcfit_loop1_adaptive_) between min_iter and max_iter
+    (default: num_iter) fits; otherwise exactly num_iter fits are
+    performed.
+
+    error_mode overrides the `error_mode` attribute (see the class
+    documentation).
+    In the 'auto' mode, the pilot fits count toward the MC budget.
+
+    If resume is True and the checkpoint file (opt_checkpoint_file)
+    exists, the run continues from the last checkpoint; the number of
+    fits (num_iter, min_iter, max_iter) counts the restored ones too."""
     if data is not None:
       raise NotImplementedError
     elif dy is not None:
@@ -334,8 +1004,53 @@ class StochasticFitting(object):
     elif not hasattr(self, "rng"):
       self.init_rng()
 
-    self.mcfit_loop_begin_()
-    self.mcfit_loop1_(num_iter=num_iter, save_fig=save_fig)
+    if error_mode is None:
+      error_mode = self.error_mode
+    if error_mode not in ('mc', 'lincov', 'auto'):
+      raise ValueError, "Unsupported error_mode: %s" % (error_mode,)
+    self.error_mode_used = 'mc'
+    if max_iter is None:
+      max_iter = num_iter
+
+    if resume and self.opt_checkpoint_file is not None \
+       and os.path.exists(self.opt_checkpoint_file):
+      self.mcfit_resume_()
+    else:
+      self.mcfit_loop_begin_()
+    if error_mode in ('lincov', 'auto'):
+      self.lincov_analysis_()
+    if error_mode == 'lincov':
+      self.error_mode_used = 'lincov'
+      self.fit_parameters = self.lincov_param_names
+      self.final_mc_params = self.final_lincov_params
+      self.mcfit_report_final_params()
+      return self.final_mc_params
+    if error_mode == 'auto':
+      num_pilot = min(self.opt_lincov_pilot_iter, num_iter)
+      self.mcfit_loop1_(num_iter=max(num_pilot - self.mc_online_stats.N, 0),
+                        save_fig=save_fig, nproc=nproc, batch_size=batch_size)
+      # A run resumed past the pilot stage had already rejected the
+      # linearized errors:
+      if self.mc_online_stats.N == num_pilot and self.lincov_check_():
+        self.mcfit_loop_end_()
+        self.mcfit_analysis_()
+        self.pilot_mc_params = self.final_mc_params
+        self.error_mode_used = 'lincov'
+        self.final_mc_params = self.final_lincov_params
+        self.mcfit_report_final_params()
+        return self.final_mc_params
+      if self.debug >= 1:
+        print "mcfit_run1: linearized errors rejected, continuing MC:", \
+              getattr(self, "lincov_diagnostic", None)
+
+    if rel_prec is not None:
+      self.mcfit_loop1_adaptive_(rel_prec, min_iter=min_iter, max_iter=max_iter,
+                                 check_interval=check_interval,
+                                 save_fig=save_fig, nproc=nproc,
+                                 batch_size=batch_size)
+    else:
+      self.mcfit_loop1_(num_iter=max(num_iter - self.mc_online_stats.N, 0),
+                        save_fig=save_fig, nproc=nproc, batch_size=batch_size)
     self.mcfit_loop_end_()
     self.mcfit_analysis_()
     self.mcfit_report_final_params()
@@ -354,20 +1069,15 @@ class StochasticFitting(object):
     else:
       x = fit_func_base.domain_array(x)
 
+    if hasattr(self.func, "eval_batch"):
+      # Batch operation: a single vectorized call if the function supports
+      # the batch_call protocol (see fit_func_base).
+      pnames = self.mc_params.dtype.names
+      C = numpy.array([ self.mc_params[k] for k in pnames ]).T
+      return self.func.eval_batch(C, x)
+
     xlen = len(x[0])
     mc_curve_y = numpy.empty((len(self.mc_params), xlen))
-    # The following loop could have been written as a batch operation,
-    # but it requires some nontrivial change in the convention of how
-    # fit_func_base.__call__() is written.
-    # Double broadcasting and other dimensional retrofitting/reduction
-    # ('dot product'?) may be required.
-    # Example: in harm_fit_func class, the statement
-    #     xdisp = (x[0] - C[2])
-    # will have to be changed becasuse the length of x[0]
-    # (which is the number of data points in the "x" argument)
-    # and the length of C[2]
-    # (which is the number of MC iterations)
-    # will not match--and these numbers must NOT be subtracted elementwise!
     for (i,ppp) in enumerate(self.mc_params):
       mc_curve_y[i] = self.func(ppp, x)
 
@@ -376,7 +1086,11 @@ class StochasticFitting(object):
   def mcfit_eval(self, x=None, yscale=1.0, ddof=1, outfmt=0):
     """Evaluates the curve (y) values for a given set of x value(s).
     This routine generates the finalized values (with errorbar estimate)
-    based on the stochastically sampled parameter values."""
+    based on the stochastically sampled parameter values.
+    If the linearized error mode was used by mcfit_run1 (see
+    `error_mode_used`), the result of lincov_eval is returned instead."""
+    if getattr(self, "error_mode_used", "mc") == 'lincov':
+      return self.lincov_eval(x=x, yscale=yscale, outfmt=outfmt)
 
     # WARNING: CONVENTION CHANGES FROM ORIGINAL make_curve_errorbar() ROUTINE!
     # The default delta degree of freedom (ddof) should be 1 because we need
@@ -404,17 +1118,239 @@ class StochasticFitting(object):
       raise ValueError, "Unsupported outfmt value=%s." % (outfmt,)
     return final_mc_curve
 
+  def lincov_analysis_(self):
+    """Computes the linearized covariance of the fit parameters at the
+    NLF solution, i.e. the covariance of
+
+        dC = pinv(J_w) . (w * dy_data)
+
+    where J_w is the (weighted) Jacobian and dy_data the data errors.
+    This also holds for unweighted fits (use_dy_weights=False).
+    Like the MC errors, and unlike the xerr of fit_func, it is not
+    rescaled by chi_square / NDF.
+    The results are stored in `lincov_params_cov' (the matrix) and
+    `final_lincov_params' (a dict of errorbar objects, like
+    final_mc_params)."""
+    if not hasattr(self, "nlf_rec") or not self.use_nlf_guess:
+      self.nlfit1()
+    if self.use_dy_weights:
+      w = 1.0 / self.samples_dy
+    else:
+      w = numpy.ones(len(self.samples_y))
+    xopt = numpy.array(self.func.get_params(self.log_nlf_params,
+                                            *getattr(self.func, "param_names", ())),
+                       dtype=float)
+    J = self.func.eval_jacobian(xopt, self.samples_x)
+    A = numpy.linalg.pinv(J * w[:,numpy.newaxis]) * w  # dC = A . dy_data
+    Ady = A * self.samples_dy
+    self.lincov_xopt = xopt
+    self.lincov_params_cov = numpy.dot(Ady, Ady.T)
+    try:
+      pnames = self.func.param_names
+      assert len(pnames) == len(xopt)
+    except:
+      pnames = [ "C"+str(i) for i in xrange(len(xopt)) ]
+    err = numpy.sqrt(numpy.diagonal(self.lincov_params_cov))
+    self.lincov_param_names = list(pnames)
+    self.final_lincov_params = dict([ (F, errorbar(xopt[i], err[i]))
+                                      for (i,F) in enumerate(pnames) ])
+
+  def lincov_eval(self, x=None, yscale=1.0, outfmt=0):
+    """Evaluates the curve (y) values and their linearized error band
+    (sqrt of the diagonal of J . cov . J^T) for a given set of x value(s).
+    The output format is the same as that of mcfit_eval."""
+    if x is None:
+      x = self.samples_x
+    else:
+      x = fit_func_base.domain_array(x)
+    xopt = self.lincov_xopt
+    J = self.func.eval_jacobian(xopt, x)
+    final_curve = numpy.empty((len(x[0]),), dtype=[('val',float),('err',float)])
+    final_curve['val'] = self.func(xopt, x)
+    final_curve['err'] = numpy.sqrt(numpy.sum(numpy.dot(J, self.lincov_params_cov) * J,
+                                              axis=1))
+    if yscale != 1.0:
+      final_curve['val'] *= yscale
+      final_curve['err'] *= yscale
+    if outfmt == 0:
+      pass
+    elif outfmt == 1:
+      final_curve = numpy.array([errorbar(y,dy) for (y,dy) in final_curve], dtype=errorbar)
+    else:
+      raise ValueError, "Unsupported outfmt value=%s." % (outfmt,)
+    return final_curve
+
+  def lincov_check_(self):
+    """Compares the linearized errors against the MC samples collected
+    so far (e.g. a pilot run).
+    For each parameter, both must hold:
+    - the MC mean is within (tol * err + 2 * err / sqrt(N)) of the NLF
+      value, and
+    - the MC error bar and the linearized one agree to within
+      tol + 2 * (the relative MC uncertainty of the error bar),
+    where tol = opt_lincov_tol.
+    The per-parameter details are stored in `lincov_diagnostic'.
+    Returns True if all the parameters pass."""
+    S = self.mc_online_stats
+    N = S.N
+    mc_mean = numpy.asarray(S.mean())
+    mc_err = numpy.asarray(S.std())
+    mc_err_relerr = numpy.asarray(S.std_rel_err())
+    lin_err = numpy.sqrt(numpy.diagonal(self.lincov_params_cov))
+    tol = self.opt_lincov_tol
+    diag = {}
+    passed = True
+    for (i,F) in enumerate(self.lincov_param_names):
+      shift = abs(mc_mean[i] - self.lincov_xopt[i])
+      mean_shift = shift / lin_err[i] if lin_err[i] > 0 else numpy.inf
+      ok_mean = mean_shift <= tol + 2.0 / numpy.sqrt(N)
+      ratio = mc_err[i] / lin_err[i] if lin_err[i] > 0 else numpy.inf
+      ok_err = abs(ratio - 1) <= tol + 2 * mc_err_relerr[i]
+      diag[F] = dict(mean_shift=mean_shift, err_ratio=ratio,
+                     ok=bool(ok_mean and ok_err))
+      passed = passed and ok_mean and ok_err
+    self.lincov_diagnostic = diag
+    return bool(passed)
+
   def mcfit_dump_param_samples(self, out):
     """Dump the generated parameter samples for diagnostic purposes.
     """
+    from wpylib.iofmt.text_output import text_output
+    from wpylib.text_tools import table_write
     O = text_output(out)
     pnames = self.mc_params.dtype.names
     snames = self.mc_stats.dtype.names
-    O.write("# %s ; %s ; nfev\n" % (" ".join(pnames), " ".join(snames)))
-    O.write(matrix_str(array_hstack([ self.mc_params[k] for k in pnames ] + \
-                                    [ self.mc_stats[k] for k in snames ] + \
-                                    [ self.log_mc_funcalls]),
-                       " %#17.10g")+ "\n")
+    table_write(O,
+                [ self.mc_params[k] for k in pnames ] + \
+                [ self.mc_stats[k] for k in snames ] + \
+                [ numpy.asarray(self.log_mc_funcalls) ],
+                fmt=" %#17.10g",
+                header="# %s ; %s ; nfev\n" % (" ".join(pnames), " ".join(snames)))
+
+
+
+def mcfit_draw_step1_(fig, iter_num, x, y, dy, plot_x, nlf_y, dice_y, mc_y):
+  """Draws the figure of an MC fit step (see mcfit_step1_viz_): the data,
+  the NLF curve, the dice toss and its fitted curve."""
+  fig.clf()
+  ax = fig.add_subplot(1, 1, 1)
+  title = "MC fit step %d" % iter_num
+  ax.set_title(title)
+  ax.errorbar(x=x, y=y, yerr=dy,
+              fmt="x", color="SlateGray", label="QMC",
+             )
+  ax.plot(plot_x, nlf_y, "-",
+          color="SlateGray", label="nlfit")
+  ax.errorbar(x=x, y=dice_y, yerr=dy,
+              fmt="or", label="MC toss",
+             )
+  ax.plot(plot_x, mc_y, "-",
+          color="salmon", label="MC fit")
+
+  samples_dy_max = numpy.max(dy)
+  ax.set_ylim((y.min() - samples_dy_max * 8, y.max() + samples_dy_max * 8))
+
+
+class mcfit_async_renderer(object):
+  """Renders the figures of MC fit steps in a background process.
+  The static parts of the figures (the data and the NLF curve) are given
+  once, to the constructor; each step is then submitted as a compact
+  snapshot (the step number, the dice toss and the fitted parameters)
+  through a bounded queue.
+  The worker process evaluates the fitted curve with its own copy of
+  `func`, and draws on an Agg canvas (no display needed).
+  When the queue is full, submit waits for the worker, unless drop is
+  True: the snapshot is then skipped, except for the last one, which is
+  handed over by close.
+
+  Counters:
+  - submitted: number of snapshots handed to the worker
+  - dropped: number of snapshots skipped because the queue was full
+  """
+  def __init__(self, func, x, y, dy, plot_x, nlf_y, fig_dir=".", queue_size=16,
+               drop=False):
+    import multiprocessing
+    self.submitted = 0
+    self.dropped = 0
+    self.drop = drop
+    self.last_dropped = None
+    self.closed = False
+    self.queue = multiprocessing.Queue(queue_size)
+    self.proc = multiprocessing.Process(
+                  target=_mcfit_render_worker,
+                  args=(self.queue, (func, x, y, dy, plot_x, nlf_y, fig_dir)))
+    self.proc.daemon = True
+    self.proc.start()
+
+  def submit(self, iter_num, dice_y, dice_params):
+    """Hands a snapshot over to the worker.
+    Returns False if it was dropped (see the class documentation)."""
+    from Queue import Full
+    snapshot = (iter_num, numpy.array(dice_y), numpy.array(dice_params))
+    if not self.drop:
+      self.queue.put(snapshot)
+    else:
+      try:
+        self.queue.put_nowait(snapshot)
+      except Full:
+        self.dropped += 1
+        self.last_dropped = snapshot
+        return False
+    self.last_dropped = None
+    self.submitted += 1
+    return True
+
+  def close(self, abort=False):
+    """Waits until all the submitted snapshots (and the last one, if it
+    was dropped) are rendered and stops the worker, or stops it right
+    away if abort is True."""
+    if self.closed:
+      return
+    self.closed = True
+    if not abort and self.proc.is_alive():
+      if self.last_dropped is not None:
+        self.queue.put(self.last_dropped)
+        self.last_dropped = None
+        self.dropped -= 1
+        self.submitted += 1
+      if self.dropped:
+        print "mcfit_async_renderer: %d of %d figures were skipped" \
+              % (self.dropped, self.dropped + self.submitted)
+      self.queue.put(None)
+    else:
+      self.proc.terminate()
+    self.proc.join()
+    self.queue.close()
+
+
+def _mcfit_render_worker(queue, static):
+  """Main loop of the rendering process of mcfit_async_renderer."""
+  from matplotlib.figure import Figure
+  from matplotlib.backends.backend_agg import FigureCanvasAgg
+  (func, x, y, dy, plot_x, nlf_y, fig_dir) = static
+  fig = Figure()
+  FigureCanvasAgg(fig)
+  while True:
+    snapshot = queue.get()
+    if snapshot is None:
+      break
+    (iter_num, dice_y, dice_params) = snapshot
+    try:
+      mcfit_draw_step1_(fig, iter_num, x, y, dy, plot_x, nlf_y,
+                        dice_y, func(dice_params, [plot_x]))
+      fig.savefig(os.path.join(fig_dir, "mcfit-%04d.png" % iter_num))
+    except Exception, e:
+      print "mcfit_async_renderer: cannot render step %d: %s" % (iter_num, e)
+
+
+
+# Worker-process routines for parallel MC loop (see mcfit_loop1_)
+
+def _mcfit_worker_step1(index):
+  """Performs the index-th dice toss and its fit in a worker process."""
+  sfit = worker_args()
+  sfit.mcfit_step1_toss_dice_(sfit.mcfit_rng_stream_(index))
+  return (sfit.dice_dy, sfit.mcfit_step1_fit_(sfit.dice_y))
 
 
 
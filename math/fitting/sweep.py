@@ -0,0 +1,212 @@
+#
+# wpylib.math.fitting.sweep module
+# Created: 20261019
+# Wirawan Purwanto
+#
+
+"""
+wpylib.math.fitting.sweep module
+Continuation fitting over sequences of related datasets.
+
+We often fit the same ansatz to a long, ordered sequence of related
+datasets: a series of basis sets, time steps, system sizes, etc.
+The solutions vary smoothly along such a sweep, so each fit can start
+from the solutions of its predecessors instead of Guess_xy:
+
+- extrapolate=0: from the previous solution;
+- extrapolate=1 or 2: from the linear or quadratic (Lagrange)
+  extrapolation of the last 2 or 3 solutions, in terms of the sweep
+  coordinates (the `coords' argument, default: the dataset index);
+- extrapolate=None: no continuation (every fit starts from Guess_xy).
+
+The extrapolated guess is used only if it has a lower chi square on the
+new dataset than the previous solution (this costs one function
+evaluation each).
+If a continuation fit fails (raises an exception or yields a non-finite
+chi square), it is redone from Guess_xy.
+
+fit_sweep_branches runs several independent sweeps (branches), optionally
+in a pool of worker processes.
+
+The results are returned as a columnar table: a numpy structured array
+with one row per dataset and the fields
+
+- branch, index, coord: the branch number, the dataset index within the
+  branch, and the sweep coordinate;
+- <param>, <param>_err: the fitted value and its uncertainty, for each
+  parameter in func.param_names (or p0, p1, ... if not defined);
+- chi_square, funcalls;
+- guess: the kind of starting point that was used (see guess_kinds);
+- ok: False if the fit failed altogether (the parameters are then NaN).
+
+Usage:
+
+    func = morse2_fit_func()
+    tbl = func.fit_sweep([ (x1, y1, dy1), (x2, y2, dy2), ... ],
+                         coords=[2, 3, 4, 5])
+    pyplot.plot(tbl['coord'], tbl['r0'])
+"""
+
+from wpylib.math.fitting import worker_pool, worker_args
+import numpy
+
+# Codes of the `guess' field in the result table:
+GUESS_XY = 0
+GUESS_PREV = 1
+GUESS_EXTRAP = 2
+GUESS_FALLBACK = 3
+guess_kinds = ('Guess_xy', 'previous', 'extrapolated', 'fallback')
+
+
+def extrapolate_params(coords, params, s):
+  """Lagrange extrapolation (or interpolation) of the parameter vectors
+  `params' (one row per coordinate in `coords') to the coordinate s."""
+  coords = numpy.asarray(coords, dtype=float)
+  params = numpy.asarray(params, dtype=float)
+  w = numpy.ones(len(coords))
+  for j in xrange(len(coords)):
+    for m in xrange(len(coords)):
+      if m != j:
+        w[j] *= (s - coords[m]) / (coords[j] - coords[m])
+  return numpy.dot(w, params)
+
+
+def sweep_table_dtype(names):
+  """Returns the dtype of the result table for the given parameter names."""
+  return numpy.dtype([('branch', int), ('index', int), ('coord', float)]
+                     + [ (p, float) for p in names ]
+                     + [ (p + '_err', float) for p in names ]
+                     + [('chi_square', float), ('funcalls', int),
+                        ('guess', numpy.int8), ('ok', bool)])
+
+
+def sweep_wssr_(func, C, x, y, dy):
+  """Chi square of parameter set C on a dataset (inf if not finite)."""
+  r = func(C, x) - y
+  if dy is not None:
+    r = r / dy
+  chi2 = numpy.sum(r**2)
+  if numpy.isfinite(chi2):
+    return chi2
+  return numpy.inf
+
+
+def sweep_fit1_(func, x, y, dy, fit_opts, Guess):
+  """Performs one fit of the sweep; returns True if it succeeded."""
+  try:
+    xopt = func.fit(x, y, dy, fit_opts=fit_opts,
+                    Guess=(tuple(Guess) if Guess is not None else None))
+  except Exception, e:
+    if func.debug >= 1:
+      print "fit_sweep: fit failed: %s" % (e,)
+    return False
+  return bool(numpy.all(numpy.isfinite(xopt))
+              and numpy.isfinite(func.last_fit['chi_square']))
+
+
+def fit_sweep(func, datasets, coords=None, extrapolate=1, fit_opts=None,
+              Guess=None, branch=0):
+  """Continuation fit of a fit_func_base object over an ordered sequence
+  of (x, y, dy) datasets; see the module documentation.
+  Guess, if given, is the starting point of the first fit.
+  Returns the result table (a numpy structured array).
+  """
+  datasets = list(datasets)
+  if coords is None:
+    coords = numpy.arange(len(datasets), dtype=float)
+  coords = numpy.asarray(coords, dtype=float)
+  if len(coords) != len(datasets):
+    raise ValueError, "fit_sweep: coords and datasets have different lengths"
+
+  rows = []
+  hist_s = []
+  hist_X = []
+  nparams = None
+  for (i, (x, y, dy)) in enumerate(datasets):
+    x = func.domain_array(x)
+    y = numpy.asarray(y, dtype=float)
+    if dy is not None:
+      dy = numpy.asarray(dy, dtype=float)
+    s = coords[i]
+
+    # Choose the starting point:
+    if extrapolate is None or not hist_X:
+      G, kind = (Guess if i == 0 else None), GUESS_XY
+    else:
+      G, kind = hist_X[-1], GUESS_PREV
+      order = min(extrapolate, len(hist_X) - 1)
+      if order > 0:
+        G_ext = extrapolate_params(hist_s[-order-1:], hist_X[-order-1:], s)
+        if sweep_wssr_(func, G_ext, x, y, dy) < sweep_wssr_(func, G, x, y, dy):
+          G, kind = G_ext, GUESS_EXTRAP
+
+    ok = sweep_fit1_(func, x, y, dy, fit_opts, G)
+    if not ok and kind != GUESS_XY:
+      kind = GUESS_FALLBACK
+      ok = sweep_fit1_(func, x, y, dy, fit_opts, None)
+
+    if ok:
+      rec = func.last_fit
+      xopt = numpy.array(rec['xopt'], dtype=float)
+      nparams = len(xopt)
+      xerr = rec.get('xerr', None)
+      if xerr is None:
+        xerr = numpy.nan * xopt
+      rows.append((branch, i, s, xopt, xerr, rec['chi_square'],
+                   rec.get('funcalls', 0), kind, ok))
+      hist_s.append(s)
+      hist_X.append(xopt)
+    else:
+      rows.append((branch, i, s, None, None, numpy.nan, 0, kind, ok))
+
+  if nparams is None:
+    nparams = len(getattr(func, "param_names", ()))
+  names = getattr(func, "param_names", None)
+  if names is None:
+    names = [ "p%d" % k for k in xrange(nparams) ]
+  tbl = numpy.zeros(len(rows), dtype=sweep_table_dtype(names))
+  for (row, (b, i, s, xopt, xerr, chi2, nfev, kind, ok)) in zip(tbl, rows):
+    (row['branch'], row['index'], row['coord']) = (b, i, s)
+    (row['chi_square'], row['funcalls'], row['guess'], row['ok']) = (chi2, nfev, kind, ok)
+    for (k, p) in enumerate(names):
+      row[p] = xopt[k] if ok else numpy.nan
+      row[p + '_err'] = xerr[k] if ok else numpy.nan
+  return tbl
+
+
+def fit_sweep_branches(func, branches, coords=None, nproc=None, **opts):
+  """Runs independent continuation sweeps (branches) of the same ansatz.
+  `branches' is a list of dataset sequences, and `coords' (optional) the
+  matching list of coordinate sequences.
+  With nproc > 1, the branches are fitted in a pool of worker processes.
+  The other keyword arguments are passed to fit_sweep.
+  Returns the concatenated result table of all the branches.
+  """
+  branches = [ list(B) for B in branches ]
+  if coords is None:
+    coords = [None] * len(branches)
+  jobs = [ (b, B, coords[b]) for (b, B) in enumerate(branches) ]
+  if nproc is not None and nproc > 1:
+    # (no concurrent access to the cache file)
+    pool = worker_pool(nproc, (func.worker_copy(), opts))
+    try:
+      tables = pool.map(_sweep_worker_branch, jobs, 1)
+      pool.close()
+    except:
+      pool.terminate()
+      raise
+    finally:
+      pool.join()
+  else:
+    worker_func = func.worker_copy(keep=('instrument', 'fit_cache'))
+    tables = [ fit_sweep(worker_func, B, coords=c, branch=b, **opts)
+               for (b, B, c) in jobs ]
+  return numpy.concatenate(tables)
+
+
+# Worker-process routines for parallel sweep branches
+
+def _sweep_worker_branch(job):
+  (func, opts) = worker_args()
+  (b, B, c) = job
+  return fit_sweep(func, B, coords=c, branch=b, **opts)
@@ -0,0 +1,214 @@
+#
+# wpylib.math.stats.online_stats module
+# Created: 20261019
+# Wirawan Purwanto
+#
+
+"""
+wpylib.math.stats.online_stats module
+Single-pass (online) statistics of a stream of samples.
+
+The online_stats object accumulates the count, mean, and the second to
+fourth central moments of a stream of (vector-valued) samples with the
+numerically stable update formulas of Welford, as generalized to higher
+moments by Terriberry and Pebay.
+Besides the mean and standard deviation, it provides the standard error
+of the standard deviation estimate itself, i.e. how well the spread
+(the "error bar") of the samples is known.
+This is what is needed to decide when a Monte Carlo error estimate has
+converged.
+With track_cov=True, it also accumulates the covariance matrix of the
+(1-D array) samples.
+
+The reservoir_sample object keeps a uniform random subset of fixed size
+of a stream of samples (Vitter's "algorithm R"), e.g. for diagnostic
+plots of a long Monte Carlo run.
+
+Reference:
+  P. Pebay, "Formulas for robust, one-pass parallel computation of
+  covariances and arbitrary-order statistical moments",
+  Sandia Report SAND2008-6212 (2008).
+"""
+
+import numpy
+
+
+class online_stats(object):
+  """Online mean, variance and higher-moment accumulator.
+  Each sample is a scalar or an array of a fixed shape; the statistics
+  are computed elementwise.
+
+      S = online_stats()
+      for x in samples:
+        S.add(x)
+      print S.mean(), S.std(), S.std_err()
+
+  With track_cov=True, the samples must be 1-D arrays, and the co-moment
+  matrix (the sum of the outer products of the deviations) is kept in
+  the `C` attribute; see cov().
+  """
+  def __init__(self, track_cov=False):
+    self.track_cov = track_cov
+    self.clear()
+
+  def clear(self):
+    self.N = 0
+    self.M1 = 0.0   # mean
+    self.M2 = 0.0   # sum of squared deviations
+    self.M3 = 0.0
+    self.M4 = 0.0
+    self.C = 0.0    # co-moment matrix (if track_cov)
+
+  def add(self, x):
+    """Adds a single sample."""
+    x = numpy.asarray(x, dtype=float)
+    n1 = self.N
+    n = n1 + 1
+    delta = x - self.M1
+    delta_n = delta / n
+    delta_n2 = delta_n * delta_n
+    term1 = delta * delta_n * n1
+    self.M1 = self.M1 + delta_n
+    self.M4 = self.M4 + term1 * delta_n2 * (n*n - 3*n + 3) \
+              + 6 * delta_n2 * self.M2 - 4 * delta_n * self.M3
+    self.M3 = self.M3 + term1 * delta_n * (n - 2) - 3 * delta_n * self.M2
+    self.M2 = self.M2 + term1
+    if self.track_cov:
+      self.C = self.C + numpy.outer(delta, x - self.M1)
+    self.N = n
+    return self
+
+  def add_batch(self, X):
+    """Adds many samples at once; the first dimension of X runs over the
+    samples."""
+    X = numpy.asarray(X, dtype=float)
+    if len(X) == 0:
+      return self
+    B = online_stats(track_cov=self.track_cov)
+    B.N = len(X)
+    B.M1 = numpy.mean(X, axis=0)
+    D = X - B.M1
+    D2 = D * D
+    B.M2 = numpy.sum(D2, axis=0)
+    B.M3 = numpy.sum(D2 * D, axis=0)
+    B.M4 = numpy.sum(D2 * D2, axis=0)
+    if self.track_cov:
+      B.C = numpy.dot(D.T, D)
+    return self.merge(B)
+
+  def merge(self, other):
+    """Merges the statistics of another online_stats object (e.g. from
+    another process) into this one."""
+    na, nb = self.N, other.N
+    if nb == 0:
+      return self
+    if na == 0:
+      (self.N, self.M1, self.M2, self.M3, self.M4) = \
+        (other.N, other.M1, other.M2, other.M3, other.M4)
+      if self.track_cov:
+        self.C = other.C
+      return self
+    n = na + nb
+    delta = other.M1 - self.M1
+    delta2 = delta * delta
+    M1 = self.M1 + delta * nb / n
+    M2 = self.M2 + other.M2 + delta2 * na * nb / n
+    M3 = self.M3 + other.M3 \
+         + delta * delta2 * na * nb * (na - nb) / (n*n) \
+         + 3 * delta * (na * other.M2 - nb * self.M2) / n
+    M4 = self.M4 + other.M4 \
+         + delta2 * delta2 * na * nb * (na*na - na*nb + nb*nb) / (n*n*n) \
+         + 6 * delta2 * (na*na * other.M2 + nb*nb * self.M2) / (n*n) \
+         + 4 * delta * (na * other.M3 - nb * self.M3) / n
+    if self.track_cov:
+      self.C = self.C + other.C + numpy.outer(delta, delta) * (na * nb / float(n))
+    (self.N, self.M1, self.M2, self.M3, self.M4) = (n, M1, M2, M3, M4)
+    return self
+
+  def mean(self):
+    return self.M1
+
+  def var(self, ddof=0):
+    return self.M2 / (self.N - ddof)
+
+  def std(self, ddof=0):
+    return numpy.sqrt(self.var(ddof))
+
+  def cov(self, ddof=0):
+    """Covariance matrix of the samples (requires track_cov)."""
+    if not self.track_cov:
+      raise ValueError, "Covariance is not tracked (track_cov=False)"
+    return self.C / (self.N - ddof)
+
+  def mean_err(self):
+    """Standard error of the mean."""
+    return numpy.sqrt(self.var(1) / self.N)
+
+  def kurtosis(self):
+    """(Non-excess) kurtosis, i.e. m4 / m2**2; equal to 3 for a normal
+    distribution."""
+    return self.N * self.M4 / (self.M2 * self.M2)
+
+  def var_err(self):
+    """Standard error of the (sample) variance estimate:
+
+        Var(s**2) = (m4 - (N-3)/(N-1) * m2**2) / N
+    """
+    N = self.N
+    m2 = self.M2 / N
+    m4 = self.M4 / N
+    return numpy.sqrt(numpy.abs(m4 - (N - 3.0) / (N - 1.0) * m2 * m2) / N)
+
+  def std_err(self):
+    """Standard error of the standard deviation estimate (delta method),
+    i.e. the Monte Carlo uncertainty of the error bar.
+    For normally distributed samples, this is about std / sqrt(2*(N-1))."""
+    return self.var_err() / (2 * self.std(1))
+
+  def std_rel_err(self):
+    """Relative standard error of the standard deviation estimate.
+    Zero-variance elements (e.g. fixed parameters) yield zero."""
+    s = self.std(1)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+      r = self.var_err() / (2 * s * s)
+    return numpy.where(s > 0, r, 0.0)
+
+
+class reservoir_sample(object):
+  """Uniform random sample of (at most) `size` items out of a stream of
+  samples of unknown length (Vitter's algorithm R).
+  Every item of the stream ends up in the sample with equal probability.
+  The random numbers are drawn from `rng` (a numpy RandomState-like
+  object), which should be separate from the one producing the stream
+  if the stream must not be perturbed.
+
+      R = reservoir_sample(100, rng=numpy.random.RandomState(1))
+      for x in samples:
+        R.add(x)
+      R.sample()   # an array of the (at most) 100 samples kept
+  """
+  def __init__(self, size, rng=None):
+    if rng is None:
+      rng = numpy.random.RandomState()
+    self.size = size
+    self.rng = rng
+    self.clear()
+
+  def clear(self):
+    self.N = 0
+    self.items = []
+
+  def add(self, x):
+    """Offers a single item to the sample."""
+    if self.N < self.size:
+      self.items.append(numpy.array(x))
+    else:
+      j = self.rng.randint(0, self.N + 1)
+      if j < self.size:
+        self.items[j] = numpy.array(x)
+    self.N += 1
+    return self
+
+  def sample(self):
+    """Returns the sampled items as an array (in no particular order)."""
+    return numpy.array(self.items)
@@ -103,6 +103,111 @@ def matrix_str(M, fmt=None, prefix="", suffix=""):
     return prefix + linesep.join([ " ".join([ fmt % c for c in R ]) for R in M ]) + suffix
 
 
+def table_write(out, columns, fmt=None, sep=" ", prefix="", suffix="",
+                header=None, chunk_rows=4096):
+  """Writes a table, given as a list of columns, in a textual format.
+  This is a streaming alternative to matrix_str: the table is formatted
+  and written out in blocks of `chunk_rows' rows, so the memory use is
+  independent of the table size.
+  Each block is formatted with a single string formatting operation
+  using a precompiled row format, which is much faster than per-element
+  formatting.
+
+  Arguments:
+  * out: a file-like object or a file name.
+  * columns: a sequence of 1-D arrays of equal length.
+    Integer, float and complex columns can be mixed.
+  * fmt: the format of a table cell, or a list of formats (one per column).
+    By default, "%22.15g" is used for real values and
+    "(%+22.15e%+22.15ej)" for complex values.
+    A complex cell format must consume two values (real and imaginary
+    parts), e.g. '(%+#22.15e,%+#22.15e)' for C++ and Fortran-friendly
+    format.
+  * sep: the separator between cells.
+  * prefix, suffix: strings added at the beginning and end of each row.
+  * header: a string written before the table (a trailing newline is
+    added if missing).
+  """
+  columns = [ numpy.asarray(c) for c in columns ]
+  if len(columns) == 0:
+    raise ValueError, "No columns to write."
+  nrows = len(columns[0])
+  for c in columns:
+    if c.shape != (nrows,):
+      raise ValueError, "Wrong shape: columns must be 1-D arrays of equal length."
+  if fmt is None or isinstance(fmt, basestring):
+    fmts = [fmt] * len(columns)
+  else:
+    fmts = list(fmt)
+    if len(fmts) != len(columns):
+      raise ValueError, "The number of formats and columns must be equal."
+
+  is_complex = [ numpy.iscomplexobj(c) for c in columns ]
+  for (i,f) in enumerate(fmts):
+    if f is None:
+      fmts[i] = ifelse(is_complex[i], "(%+22.15e%+22.15ej)", "%22.15g")
+  rowfmt = prefix + sep.join(fmts) + suffix + "\n"
+
+  # Cell values are laid out as a 2-D array (one row per table row);
+  # complex values occupy two consecutive slots.
+  # Integer values are kept as python ints if they are mixed with other
+  # types to avoid loss of precision.
+  nvals = sum([ ifelse(cplx, 2, 1) for cplx in is_complex ])
+  kinds = set([ c.dtype.kind for c in columns ])
+  if kinds <= set("biu") or kinds <= set("fc"):
+    val_dtype = None
+  else:
+    val_dtype = object
+
+  if isinstance(out, basestring):
+    F = open(out, "w")
+  else:
+    F = out
+  try:
+    if header is not None:
+      F.write(header)
+      if not header.endswith("\n"):
+        F.write("\n")
+    for i0 in xrange(0, nrows, chunk_rows):
+      i1 = min(i0 + chunk_rows, nrows)
+      parts = []
+      for (c,cplx) in zip(columns, is_complex):
+        if cplx:
+          parts += [ c[i0:i1].real, c[i0:i1].imag ]
+        else:
+          parts.append(c[i0:i1])
+      if val_dtype is None:
+        block = numpy.column_stack(parts)
+      else:
+        block = numpy.empty((i1-i0, nvals), dtype=val_dtype)
+        for (j,p) in enumerate(parts):
+          block[:,j] = p.tolist()
+      F.write((rowfmt * (i1-i0)) % tuple(block.ravel().tolist()))
+  finally:
+    if F is not out:
+      F.close()
+
+
+def matrix_write(out, M, fmt=None, sep=" ", prefix="", suffix="",
+                 header=None, chunk_rows=4096):
+  """Writes a matrix in a textual format to a file-like object (or a
+  file with a given name).
+  The output is the same as that of matrix_str (plus the trailing
+  newline), but the text is streamed out in blocks of rows.
+  Use this instead of matrix_str for big arrays.
+  A 1-D array is written as a single column.
+  See table_write for the description of the arguments.
+  """
+  M = numpy.asarray(M)
+  if len(M.shape) == 1:
+    M = M.reshape((len(M), 1))
+  elif len(M.shape) != 2:
+    raise ValueError, "Wrong shape: expecting a one- or two-dimensional array."
+  table_write(out, [ M[:,j] for j in xrange(M.shape[1]) ],
+              fmt=fmt, sep=sep, prefix=prefix, suffix=suffix,
+              header=header, chunk_rows=chunk_rows)
+
+
 def str_indent(text, indent=" "*4):
   """Indents a text block by a given prefix.
   If the indent is a number 'N', a string of N white spaces are taken as